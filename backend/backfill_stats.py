@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+'''Rebuilds the circulation rollups (daily_stats and book_daily_stats) from checkout_logs
+
+Checkout and return keep the rollups up to date as they happen, this fills them in for the
+history logged before the circulation_rollups migration, or repairs them. It can run while the
+server is up: the rollups are locked against writes while they are rebuilt, so checkouts and
+returns made meanwhile wait for it and are then counted once.
+
+Usage: python backfill_stats.py'''
+
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+# queries
+LOCK = "lock table daily_stats, book_daily_stats in exclusive mode"
+CLEAR = "delete from book_daily_stats; delete from daily_stats"
+# a loan counts as a checkout on the day it was made, and as a return on the day it was closed
+BACKFILL_BOOK_DAYS = """insert into book_daily_stats (day, book_id, checkouts, returns, loan_seconds)
+                        select day, book_id, sum(checkouts), sum(returns), sum(loan_seconds)
+                        from (select checkout_date::date as day, book_id, count(*) as checkouts,
+                                     0 as returns, 0 as loan_seconds
+                              from checkout_logs group by 1, 2
+                              union all
+                              select checkin_date::date, book_id, 0, count(*),
+                                     sum(extract(epoch from checkin_date - checkout_date))
+                              from checkout_logs where checkin_date is not null group by 1, 2) as loans
+                        group by day, book_id"""
+BACKFILL_DAYS = """insert into daily_stats (day, checkouts, returns, loan_seconds)
+                   select day, sum(checkouts), sum(returns), sum(loan_seconds)
+                   from book_daily_stats group by day"""
+
+
+def backfill(engine) -> int:
+    """Rebuilds the rollups in one transaction, returns the number of days they cover"""
+    with engine.begin() as connection:
+        connection.execute(text(LOCK))
+        connection.execute(text(CLEAR))
+        connection.execute(text(BACKFILL_BOOK_DAYS))
+        return connection.execute(text(BACKFILL_DAYS)).rowcount
+
+
+def main():
+    load_dotenv()
+    engine = create_engine(os.getenv("SUPABASE_DATABASE_URL"))
+    try:
+        days = backfill(engine)
+    finally:
+        engine.dispose()
+    print(f"Rebuilt the circulation rollups of {days} days")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Load test of the server's hot endpoints against the in-memory storage backend.
+
+Drives /books, /checkout, /my-books and /return through the ASGI app with a configurable number
+of concurrent clients, and reports requests/s and p50/p95/p99 latency for each. The server
+runs on the in-memory storage backend, optionally with a simulated database round trip
+(--db-latency), so the numbers measure the server itself and are comparable between commits.
+
+Usage: python benchmarks/load.py [--concurrency 10] [--requests 500] [--output results.json]
+                                 [--compare previous.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from unittest.mock import patch
+
+# the server picks its storage backend when it is imported, so it doesn't create a database
+# engine. The storage and JWT secret the requests use are passed in by run()
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+import jwt  # noqa: E402
+
+import server  # noqa: E402
+import storage  # noqa: E402
+
+# the tokens of the simulated users are signed with it
+JWT_SECRET = "bench-secret-that-is-at-least-32-bytes"
+
+
+class SlowMemoryStorage(storage.MemoryStorage):
+    """The in-memory storage with a simulated database round trip added to each call the handlers make"""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def books_page(self, limit: int, after: list | None) -> list:
+        self.round_trip()
+        return super().books_page(limit, after)
+
+    def my_books(self, user_id: str, today) -> list:
+        self.round_trip()
+        return super().my_books(user_id, today)
+
+    def claim_books(self, book_ids: list, user_id: str, due_date) -> tuple[dict, set]:
+        self.round_trip()
+        return super().claim_books(book_ids, user_id, due_date)
+
+    def checkin_books(self, book_ids: list, user_id: str) -> set:
+        self.round_trip()
+        return super().checkin_books(book_ids, user_id)
+
+
+def percentile(latencies: list, p: int) -> float:
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0.0
+    return statistics.quantiles(latencies, n=100, method="inclusive")[p - 1]
+
+
+def auth(user_id: str) -> dict:
+    """Returns the header of a request made by user_id"""
+    claims = {"sub": user_id, "aud": "authenticated", "exp": int(time.time()) + 3600}
+    return {"Authorization": jwt.encode(claims, JWT_SECRET, algorithm="HS256")}
+
+
+async def run_endpoint(client: httpx.AsyncClient, requests: list, concurrency: int) -> dict:
+    """Sends (method, path, headers, json) requests with concurrency clients, returns their statistics"""
+    latencies, errors = [], 0
+    queue = iter(requests)
+
+    async def worker():
+        nonlocal errors
+        for method, path, headers, body in queue:
+            start = time.perf_counter()
+            response = await client.request(method, path, headers=headers, json=body)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {"requests": len(latencies), "errors": errors, "requests_per_second": round(len(latencies) / elapsed, 1),
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3)}
+
+
+async def run(args) -> dict:
+    store = SlowMemoryStorage(latency=args.db_latency / 1000)
+    for i in range(max(args.books, args.requests)):
+        store.add_book_copies(f"Book {i:06d}", f"Author {i % 500}", f"978{i:010d}", 1)
+    users = [str(uuid.uuid4()) for _ in range(args.concurrency)]
+    headers = {user_id: auth(user_id) for user_id in users}
+    book_ids = [book_id for _, book_id in store.order[:args.requests]]
+    loans = [(book_id, users[i % len(users)]) for i, book_id in enumerate(book_ids)]
+
+    # each endpoint is run after the one before it, so /my-books sees the loans made by /checkout
+    scenarios = {
+        "/books": [("GET", "/books", None, None)] * args.requests,
+        "/checkout": [("PUT", "/checkout", headers[user_id], {"book_id": book_id}) for book_id, user_id in loans],
+        "/my-books": [("POST", "/my-books", None, {"user_id": users[i % len(users)]}) for i in range(args.requests)],
+        "/return": [("PUT", "/return", headers[user_id], {"book_id": book_id}) for book_id, user_id in loans],
+    }
+
+    with patch.object(server, "store", store), patch.object(server, "jwt_secret", JWT_SECRET):
+        server.invalidate_catalog()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            results = {}
+            for endpoint, requests in scenarios.items():
+                results[endpoint] = await run_endpoint(client, requests, args.concurrency)
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: dict, previous: dict | None) -> None:
+    print(f"{'endpoint':<12}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for endpoint, result in results.items():
+        print(f"{endpoint:<12}{result['requests_per_second']:>10}{result['p50_ms']:>10}"
+              f"{result['p95_ms']:>10}{result['p99_ms']:>10}{result['errors']:>8}")
+        old = (previous or {}).get(endpoint)
+        if old:
+            print(f"{'  vs before':<12}{result['requests_per_second'] / old['requests_per_second']:>9.2f}x"
+                  f"{result['p50_ms'] / old['p50_ms']:>9.2f}x{result['p95_ms'] / old['p95_ms']:>9.2f}x"
+                  f"{result['p99_ms'] / old['p99_ms']:>9.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=10, help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=500, help="requests sent to each endpoint")
+    parser.add_argument("--books", type=int, default=1000, help="books in the stand-in catalog")
+    parser.add_argument("--db-latency", type=float, default=1.0, help="simulated database round trip in ms")
+    parser.add_argument("--output", default="benchmark-results.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            previous = json.load(f)["endpoints"]
+    print_results(results, previous)
+
+    report = {"commit": git_commit(), "python": platform.python_version(), "concurrency": args.concurrency,
+              "requests": args.requests, "books": args.books, "db_latency_ms": args.db_latency, "endpoints": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Compares encoding a page of books the old way (jsonable_encoder + json.dumps)
+with the new one (orjson), reporting time and peak allocation per 10k rows.
+
+Usage: python benchmarks/serialization.py [rows]
+"""
+
+import json
+import sys
+import timeit
+import tracemalloc
+import uuid
+from datetime import date, datetime, timedelta
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+
+def make_rows(count: int) -> list:
+    """Builds rows shaped like the books table"""
+    now = datetime(2026, 10, 18, 12, 0)
+    return [{
+        "id": uuid.uuid4(),
+        "created_at": now - timedelta(minutes=i),
+        "updated_at": now,
+        "title": f"Book {i}",
+        "author": f"Author {i % 500}",
+        "isbn": f"978{i:010d}",
+        "is_checked_out": i % 3 == 0,
+        "due_date": date(2026, 11, 1) if i % 3 == 0 else None,
+    } for i in range(count)]
+
+
+def before(page: dict) -> bytes:
+    return json.dumps(jsonable_encoder(page)).encode()
+
+
+def after(page: dict) -> bytes:
+    return orjson.dumps(page)
+
+
+def measure(encode, page: dict) -> tuple[float, int]:
+    """Returns the best time in seconds and the peak allocation in bytes of one encode"""
+    seconds = min(timeit.repeat(lambda: encode(page), number=1, repeat=5))
+    tracemalloc.start()
+    encode(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    page = {"data": make_rows(count), "next_cursor": None}
+    assert orjson.loads(before(page)) == orjson.loads(after(page))
+
+    print(f"{'encoder':<28}{'ms':>10}{'peak KiB':>12}")
+    for name, encode in (("jsonable_encoder+json", before), ("orjson", after)):
+        seconds, peak = measure(encode, page)
+        print(f"{name:<28}{seconds * 1000:>10.1f}{peak / 1024:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Startup benchmark of the server: how long until it answers its first requests.
+
+Starts the server with uvicorn in a new process several times, and reports the median time
+from starting the process until / answers (time to first request), and how long the first and
+second /books requests then take. Importing the server is timed separately. With the Postgres
+storage backend the first /books shows what warming the pool (--pool-warmup) saves.
+
+Usage: python benchmarks/startup.py [--runs 5] [--storage memory] [--pool-warmup 2]
+                                    [--output benchmark-results-startup.json] [--compare previous.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# time given to the server to start before a run fails
+START_TIMEOUT = 60
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_import(env: dict) -> float:
+    """Returns how long importing the server takes in a new process, in ms"""
+    code = "import time; start = time.perf_counter(); import server; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=BACKEND, env=env, capture_output=True, text=True,
+                            check=True).stdout
+    return float(output.strip().splitlines()[-1]) * 1000
+
+
+def time_startup(env: dict) -> dict:
+    """Starts the server, returns the time until / answered and the time of the first two /books, in ms"""
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"],
+                               cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}") as client:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"The server exited with code {process.returncode}")
+                if time.perf_counter() - start > START_TIMEOUT:
+                    raise RuntimeError("The server didn't start in time")
+                try:
+                    if client.get("/").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    time.sleep(0.005)
+            ready = time.perf_counter() - start
+
+            books = []
+            for _ in range(2):
+                request_start = time.perf_counter()
+                client.get("/books", params={"limit": 100})
+                books.append(time.perf_counter() - request_start)
+    finally:
+        process.terminate()
+        process.wait()
+    return {"first_request_ms": ready * 1000, "first_books_ms": books[0] * 1000, "second_books_ms": books[1] * 1000}
+
+
+def run(args) -> dict:
+    env = dict(os.environ, STORAGE_BACKEND=args.storage, DB_POOL_WARMUP=str(args.pool_warmup))
+    imports = [time_import(env) for _ in range(args.runs)]
+    startups = [time_startup(env) for _ in range(args.runs)]
+    results = {"import_ms": round(statistics.median(imports), 1)}
+    for name in startups[0]:
+        results[name] = round(statistics.median(startup[name] for startup in startups), 1)
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: dict, previous: dict | None) -> None:
+    print(f"{'median of runs':<20}{'ms':>10}{'vs before':>12}")
+    for name, value in results.items():
+        old = (previous or {}).get(name)
+        change = f"{value / old:>11.2f}x" if old else ""
+        print(f"{name:<20}{value:>10}{change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="times the server is started")
+    parser.add_argument("--storage", default="memory", choices=["memory", "postgres"],
+                        help="storage backend, postgres reads SUPABASE_DATABASE_URL")
+    parser.add_argument("--pool-warmup", type=int, default=2, help="connections opened when the server starts")
+    parser.add_argument("--output", default="benchmark-results-startup.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            previous = json.load(f)["results"]
+    print_results(results, previous)
+
+    report = {"commit": git_commit(), "python": platform.python_version(), "runs": args.runs,
+              "storage": args.storage, "pool_warmup": args.pool_warmup, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+'''Server-sent events of availability changes
+
+Checkouts and returns publish an event per book with its new available_copies and total_copies,
+GET /events streams them to every subscriber. The last EVENTS_BUFFER events are kept in a ring
+buffer in sequence order, and a subscriber is only a position in it: while idle it awaits one
+future shared by all subscribers, which the next publish resolves, waking them all at once
+rather than each polling for events. Each idle subscriber only has the timer of its heartbeat.
+
+The counters are read after the write committed, so two concurrent checkouts of a book can
+publish their counters in the opposite order. Each event carries the book's updated_at, which
+increases with every write to the book, and clients ignore an event older than what they show.
+
+Checkouts and returns handled by other server processes are published when they reach this
+one through the invalidation bus (see invalidation.py), but events are numbered per process.
+A client reconnecting with the Last-Event-ID of an event still in the buffer is sent the events
+it missed. A client whose event is no longer in the buffer, or is
+from another process, is sent a "reset" event, after which it has to reload the books.'''
+
+import asyncio
+import os
+from collections import deque
+
+import orjson
+
+import metrics
+
+EVENTS_BUFFER = int(os.getenv("EVENTS_BUFFER", "1024"))
+# seconds between the comments sent to idle subscribers, so proxies don't close the connection
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))
+
+HEARTBEAT = b": heartbeat\n\n"
+
+
+class EventBroker:
+    """The recent events of this process and what wakes their subscribers"""
+
+    def __init__(self, instance: str, size: int = EVENTS_BUFFER):
+        self.instance = instance  # prefix of the event ids, changes every time the server starts
+        self.events = deque(maxlen=size)  # (sequence, encoded event), oldest first
+        self.sequence = 0  # of the last event
+        self.subscribers = 0
+        self.published = None  # future resolved by the next publish, while anyone waits for it
+
+    def event_id(self, sequence: int) -> str:
+        return f"{self.instance}-{sequence}"
+
+    def parse_id(self, event_id: str | None) -> int | None:
+        """Returns the sequence of an event id of this process, None if it isn't one"""
+        instance, _, sequence = (event_id or "").rpartition("-")
+        if instance != self.instance or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+    def publish(self, name: str, data: dict) -> None:
+        """Adds an event to the buffer and wakes every subscriber, call it from the event loop"""
+        self.sequence += 1
+        self.events.append((self.sequence, b"id: %s\nevent: %s\ndata: %s\n\n" % (
+            self.event_id(self.sequence).encode(), name.encode(), orjson.dumps(data))))
+        self.wake()
+
+    def skip(self) -> None:
+        """Counts an event nobody was subscribed to without encoding it. Reconnecting
+        subscribers that missed it are reset, since it isn't in the buffer."""
+        self.sequence += 1
+        self.events.clear()
+
+    def reset(self) -> bytes:
+        return b"id: %s\nevent: reset\ndata: {}\n\n" % self.event_id(self.sequence).encode()
+
+    def wake(self) -> None:
+        if self.published is not None:
+            self.published.set_result(None)
+            self.published = None
+
+    def since(self, sequence: int) -> list | None:
+        """Returns the (sequence, encoded event) after sequence, None if some of them were dropped"""
+        if sequence >= self.sequence:
+            return []
+        if not self.events or self.events[0][0] > sequence + 1:
+            return None
+        # the buffer is in sequence order without gaps
+        start = len(self.events) - (self.sequence - sequence)
+        return [self.events[i] for i in range(start, len(self.events))]
+
+    async def wait(self, timeout: float) -> bool:
+        """Waits up to timeout seconds for the next publish, returns whether it happened"""
+        if self.published is None:
+            self.published = asyncio.get_running_loop().create_future()
+        try:
+            # shielded so that a subscriber timing out doesn't cancel the future of the others
+            await asyncio.wait_for(asyncio.shield(self.published), timeout)
+            return True
+        except TimeoutError:
+            return False
+
+    async def subscribe(self, last_event_id: str | None = None, heartbeat: float = EVENTS_HEARTBEAT):
+        """Yields the encoded events published from now on, or after last_event_id, as they are published"""
+        self.subscribers += 1
+        metrics.event_subscribers.add(1)
+        try:
+            sequence = self.parse_id(last_event_id) if last_event_id else self.sequence
+            if sequence is None or sequence > self.sequence:
+                sequence = -1  # from another process, reset
+            # tells the client how long to wait before reconnecting
+            yield b"retry: 3000\n\n"
+            while True:
+                events = self.since(sequence)
+                if events is None:
+                    yield self.reset()
+                    sequence = self.sequence
+                elif events:
+                    sequence = events[-1][0]
+                    yield b"".join(event for _, event in events)
+                elif not await self.wait(heartbeat):
+                    yield HEARTBEAT
+        finally:
+            self.subscribers -= 1
+            metrics.event_subscribers.add(-1)
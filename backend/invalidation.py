@@ -0,0 +1,157 @@
+'''Cache invalidation across server processes with Postgres LISTEN/NOTIFY
+
+Each server process keeps caches of the database: the rendered /books pages, the recommendation
+counts and the availability events of its /events subscribers. A write handler updates its own
+process's caches as it always did, and publishes a message saying what it changed on CHANNEL.
+Every other process, on this host or another one using the same database, gets the message
+and makes the same change to its caches, so no broker other than Postgres is needed.
+
+Messages are JSON objects with the origin (the server_instance of the process that sent
+them), a kind, and the fields of that kind:
+    {"kind": "catalog"}                                    books were added
+    {"kind": "book", "book": {id, title, author, isbn}}    a book was added
+    {"kind": "checkout", "user_id", "book_ids"}            books were checked out
+    {"kind": "return", "user_id", "book_ids"}              books were returned
+    {"kind": "reset"}                                      messages may have been lost
+
+Publishing doesn't wait for the database: messages are queued and a sender thread sends the
+queued messages with one NOTIFY statement. A listener thread holds a connection of its own
+outside the pool, LISTENing on CHANNEL, and calls the handler with each message from another
+process. When its connection drops it reconnects, and calls the handler with a "reset" message,
+since the messages sent while it was disconnected are lost.'''
+
+import itertools
+import logging
+import os
+import queue
+import select
+import threading
+
+import orjson
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "lms_invalidation"
+# NOTIFY payloads are limited to 8000 bytes, messages with more book ids are split
+MAX_BOOK_IDS = 100
+# seconds between attempts to reconnect or resend after an error
+RETRY_SECONDS = 5
+# seconds the listener waits for a notification before checking that its connection is alive
+POLL_SECONDS = 5
+
+# queries
+NOTIFY = "select pg_notify(:channel, payload) from unnest(cast(:payloads as text[])) as payload"
+
+
+class InvalidationBus:
+    """Publishes the changes made by this process and applies those of the others"""
+
+    def __init__(self, engine, origin: str, handler):
+        self.engine = engine
+        self.origin = origin
+        self.handler = handler  # called with each message from another process, on the listener thread
+        self.pending = queue.SimpleQueue()  # payloads to send, None stops the sender
+        # numbers the messages, Postgres delivers identical payloads sent together only once
+        self.sequence = itertools.count()
+        self.stopped = threading.Event()
+        self.wakeup = os.pipe()  # written to by stop, so the listener doesn't wait out its poll
+        self.threads = []
+
+    def publish(self, kind: str, **fields) -> None:
+        """Queues a message for the other processes"""
+        book_ids = [str(book_id) for book_id in fields.pop("book_ids", [])]
+        chunks = [book_ids[i:i + MAX_BOOK_IDS] for i in range(0, len(book_ids), MAX_BOOK_IDS)]
+        for chunk in chunks or [None]:
+            message = {"origin": self.origin, "sequence": next(self.sequence), "kind": kind, **fields}
+            if chunk is not None:
+                message["book_ids"] = chunk
+            self.pending.put(orjson.dumps(message).decode())
+
+    def start(self) -> None:
+        for target, name in [(self.send, "invalidation-sender"), (self.listen, "invalidation-listener")]:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self) -> None:
+        """Sends the queued messages and stops both threads"""
+        self.pending.put(None)
+        self.stopped.set()
+        os.write(self.wakeup[1], b"\0")
+        for thread in self.threads:
+            thread.join(POLL_SECONDS + 1)
+        for fd in self.wakeup:
+            os.close(fd)
+
+    def send(self) -> None:
+        payloads = []
+        while True:
+            if not payloads:
+                payloads.append(self.pending.get())
+            # everything queued meanwhile goes in the same statement
+            while True:
+                try:
+                    payloads.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in payloads
+            payloads = [payload for payload in payloads if payload is not None]
+            if payloads:
+                try:
+                    with self.engine.begin() as connection:
+                        connection.execute(text(NOTIFY), {"channel": CHANNEL, "payloads": payloads})
+                    payloads = []
+                except Exception:
+                    logger.exception("Failed to send %d invalidation messages", len(payloads))
+                    if not stopping:
+                        # kept and sent again with the next ones
+                        self.stopped.wait(RETRY_SECONDS)
+                        continue
+            if stopping:
+                return
+
+    def listen(self) -> None:
+        connected_before = False
+        while not self.stopped.is_set():
+            try:
+                connection = self.engine.raw_connection()
+            except Exception:
+                logger.exception("Failed to connect to listen for invalidation messages")
+                self.stopped.wait(RETRY_SECONDS)
+                continue
+            # the connection stays open as long as the process runs, it is kept out of the pool
+            listener = connection.driver_connection
+            connection.detach()
+            try:
+                listener.autocommit = True
+                with listener.cursor() as cursor:
+                    cursor.execute(f"listen {CHANNEL}")
+                if connected_before:
+                    self.apply({"kind": "reset"})
+                connected_before = True
+                while not self.stopped.is_set():
+                    readable, _, _ = select.select([listener, self.wakeup[0]], [], [], POLL_SECONDS)
+                    if self.stopped.is_set():
+                        break
+                    if not readable:
+                        # a connection that died without closing never becomes readable, a query finds out
+                        with listener.cursor() as cursor:
+                            cursor.execute("select 1")
+                    else:
+                        listener.poll()
+                    while listener.notifies:
+                        message = orjson.loads(listener.notifies.pop(0).payload)
+                        if message.get("origin") != self.origin:
+                            self.apply(message)
+            except Exception:
+                logger.exception("Lost the connection listening for invalidation messages")
+                self.stopped.wait(RETRY_SECONDS)
+            finally:
+                listener.close()
+
+    def apply(self, message: dict) -> None:
+        try:
+            self.handler(message)
+        except Exception:
+            logger.exception("Failed to apply the invalidation message %s", message)
@@ -8,6 +8,9 @@ import traceback
 from time import sleep
 
 sleep_time = 2  # seconds
+page_size = 50  # books shown per page
+books_cache = {}  # cursor -> (ETag, page) for the pages of books already fetched
+books_since = None  # since of the cached pages, for fetching the changes made to them
 
 
 # functions
@@ -27,6 +30,7 @@ def print_menu() -> None:
     print("6. Exit")
     if not "token" in globals():
         print("7. Sign Up")
+    print("8. View All Books")
 
 
 def hello_world():
@@ -134,28 +138,164 @@ def signup() -> None:
         return
 
 
-def print_books() -> None:
-    """Fetches and prints the list of books from the server."""
-    clear_screen()
-    response = requests.get("https://lms.murtsa.dev/books")
-    # response = requests.get("http://127.0.0.1:8000/books")
+def print_book(book: dict) -> None:
+    """Prints a book of the catalog with how many of its copies are available."""
+    copies = ""
+    if "available_copies" in book:
+        copies = f", Available: {book['available_copies']}/{book['total_copies']}"
+    print(
+        f"\nTitle: {book['title']}, Author: {book['author']}, ISBN: {book['isbn']}, ID: {book['id']}{copies}"
+    )
+
 
+def get_book_changes(since: str | None) -> tuple[list, list, str] | None:
+    """Fetches the books changed and the ids of the books deleted since an earlier call,
+    with the since to pass next time. Without since, only the since is fetched.
+    Returns None if the changes couldn't be fetched."""
+    changed, deleted = [], []
+    while True:
+        params = {"since": since} if since else {}
+        response = requests.get("https://lms.murtsa.dev/books/changes", params=params)
+        # response = requests.get("http://127.0.0.1:8000/books/changes", params=params)
+        try:
+            data = response.json()
+        except json.JSONDecodeError:
+            return None
+        if "error" in data or "since" not in data:
+            return None
+        if since:
+            changed.extend(data["data"])
+            deleted.extend(data["deleted"])
+        since = data["since"]
+        if not data["has_more"]:
+            return changed, deleted, since
+
+
+def sync_books_cache() -> bool:
+    """Applies the changes made to the catalog since the cached pages were fetched to them.
+    Returns whether the cached pages are up to date, if not they are revalidated with their ETags."""
+    global books_since
+    if books_since is None:
+        # the since is taken before fetching pages, so no change is missed in between
+        changes = get_book_changes(None)
+        if changes is None:
+            return False
+        books_cache.clear()
+        books_since = changes[2]
+        return True
+
+    changes = get_book_changes(books_since)
+    if changes is None:
+        # the since may be too old or invalid, start over
+        books_since = None
+        return False
+    changed, deleted, books_since = changes
+    changed = {book["id"]: book for book in changed}
+    deleted = set(deleted)
+    placed = set()
+    for _, page in books_cache.values():
+        rows = []
+        for book in page["data"]:
+            if book["id"] in deleted:
+                continue
+            update = changed.get(book["id"])
+            if update is not None and update["title"] == book["title"]:
+                # still in the same place, only its details or copies changed
+                book = update
+                placed.add(book["id"])
+            rows.append(book)
+        page["data"] = rows
+    if placed != changed.keys():
+        # a new or renamed book, or one of a page that isn't cached, can belong on any page in
+        # the server's sort order, so the pages are fetched again
+        books_cache.clear()
+    return True
+
+
+def fetch_books_page(cursor: str | None) -> dict | None:
+    """Fetches the page of books after cursor, from the cache if it hasn't changed.
+    Prints the error and returns None if it couldn't be fetched."""
+    params = {"limit": page_size}
+    if cursor:
+        params["cursor"] = cursor
+    # send the ETag of the cached page so the server can answer 304 if nothing changed
+    headers = {}
+    if cursor in books_cache:
+        headers["If-None-Match"] = books_cache[cursor][0]
+    response = requests.get("https://lms.murtsa.dev/books", params=params, headers=headers)
+    # response = requests.get("http://127.0.0.1:8000/books", params=params, headers=headers)
+
+    if response.status_code == 304:
+        return books_cache[cursor][1]
     try:
         data = response.json()
     except json.JSONDecodeError:
         print("Failed to decode JSON response.\n")
-        sleep(sleep_time)
-        return []
+        return None
     if "error" in data:
         print(f"Error fetching books: {data['error']['message']}\n")
+        return None
+    etag = response.headers.get("ETag")
+    if etag:
+        books_cache[cursor] = (etag, data)
+    return data
+
+
+def print_books(stream: bool = False) -> None:
+    """Fetches and prints the list of books from the server one page at a time.
+    With stream=True every book is printed as it arrives instead."""
+    clear_screen()
+    if stream:
+        print_book_stream()
+        return
+    synced = sync_books_cache()
+    cursor = None
+    first_page = True
+    while True:
+        if synced and cursor in books_cache:
+            # kept up to date with the changes, no need to ask the server
+            data = books_cache[cursor][1]
+        else:
+            data = fetch_books_page(cursor)
+            if data is None:
+                sleep(sleep_time)
+                return []
+        books = data["data"]
+        if first_page:
+            print(f"\n{'-'*20} Books {'-'*20}\n")
+            first_page = False
+        for book in books:
+            print_book(book)
+        cursor = data.get("next_cursor")
+        if not cursor:
+            break
+        if input("\nPress Enter for more books or q to stop: ").lower() == "q":
+            return
+    input("\nPress Enter to continue...")
+
+
+def print_book_stream() -> None:
+    """Prints every book as the server streams it, one JSON object per line."""
+    response = requests.get(
+        "https://lms.murtsa.dev/books",
+        headers={"Accept": "application/x-ndjson"},
+        stream=True,
+    )
+    # response = requests.get("http://127.0.0.1:8000/books", headers={"Accept": "application/x-ndjson"}, stream=True)
+    if response.status_code != 200:
+        print(f"Error fetching books: {response.status_code} {response.text}\n")
         sleep(sleep_time)
-        return []
-    books = data["data"]
+        return
     print(f"\n{'-'*20} Books {'-'*20}\n")
-    for book in books:
-        print(
-            f"\nTitle: {book['title']}, Author: {book['author']}, ISBN: {book['isbn']}, ID: {book['id']}"
-        )
+    for line in response.iter_lines():
+        if not line:
+            continue
+        try:
+            book = json.loads(line)
+        except json.JSONDecodeError:
+            print("Failed to decode JSON response.\n")
+            break
+        print_book(book)
     input("\nPress Enter to continue...")
 
 
@@ -192,6 +332,8 @@ def print_my_books() -> None:
             print(
                 f"\nTitle: {book['title']}, Author: {book['author']}, ISBN: {book['isbn']}, ID: {book['id']}"
             )
+            overdue = " (Overdue)" if book.get("is_overdue") else ""
+            print(f"Due: {book['due_date']}{overdue}")
     else:
         print(
             f"There was an error, code: {response.status_code} {response.text}",
@@ -257,7 +399,17 @@ def return_book() -> None:
     print_my_books()
     headers = {"Authorization": token, "Content-Type": "application/json"}
 
-    book_id = input("Enter the ID of the book you want to return: ")
+    book_ids = [
+        book_id.strip()
+        for book_id in input(
+            "Enter the ID of the book you want to return (separate IDs with commas to return several): "
+        ).split(",")
+        if book_id.strip()
+    ]
+    if len(book_ids) > 1:
+        return_books(book_ids, headers)
+        return
+    book_id = book_ids[0] if book_ids else ""
     user_id = requests.get("https://lms.murtsa.dev/user", headers=headers)
     # user_id = requests.get('http://127.0.0.1:8000/user', headers=headers)
     if user_id.status_code != 200:
@@ -280,6 +432,26 @@ def return_book() -> None:
     return
 
 
+def return_books(book_ids: list, headers: dict) -> None:
+    """Returns several books for the logged-in user in one request."""
+    response = requests.put(
+        "https://lms.murtsa.dev/return/batch",
+        headers=headers,
+        json={"book_ids": book_ids},
+    )
+    # response = requests.put('http://127.0.0.1:8000/return/batch', headers=headers, json={"book_ids": book_ids})
+    if response.status_code == 200:
+        for result in response.json()["results"]:
+            print(f"\nID {result['book_id']}: {result['message']}")
+        sleep(sleep_time)
+    else:
+        print(
+            f"\nFailed to return books. Status code: {response.status_code}, Response: {response.text}\n"
+        )
+        sleep(sleep_time)
+    return
+
+
 def clear_screen() -> None:
     """Clears the terminal screen."""
     if os.name == "nt":
@@ -343,6 +515,8 @@ def main():
                     break
                 case "7":
                     signup()
+                case "8":
+                    print_books(stream=True)
                 case _:
                     print("Invalid choice. Please try again.")
                     sleep(sleep_time)
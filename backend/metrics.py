@@ -0,0 +1,229 @@
+'''In-process metrics for the server, exposed in the Prometheus text format by GET /metrics
+
+Counters, gauges and histograms are kept in memory per worker process, so nothing has to be
+running next to the server to collect them; a Prometheus server (or curl) can scrape /metrics.'''
+
+import functools
+import re
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry = []  # every metric, in the order they are rendered
+
+
+def escape(value) -> str:
+    """Escapes a label value for the text format"""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    """Formats label names and values as {name="value",...}"""
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """A metric with a value per combination of label values"""
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}  # label values -> value
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in sorted(values):
+            lines.extend(self.samples(key, value))
+        return lines
+
+    def samples(self, key: tuple, value) -> list:
+        return [f"{self.name}{label_text(self.labels, key)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def add(self, amount: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, seconds: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket, then the sum and the total count
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+            counts[-2] += seconds
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the body of a with statement takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self, key: tuple, value) -> list:
+        lines = []
+        for bound, count in zip(self.buckets, value):
+            bucket = label_text(self.labels, key, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{bucket} {count}")
+        bucket = label_text(self.labels, key, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{bucket} {value[-1]}")
+        lines.append(f"{self.name}_sum{label_text(self.labels, key)} {value[-2]}")
+        lines.append(f"{self.name}_count{label_text(self.labels, key)} {value[-1]}")
+        return lines
+
+
+def render() -> str:
+    """Returns every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+requests_total = Counter("lms_http_requests_total", "HTTP requests handled", ("method", "route", "status"))
+request_seconds = Histogram("lms_http_request_duration_seconds", "Time to handle an HTTP request", ("method", "route"))
+requests_in_flight = Gauge("lms_http_requests_in_flight", "HTTP requests being handled")
+pool_wait_seconds = Histogram("lms_db_pool_checkout_wait_seconds", "Time spent waiting for a database connection from the pool")
+statement_seconds = Histogram("lms_db_statement_duration_seconds", "Time to execute a SQL statement", ("statement",))
+supabase_seconds = Histogram("lms_supabase_call_duration_seconds", "Time taken by a call to supabase", ("call",))
+event_subscribers = Gauge("lms_event_subscribers", "Clients subscribed to /events")
+
+
+class MetricsMiddleware:
+    """Counts and times every HTTP request by its route template, like /books/{id}, rather
+    than its path, so the number of label values stays bounded"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        requests_in_flight.add(1)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            # the route is set on the scope by the router once a route matched
+            route = getattr(scope.get("route"), "path", "unmatched")
+            request_seconds.observe(time.perf_counter() - start, method=scope["method"], route=route)
+            requests_total.inc(method=scope["method"], route=route, status=status)
+            requests_in_flight.add(-1)
+
+
+# seconds the checkout running on this thread spent opening new connections
+opening = threading.local()
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long each checkout waited for a connection
+
+    Pool.connect is timed, less the time spent opening new connections, which the do_connect
+    and connect events of instrument_engine measure. What is left is the time spent queued for
+    a connection that another request holds, and the pre-ping of a pooled connection. Only
+    public API is used (Pool.connect and the events), which SQLAlchemy 1.4 and 2.0 both have."""
+
+    def connect(self):
+        opening.seconds = 0.0
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            pool_wait_seconds.observe(max(0.0, time.perf_counter() - start - opening.seconds))
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_name(statement: str) -> str:
+    """Labels a statement by the start of its SQL and a checksum of the rest, so statements that
+    start alike (like the first and next page of /books) get different labels. The server's
+    statements are fixed texts with bound parameters, so there are only a few labels."""
+    statement = re.sub(r"\s+", " ", statement).strip()
+    if len(statement) <= 60:
+        return statement
+    return f"{statement[:60]}... [{zlib.crc32(statement.encode()):08x}]"
+
+
+def instrument_engine(engine) -> None:
+    """Times every statement executed through the engine, and the connections it opens"""
+
+    @event.listens_for(engine, "do_connect")
+    def do_connect(dialect, connection_record, cargs, cparams):
+        connection_record.info["connect_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        start = connection_record.info.pop("connect_start", None)
+        if start is not None:
+            opening.seconds = getattr(opening, "seconds", 0.0) + time.perf_counter() - start
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["statement_start"].pop()
+        statement_seconds.observe(time.perf_counter() - start, statement=statement_name(statement))
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # a failed statement never reaches after_cursor_execute
+        starts = context.connection.info.get("statement_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
@@ -0,0 +1,29 @@
+"""books title id index
+
+Revision ID: 46e5d8ee5ffe
+Revises: de6f1d131835
+Create Date: 2026-10-18 09:12:41.220417
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '46e5d8ee5ffe'
+down_revision: Union[str, Sequence[str], None] = 'de6f1d131835'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # /books pages through the catalog with a keyset on (title, id)
+    op.create_index('ix_books_title_id', 'books', ['title', 'id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_books_title_id', table_name='books')
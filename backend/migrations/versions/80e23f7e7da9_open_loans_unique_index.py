@@ -0,0 +1,33 @@
+"""open loans unique index
+
+Revision ID: 80e23f7e7da9
+Revises: b8ef78e1f467
+Create Date: 2026-10-18 11:26:05.731194
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '80e23f7e7da9'
+down_revision: Union[str, Sequence[str], None] = 'b8ef78e1f467'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # books.due_date is used by /checkout and /my-books but was never part of a migration
+    op.execute('ALTER TABLE books ADD COLUMN IF NOT EXISTS due_date date')
+    # a book can only have one open loan, so concurrent checkouts of the same book can't both succeed
+    op.create_index('ux_checkout_logs_open_book', 'checkout_logs', ['book_id'], unique=True,
+                    postgresql_where=sa.text('checkin_date IS NULL'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # books.due_date is left in place, it may have existed before this revision
+    op.drop_index('ux_checkout_logs_open_book', table_name='checkout_logs')
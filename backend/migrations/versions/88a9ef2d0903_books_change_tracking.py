@@ -0,0 +1,81 @@
+"""books change tracking
+
+Revision ID: 88a9ef2d0903
+Revises: b53194b5de1d
+Create Date: 2026-10-18 16:20:45.118302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '88a9ef2d0903'
+down_revision: Union[str, Sequence[str], None] = 'b53194b5de1d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # updated_at is set on every insert and every update that changes the row, whichever
+    # statement makes it, so /books/changes can find what changed since a time.
+    # clock_timestamp() rather than now(), which is the time the transaction started.
+    op.execute("""
+        CREATE FUNCTION books_set_updated_at() RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND NEW IS NOT DISTINCT FROM OLD THEN
+                RETURN NEW;
+            END IF;
+            NEW.updated_at = clock_timestamp();
+            RETURN NEW;
+        END
+        $$
+    """)
+    op.execute("""
+        CREATE TRIGGER books_updated_at BEFORE INSERT OR UPDATE ON books
+        FOR EACH ROW EXECUTE FUNCTION books_set_updated_at()
+    """)
+
+    # a row for every deleted book, so clients syncing changes can drop it too
+    op.create_table(
+        'book_tombstones',
+        sa.Column('book_id', sa.UUID, primary_key=True),
+        sa.Column('deleted_at', sa.DateTime, nullable=False)
+    )
+    op.create_index('ix_book_tombstones_deleted_at_id', 'book_tombstones', ['deleted_at', 'book_id'])
+    op.execute("""
+        CREATE FUNCTION books_record_deletion() RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            INSERT INTO book_tombstones (book_id, deleted_at) VALUES (OLD.id, clock_timestamp())
+            ON CONFLICT (book_id) DO UPDATE SET deleted_at = excluded.deleted_at;
+            RETURN OLD;
+        END
+        $$
+    """)
+    op.execute("""
+        CREATE TRIGGER books_deleted AFTER DELETE ON books
+        FOR EACH ROW EXECUTE FUNCTION books_record_deletion()
+    """)
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, and doesn't lock out writes
+    with op.get_context().autocommit_block():
+        # books by when they changed, for the pages of /books/changes
+        op.create_index('ix_books_updated_at_id', 'books', ['updated_at', 'id'], postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_books_updated_at_id', table_name='books', postgresql_concurrently=True)
+    op.execute('DROP TRIGGER books_deleted ON books')
+    op.execute('DROP FUNCTION books_record_deletion()')
+    op.drop_table('book_tombstones')
+    op.execute('DROP TRIGGER books_updated_at ON books')
+    op.execute('DROP FUNCTION books_set_updated_at()')
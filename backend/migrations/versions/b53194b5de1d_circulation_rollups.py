@@ -0,0 +1,46 @@
+"""circulation rollups
+
+Revision ID: b53194b5de1d
+Revises: d3166d5597bd
+Create Date: 2026-10-18 15:42:09.652170
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b53194b5de1d'
+down_revision: Union[str, Sequence[str], None] = 'd3166d5597bd'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Checkouts and returns counted per day, and per book per day, by checkout and return as they
+    # happen, so /stats never reads checkout_logs. loan_seconds is the total length of the loans
+    # returned that day, for the average loan length. backfill_stats.py rebuilds them from checkout_logs.
+    op.create_table(
+        'daily_stats',
+        sa.Column('day', sa.Date, primary_key=True),
+        sa.Column('checkouts', sa.Integer, server_default=sa.text("0"), nullable=False),
+        sa.Column('returns', sa.Integer, server_default=sa.text("0"), nullable=False),
+        sa.Column('loan_seconds', sa.Float, server_default=sa.text("0"), nullable=False)
+    )
+    op.create_table(
+        'book_daily_stats',
+        sa.Column('day', sa.Date, primary_key=True),
+        sa.Column('book_id', sa.UUID, sa.ForeignKey('books.id'), primary_key=True),
+        sa.Column('checkouts', sa.Integer, server_default=sa.text("0"), nullable=False),
+        sa.Column('returns', sa.Integer, server_default=sa.text("0"), nullable=False),
+        sa.Column('loan_seconds', sa.Float, server_default=sa.text("0"), nullable=False)
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('book_daily_stats')
+    op.drop_table('daily_stats')
@@ -0,0 +1,94 @@
+"""book copies
+
+Revision ID: b75f4996188a
+Revises: cd3e4dcd2074
+Create Date: 2026-10-18 14:02:37.518204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b75f4996188a'
+down_revision: Union[str, Sequence[str], None] = 'cd3e4dcd2074'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# must match the expression of ux_books_isbn_normalized
+NORMALIZED_ISBN = "upper(regexp_replace(isbn, '[^0-9Xx]', '', 'g'))"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # a books row is a title, each physical copy of it is a book_copies row
+    op.create_table(
+        'book_copies',
+        sa.Column('id', sa.UUID, server_default=sa.text("uuid_generate_v4()"), primary_key=True),
+        sa.Column('created_at', sa.DateTime, server_default=sa.text("now()"), nullable=False),
+        sa.Column('book_id', sa.UUID, sa.ForeignKey('books.id'), nullable=False),
+        sa.Column('is_checked_out', sa.Boolean, server_default=sa.text("false"), nullable=False),
+        sa.Column('due_date', sa.Date, nullable=True)
+    )
+    op.create_index('ix_book_copies_book', 'book_copies', ['book_id'])
+    # the available copies of a title, for picking a copy at checkout
+    op.create_index('ix_book_copies_available', 'book_copies', ['book_id'],
+                    postgresql_where=sa.text('NOT is_checked_out'))
+
+    # counters kept up to date by checkout and return, so listing a title doesn't count its copies
+    op.add_column('books', sa.Column('total_copies', sa.Integer, server_default=sa.text("1"), nullable=False))
+    op.add_column('books', sa.Column('available_copies', sa.Integer, server_default=sa.text("1"), nullable=False))
+    op.execute('UPDATE books SET available_copies = 0 WHERE is_checked_out')
+    op.create_check_constraint('ck_books_available_copies', 'books',
+                               'available_copies >= 0 AND available_copies <= total_copies')
+
+    # every existing book becomes a title with one copy, and its loans are loans of that copy
+    op.execute('INSERT INTO book_copies (book_id, is_checked_out, due_date) SELECT id, is_checked_out, due_date FROM books')
+    op.add_column('checkout_logs', sa.Column('copy_id', sa.UUID, sa.ForeignKey('book_copies.id'), nullable=True))
+    op.execute('UPDATE checkout_logs SET copy_id = book_copies.id FROM book_copies WHERE book_copies.book_id = checkout_logs.book_id')
+    op.alter_column('checkout_logs', 'copy_id', nullable=False)
+
+    # a copy can only have one open loan, and a user can only borrow one copy of a title at a time
+    op.drop_index('ux_checkout_logs_open_book', table_name='checkout_logs')
+    op.create_index('ux_checkout_logs_open_copy', 'checkout_logs', ['copy_id'], unique=True,
+                    postgresql_where=sa.text('checkin_date IS NULL'))
+    op.create_index('ux_checkout_logs_open_book_user', 'checkout_logs', ['user_id', 'book_id'], unique=True,
+                    postgresql_where=sa.text('checkin_date IS NULL'))
+
+    # adds copies of a title, creating the title if its ISBN isn't in the catalog yet
+    # called through postgrest by PUT /book
+    op.execute(f"""
+        CREATE FUNCTION add_book_copies(new_title text, new_author text, new_isbn text, copies integer DEFAULT 1)
+        RETURNS SETOF books
+        LANGUAGE sql
+        AS $$
+            WITH book AS (
+                INSERT INTO books (title, author, isbn, total_copies, available_copies)
+                VALUES (new_title, new_author, new_isbn, copies, copies)
+                ON CONFLICT (({NORMALIZED_ISBN})) DO UPDATE
+                SET total_copies = books.total_copies + excluded.total_copies,
+                    available_copies = books.available_copies + excluded.available_copies,
+                    is_checked_out = false, due_date = null, updated_at = now()
+                RETURNING *
+            ), added AS (
+                INSERT INTO book_copies (book_id) SELECT id FROM book, generate_series(1, copies)
+            )
+            SELECT * FROM book
+        $$
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('DROP FUNCTION add_book_copies(text, text, text, integer)')
+    op.drop_index('ux_checkout_logs_open_book_user', table_name='checkout_logs')
+    op.drop_index('ux_checkout_logs_open_copy', table_name='checkout_logs')
+    op.create_index('ux_checkout_logs_open_book', 'checkout_logs', ['book_id'], unique=True,
+                    postgresql_where=sa.text('checkin_date IS NULL'))
+    op.drop_column('checkout_logs', 'copy_id')
+    op.drop_constraint('ck_books_available_copies', 'books', type_='check')
+    op.drop_column('books', 'available_copies')
+    op.drop_column('books', 'total_copies')
+    op.drop_table('book_copies')
@@ -0,0 +1,37 @@
+"""books search indexes
+
+Revision ID: b8ef78e1f467
+Revises: 46e5d8ee5ffe
+Create Date: 2026-10-18 10:03:17.584902
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8ef78e1f467'
+down_revision: Union[str, Sequence[str], None] = '46e5d8ee5ffe'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # trigram indexes used by /books/search for word similarity and ISBN prefix matches
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_books_title_trgm', 'books', ['title'],
+                    postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+    op.create_index('ix_books_author_trgm', 'books', ['author'],
+                    postgresql_using='gin', postgresql_ops={'author': 'gin_trgm_ops'})
+    op.create_index('ix_books_isbn_trgm', 'books', ['isbn'],
+                    postgresql_using='gin', postgresql_ops={'isbn': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_books_isbn_trgm', table_name='books')
+    op.drop_index('ix_books_author_trgm', table_name='books')
+    op.drop_index('ix_books_title_trgm', table_name='books')
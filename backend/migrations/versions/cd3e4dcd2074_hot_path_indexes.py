@@ -0,0 +1,69 @@
+"""hot path indexes
+
+Revision ID: cd3e4dcd2074
+Revises: 80e23f7e7da9
+Create Date: 2026-10-18 13:40:52.119863
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'cd3e4dcd2074'
+down_revision: Union[str, Sequence[str], None] = '80e23f7e7da9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# must match normalize_isbn in storage.py and the ISBN lookups that use this index
+NORMALIZED_ISBN = "upper(regexp_replace(isbn, '[^0-9Xx]', '', 'g'))"
+
+INDEXES = ['ix_checkout_logs_open_user', 'ix_checkout_logs_book_user', 'ux_books_isbn_normalized', 'ux_users_supabase_id']
+
+
+def check_unique(table: str, column: str, name: str) -> None:
+    """Fails with the duplicated values if a unique index can't be built on column"""
+    duplicates = op.get_bind().execute(sa.text(
+        f"select {column} as value, count(*) as rows from {table} group by 1 having count(*) > 1 order by 2 desc limit 10"
+    )).all()
+    if duplicates:
+        listed = ", ".join(f"{row.value!r} ({row.rows} rows)" for row in duplicates)
+        raise RuntimeError(f"{table} has rows with the same {name}, merge them before upgrading: {listed}")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    check_unique('books', NORMALIZED_ISBN, 'normalized ISBN')
+    check_unique('users', 'supabase_id', 'supabase_id')
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, and doesn't lock out writes
+    with op.get_context().autocommit_block():
+        # a concurrent build that failed, or a run that was interrupted, leaves an INVALID index
+        # behind, which is dropped so that this can be run again
+        invalid = op.get_bind().execute(sa.text(
+            "select indexrelid::regclass::text from pg_index "
+            "where not indisvalid and indexrelid::regclass::text = any(:names)"
+        ), {"names": INDEXES}).scalars().all()
+        for name in invalid:
+            op.execute(f"DROP INDEX CONCURRENTLY {name}")
+        # open loans of a user, for /my-books
+        op.create_index('ix_checkout_logs_open_user', 'checkout_logs', ['user_id'], if_not_exists=True,
+                        postgresql_where=sa.text('checkin_date IS NULL'), postgresql_concurrently=True)
+        # a user's loans of a book, for /return
+        op.create_index('ix_checkout_logs_book_user', 'checkout_logs', ['book_id', 'user_id'], if_not_exists=True,
+                        postgresql_concurrently=True)
+        # one book per ISBN, however it is written, for the ISBN lookups of /book and /books/import
+        op.create_index('ux_books_isbn_normalized', 'books', [sa.text(NORMALIZED_ISBN)], unique=True,
+                        if_not_exists=True, postgresql_concurrently=True)
+        op.create_index('ux_users_supabase_id', 'users', ['supabase_id'], unique=True, if_not_exists=True,
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ux_users_supabase_id', table_name='users', postgresql_concurrently=True)
+        op.drop_index('ux_books_isbn_normalized', table_name='books', postgresql_concurrently=True)
+        op.drop_index('ix_checkout_logs_book_user', table_name='checkout_logs', postgresql_concurrently=True)
+        op.drop_index('ix_checkout_logs_open_user', table_name='checkout_logs', postgresql_concurrently=True)
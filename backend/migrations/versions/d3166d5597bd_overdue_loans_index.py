@@ -0,0 +1,34 @@
+"""overdue loans index
+
+Revision ID: d3166d5597bd
+Revises: b75f4996188a
+Create Date: 2026-10-18 15:10:24.381907
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3166d5597bd'
+down_revision: Union[str, Sequence[str], None] = 'b75f4996188a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, and doesn't lock out writes
+    with op.get_context().autocommit_block():
+        # the loaned copies by due date, for /overdue, which reads the ones due before today
+        # in (due_date, id) order and pages through them by that key
+        op.create_index('ix_book_copies_due_date', 'book_copies', ['due_date', 'id'],
+                        postgresql_where=sa.text('is_checked_out'), postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_book_copies_due_date', table_name='book_copies', postgresql_concurrently=True)
@@ -0,0 +1,209 @@
+'''Opt-in profiling of single requests
+
+A request is profiled when an admin sends it with an X-Profile header, or when it is picked by
+PROFILE_SAMPLE_RATE (a fraction of requests, 0 by default). A sampling profiler records the stacks
+of the threads working on the request every PROFILE_INTERVAL seconds: the event loop thread while
+the request's task is running on it, and the threadpool threads running its blocking calls through
+run_blocking. Other requests handled at the same time are not recorded.
+
+Profiles are saved in the speedscope format (https://www.speedscope.app) to PROFILE_DIR, which
+keeps the newest PROFILE_KEEP of them, and can be listed and downloaded from /admin/profiles.'''
+
+import asyncio
+import contextvars
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+import anyio
+from starlette.requests import Request
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "lms-profiles"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.002"))
+# at most this many requests are profiled at the same time, others run unprofiled
+PROFILE_CONCURRENCY = int(os.getenv("PROFILE_CONCURRENCY", "2"))
+
+PROFILE_SUFFIX = ".speedscope.json"
+profile_slots = threading.BoundedSemaphore(PROFILE_CONCURRENCY)
+file_lock = threading.Lock()
+
+# the sampler of the request being handled, if it is profiled
+current_sampler = contextvars.ContextVar("current_sampler", default=None)
+
+
+class Sampler(threading.Thread):
+    """Samples the stacks of a request's threads until it is stopped"""
+
+    def __init__(self, name: str, interval: float = PROFILE_INTERVAL):
+        super().__init__(name="profiler", daemon=True)
+        self.request_name = name
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.task = asyncio.current_task()
+        self.threads = Counter()  # ident -> calls of the request running on that thread
+        self.threads_lock = threading.Lock()
+        self.stacks = {}  # thread label -> Counter of stacks
+        self.stopped = threading.Event()
+        self.started_at = self.stopped_at = time.perf_counter()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            if asyncio.current_task(self.loop) is self.task:
+                self.record("event loop", frames.get(self.loop_thread))
+            with self.threads_lock:
+                threads = list(self.threads)
+            for ident in threads:
+                self.record(f"thread {ident}", frames.get(ident))
+
+    def record(self, label: str, frame) -> None:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        if stack:
+            self.stacks.setdefault(label, Counter())[tuple(reversed(stack))] += 1
+
+    def wrap(self, function):
+        """Returns function with the thread it runs on included in the profile while it runs"""
+        def sampled():
+            ident = threading.get_ident()
+            with self.threads_lock:
+                self.threads[ident] += 1
+            try:
+                return function()
+            finally:
+                with self.threads_lock:
+                    self.threads[ident] -= 1
+                    if not self.threads[ident]:
+                        del self.threads[ident]
+        return sampled
+
+    def stop(self) -> None:
+        self.stopped_at = time.perf_counter()
+        self.stopped.set()
+        self.join()
+
+    def speedscope(self) -> dict:
+        """Returns the samples as a speedscope file, with a profile per thread"""
+        frames, frame_index, profiles = [], {}, []
+        for label, stacks in self.stacks.items():
+            samples, weights = [], []
+            for stack, count in stacks.items():
+                for frame in stack:
+                    if frame not in frame_index:
+                        frame_index[frame] = len(frames)
+                        frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                samples.append([frame_index[frame] for frame in stack])
+                weights.append(count * self.interval)
+            profiles.append({"type": "sampled", "name": label, "unit": "seconds", "startValue": 0,
+                             "endValue": sum(weights), "samples": samples, "weights": weights})
+        return {"$schema": "https://www.speedscope.app/file-format-schema.json", "name": self.request_name,
+                "exporter": "lms-server", "shared": {"frames": frames}, "profiles": profiles,
+                "duration": self.stopped_at - self.started_at}
+
+
+def run_sampled(function):
+    """Returns function wrapped so that its thread is sampled if the current request is being profiled"""
+    sampler = current_sampler.get()
+    return function if sampler is None else sampler.wrap(function)
+
+
+def save_profile(profile_id: str, profile: dict) -> None:
+    """Writes a profile to PROFILE_DIR and deletes the oldest profiles past PROFILE_KEEP"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, profile_id + PROFILE_SUFFIX)
+    with open(path + ".tmp", "w") as f:
+        json.dump(profile, f)
+    os.replace(path + ".tmp", path)
+    with file_lock:
+        for old_id in list_profile_ids()[PROFILE_KEEP:]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old_id + PROFILE_SUFFIX))
+            except FileNotFoundError:
+                pass
+
+
+def list_profile_ids() -> list:
+    """Returns the ids of the saved profiles, newest first"""
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted((name.removesuffix(PROFILE_SUFFIX) for name in names if name.endswith(PROFILE_SUFFIX)), reverse=True)
+
+
+def list_profiles() -> list:
+    """Returns the name and duration of the saved profiles, newest first"""
+    profiles = []
+    for profile_id in list_profile_ids():
+        try:
+            with open(os.path.join(PROFILE_DIR, profile_id + PROFILE_SUFFIX), "r") as f:
+                profile = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue  # deleted since it was listed
+        profiles.append({"id": profile_id, "name": profile["name"], "duration": profile["duration"]})
+    return profiles
+
+
+def profile_path(profile_id: str) -> str | None:
+    """Returns the file of a saved profile, or None if the id isn't one of a saved profile"""
+    if not re.fullmatch(r"[0-9]+-[0-9a-f]+", profile_id):
+        return None
+    path = os.path.join(PROFILE_DIR, profile_id + PROFILE_SUFFIX)
+    return path if os.path.exists(path) else None
+
+
+class ProfilingMiddleware:
+    """Profiles the requests that ask for it (X-Profile from an admin) or that are sampled,
+    and returns the id of their profile in an X-Profile-Id header"""
+
+    def __init__(self, app, is_admin, exclude: tuple = ()):
+        self.app = app
+        self.is_admin = is_admin  # takes a Request, returns whether it was made by an admin
+        self.exclude = exclude  # paths never profiled, like streams that stay open
+
+    def wants_profile(self, scope) -> bool:
+        if scope["path"] in self.exclude:
+            return False
+        if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            return True
+        request = Request(scope)
+        return "x-profile" in request.headers and self.is_admin(request)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.wants_profile(scope) or not profile_slots.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        # ids sort by the time they were taken
+        profile_id = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+
+        async def send_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        try:
+            sampler = Sampler(f"{scope['method']} {scope['path']}")
+            token = current_sampler.set(sampler)
+            sampler.start()
+            try:
+                await self.app(scope, receive, send_profile_id)
+            finally:
+                current_sampler.reset(token)
+                sampler.stop()
+                await anyio.to_thread.run_sync(save_profile, profile_id, sampler.speedscope())
+        finally:
+            profile_slots.release()
@@ -0,0 +1,177 @@
+'''"Readers also borrowed" recommendations
+
+Two books are related by the number of users who borrowed both. Those counts are the
+book-by-book co-occurrence matrix C = AᵀA, where A is the users-by-books matrix with a 1 where a
+user has borrowed a book. It is built with scipy.sparse from every (user, book) pair in
+checkout_logs, and the RECOMMENDATIONS_TOP_N most related books of each book are kept in a dict,
+so answering a request is a dict lookup.
+
+Checkouts made through this server after the build are added as they happen: a user borrowing a
+book for the first time adds one to its count with every book they borrowed before, and only
+those books' top lists can change. Checkouts made through other server processes are picked up
+by the next build, every RECOMMENDATIONS_REBUILD seconds.'''
+
+import os
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+
+RECOMMENDATIONS_TOP_N = int(os.getenv("RECOMMENDATIONS_TOP_N", "20"))
+RECOMMENDATIONS_REBUILD = float(os.getenv("RECOMMENDATIONS_REBUILD", "3600"))
+# (user, book) pairs read from the storage at a time while building
+BUILD_BATCH_SIZE = 10000
+
+
+def top_counts(matrix, ids: list, top_n: int) -> dict:
+    """Returns the top_n (book id, count) of each row of a CSR co-occurrence matrix, most first"""
+    top = {}
+    for row in range(matrix.shape[0]):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        if start == end:
+            continue
+        columns, counts = matrix.indices[start:end], matrix.data[start:end]
+        if end - start > top_n:
+            keep = np.argpartition(-counts, top_n - 1)[:top_n]
+            columns, counts = columns[keep], counts[keep]
+        # most readers first, ties in id order so the lists don't change between builds
+        top[ids[row]] = sorted(((ids[column], int(count)) for column, count in zip(columns, counts)),
+                               key=lambda item: (-item[1], item[0]))
+    return top
+
+
+class Recommender:
+    """The top related books of every book, and what it takes to keep them up to date"""
+
+    def __init__(self, top_n: int = RECOMMENDATIONS_TOP_N):
+        self.top_n = top_n
+        self.lock = threading.Lock()  # guards everything below
+        self.build_lock = threading.Lock()  # held while building
+        self.built_at = None  # time.monotonic() of the last build
+        self.ids = []  # book id of each row and column of the matrix
+        self.index = {}  # book id -> row
+        self.matrix = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self.added = {}  # (book id, book id) -> count added to the matrix since the build
+        self.borrowed = {}  # user id -> ids of the books they borrowed
+        self.top = {}  # book id -> [(book id, count)], most first
+        self.books = {}  # book id -> id, title, author and isbn
+        self.pending = None  # (user id, book id) of checkouts made during a build
+
+    def build(self, pairs, books) -> None:
+        """Builds the matrix and the top lists from lists of (user id, book id) pairs and lists
+        of books, like those of Storage.loan_pairs and Storage.stream_books"""
+        with self.lock:
+            self.pending = []
+        try:
+            user_ids, book_ids = [], []
+            for batch in pairs:
+                for user_id, book_id in batch:
+                    user_ids.append(str(user_id))
+                    book_ids.append(str(book_id))
+            details = {str(book["id"]): {"id": str(book["id"]), "title": book["title"], "author": book["author"],
+                                         "isbn": book["isbn"]} for batch in books for book in batch}
+
+            users, user_rows = np.unique(np.array(user_ids, dtype=str), return_inverse=True)
+            ids, book_rows = np.unique(np.array(book_ids, dtype=str), return_inverse=True)
+            borrowed = sparse.csr_matrix((np.ones(len(user_rows), dtype=np.int32), (user_rows, book_rows)),
+                                         shape=(len(users), len(ids)))
+            borrowed.data[:] = 1  # a user borrowing a book twice is still one reader
+            matrix = (borrowed.T @ borrowed).tocsr()
+            matrix.setdiag(0)
+            matrix.eliminate_zeros()
+            matrix.sort_indices()
+            ids = ids.tolist()
+            top = top_counts(matrix, ids, self.top_n)
+
+            borrowed_by = {}
+            for user_id, book_id in zip(user_ids, book_ids):
+                borrowed_by.setdefault(user_id, set()).add(book_id)
+        except BaseException:
+            with self.lock:
+                self.pending = None
+            raise
+
+        with self.lock:
+            self.ids, self.index, self.matrix = ids, {book_id: row for row, book_id in enumerate(ids)}, matrix
+            self.added, self.borrowed, self.top, self.books = {}, borrowed_by, top, details
+            self.built_at = time.monotonic()
+            pending, self.pending = self.pending, None
+            # checkouts the pairs may have been read before; adding a pair twice changes nothing
+            for user_id, book_id in pending:
+                self.add_pair(user_id, book_id)
+
+    def refresh(self, store, wait: bool = False) -> None:
+        """Builds from a Storage, unless another thread is already building. With wait, waits
+        for that build instead of returning."""
+        if not self.build_lock.acquire(blocking=wait):
+            return
+        try:
+            if wait and self.built_at is not None:
+                return  # built while waiting
+            self.build(store.loan_pairs(BUILD_BATCH_SIZE), store.stream_books(BUILD_BATCH_SIZE))
+        finally:
+            self.build_lock.release()
+
+    def refresh_in_background(self, store) -> None:
+        """Starts building from a Storage on another thread, unless a build is running"""
+        if not self.build_lock.locked():
+            threading.Thread(target=self.refresh, args=(store,), name="recommendations", daemon=True).start()
+
+    def is_stale(self) -> bool:
+        return self.built_at is None or time.monotonic() - self.built_at > RECOMMENDATIONS_REBUILD
+
+    def count(self, book_id: str, other_id: str) -> int:
+        """Returns how many users borrowed both books"""
+        count = self.added.get((book_id, other_id), 0)
+        row, column = self.index.get(book_id), self.index.get(other_id)
+        if row is not None and column is not None:
+            start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+            position = start + np.searchsorted(self.matrix.indices[start:end], column)
+            if position < end and self.matrix.indices[position] == column:
+                count += int(self.matrix.data[position])
+        return count
+
+    def add_book(self, book: dict) -> None:
+        """Adds a book created after the build, so it can be recommended"""
+        with self.lock:
+            self.books[str(book["id"])] = {"id": str(book["id"]), "title": book["title"], "author": book["author"],
+                                           "isbn": book["isbn"]}
+
+    def add_checkout(self, user_id: str, book_id: str) -> None:
+        """Adds a checkout made after the build"""
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((str(user_id), str(book_id)))
+            if self.built_at is not None:
+                self.add_pair(str(user_id), str(book_id))
+
+    def add_pair(self, user_id: str, book_id: str) -> None:
+        borrowed = self.borrowed.setdefault(user_id, set())
+        if book_id in borrowed:
+            return
+        others = list(borrowed)
+        borrowed.add(book_id)
+        if not others:
+            return
+
+        for other_id in others:
+            self.added[book_id, other_id] = self.added.get((book_id, other_id), 0) + 1
+            self.added[other_id, book_id] = self.added.get((other_id, book_id), 0) + 1
+            # book_id's count went up in other_id's row
+            self.update_top(other_id, {book_id: self.count(other_id, book_id)})
+        # every other book's count went up in book_id's row, books outside it that weren't
+        # counted up are still behind the ones in it
+        self.update_top(book_id, {other_id: self.count(book_id, other_id) for other_id in others})
+
+    def update_top(self, book_id: str, counts: dict) -> None:
+        """Merges new counts of some books into the top list of book_id"""
+        merged = dict(self.top.get(book_id, []))
+        merged.update(counts)
+        self.top[book_id] = sorted(merged.items(), key=lambda item: (-item[1], item[0]))[:self.top_n]
+
+    def recommend(self, book_id: str, limit: int) -> list:
+        """Returns up to limit books borrowed by readers of book_id, with how many of them did"""
+        with self.lock:
+            return [{**self.books[other_id], "readers": count}
+                    for other_id, count in self.top.get(book_id, []) if other_id in self.books][:limit]
@@ -1,29 +1,278 @@
 #!/usr/bin/env python3
 
-from fastapi import FastAPI, Depends, Request
+from fastapi import FastAPI, Depends, Request, Header
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, timezone, timedelta
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 
-from supabase import create_client, Client
-
+import asyncio
+import base64
+import concurrent.futures
+import csv
+import functools
+import io
+import json
+import logging
 import os
+import tempfile
+import threading
+import time
+import uuid
+
+import anyio
+import jwt
+import orjson
+
+import events
+import invalidation
+import metrics
+import profiling
+import storage
+from storage import normalize_isbn
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 url = os.getenv("SUPABASE_DATABASE_URL")
+# optional read replica of the database, the catalog and loan listings are read from it
+replica_url = os.getenv("SUPABASE_REPLICA_URL")
+
+
+class LazyResource:
+    """A resource created by factory the first time one of its attributes is used, so importing
+    the server creates nothing. The lifespan creates them when the server starts."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.resource = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Returns the resource, creating it once even if several threads ask for it at the same time"""
+        if self.resource is None:
+            with self.lock:
+                if self.resource is None:
+                    self.resource = self.factory()
+        return self.resource
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            # looked up by introspection (copy, mock, asyncio), which shouldn't create the resource
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+def create_database_engine(database_url: str):
+    """Creates an engine whose pool records checkout waits and whose statements are timed for /metrics"""
+    engine = create_engine(database_url, pool_pre_ping=True, poolclass=metrics.TimedQueuePool)
+    metrics.instrument_engine(engine)
+    return engine
+
+
+def create_supabase():
+    # the supabase package takes a while to import, it is only imported once it is needed
+    from supabase import create_client
+    return create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_PUBLIC_KEY"))
+
 
-engine = create_engine(url, pool_pre_ping=True)
+def create_recommender():
+    # recommendations.py imports scipy and numpy, which take a while, so it is only imported once it is needed
+    import recommendations
+    return recommendations.Recommender()
+
+
+# Handlers read and write through store, see storage.py
+# With STORAGE_BACKEND=memory there is no database, and nothing is kept when the server stops
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+replica_engine = None
+if STORAGE_BACKEND == "memory":
+    engine = None
+    store = storage.MemoryStorage()
+else:
+    engine = LazyResource(functools.partial(create_database_engine, url))
+    if replica_url:
+        replica_engine = LazyResource(functools.partial(create_database_engine, replica_url))
+    store = storage.PostgresStorage(engine, replica_engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base
 
-# use subabase for almost everything. supabase_service_client is currently only for creating users
-supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_PUBLIC_KEY"))
-supabase_service_client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SECRET_KEY"))
+# supabase is only used for signing users up, in and out, those endpoints return 503 without it
+supabase = None
+if os.getenv("SUPABASE_URL") and os.getenv("SUPABASE_PUBLIC_KEY"):
+    supabase = LazyResource(create_supabase)
+
+
+# seconds between fetches of the project's JWKS, and the least time between two fetches when
+# tokens name keys that haven't been fetched
+JWKS_REFRESH = float(os.getenv("JWKS_REFRESH", "600"))
+JWKS_MIN_REFRESH = float(os.getenv("JWKS_MIN_REFRESH", "30"))
+
+
+class JwksRefresher:
+    """The project's JWKS, fetched when the server starts and then on a background thread.
+    PyJWKClient fetches with a blocking request, so tokens are only checked against the keys
+    already fetched: a token naming another key is rejected, and the keys are fetched again."""
+
+    def __init__(self, client: jwt.PyJWKClient):
+        self.client = client
+        self.keys = None  # PyJWKSet of the last fetch
+        self.wanted = threading.Event()  # set to fetch before JWKS_REFRESH is up
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def fetch(self) -> None:
+        with metrics.supabase_seconds.time(call="jwks"):
+            self.keys = self.client.get_jwk_set(refresh=True)
+
+    def key(self, kid: str | None):
+        """Returns the key with an id, raises jwt.InvalidTokenError if it wasn't fetched"""
+        keys = self.keys
+        try:
+            if keys is None:
+                raise KeyError(kid)
+            return keys[kid].key
+        except KeyError:
+            # a key added since the last fetch, or a made up one
+            self.wanted.set()
+            raise jwt.InvalidTokenError("Unknown signing key")
+
+    def run(self) -> None:
+        while True:
+            self.wanted.wait(JWKS_REFRESH)
+            if self.stopped.is_set():
+                return
+            self.wanted.clear()
+            try:
+                self.fetch()
+            except Exception:
+                logger.exception("Failed to fetch the JWKS")
+                self.wanted.set()
+            # tokens naming unknown keys can't make it fetch more often than this
+            if self.stopped.wait(JWKS_MIN_REFRESH):
+                return
+
+    def start(self) -> None:
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="jwks", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.wanted.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+# Access tokens are verified locally instead of calling supabase.auth.get_user on every request.
+# HS256 tokens are checked against the project's JWT secret. Tokens signed with an asymmetric
+# key are checked against the project's JWKS, which is fetched off the request path (see JwksRefresher).
+# SUPABASE_JWKS_FILE can point to a local JWKS to use instead, so tokens can be checked offline.
+jwt_secret = os.getenv("SUPABASE_JWT_SECRET")
+jwks = None
+if os.getenv("SUPABASE_URL"):
+    jwks = JwksRefresher(jwt.PyJWKClient(f"{os.getenv('SUPABASE_URL')}/auth/v1/.well-known/jwks.json"))
+local_jwks = None
+if os.getenv("SUPABASE_JWKS_FILE"):
+    with open(os.getenv("SUPABASE_JWKS_FILE"), "r") as f:
+        local_jwks = jwt.PyJWKSet.from_dict(json.load(f))
+
+TOKEN_ALGORITHMS = ["HS256", "RS256", "ES256"]
+TOKEN_CACHE_SIZE = 1024
+verified_tokens = OrderedDict()  # token -> claims, for tokens whose signature was already checked
+token_lock = threading.Lock()
+
+
+def signing_key(token: str):
+    """Returns the key the token has to be signed with"""
+    header = jwt.get_unverified_header(token)
+    if header.get("alg") == "HS256":
+        if not jwt_secret:
+            raise jwt.InvalidTokenError("No JWT secret is configured")
+        return jwt_secret
+    if local_jwks is not None:
+        try:
+            return local_jwks[header.get("kid")].key
+        except KeyError:
+            raise jwt.InvalidTokenError("Unknown signing key")
+    if jwks is None:
+        raise jwt.InvalidTokenError("No JWKS is configured")
+    return jwks.key(header.get("kid"))
+
+
+def verify_token(token: str) -> dict:
+    """Returns the claims of a valid access token, raises a jwt.PyJWTError if it isn't valid"""
+    token = token.removeprefix("Bearer ").strip()
+
+    with token_lock:
+        claims = verified_tokens.get(token)
+        if claims is not None:
+            verified_tokens.move_to_end(token)
+    if claims is not None:
+        if claims["exp"] > time.time():
+            return claims
+        with token_lock:
+            verified_tokens.pop(token, None)
+        raise jwt.ExpiredSignatureError("Signature has expired")
+
+    algorithm = jwt.get_unverified_header(token).get("alg")
+    if algorithm not in TOKEN_ALGORITHMS:
+        raise jwt.InvalidAlgorithmError("The specified alg value is not allowed")
+    claims = jwt.decode(token, signing_key(token), algorithms=[algorithm], audience="authenticated",
+                        options={"require": ["exp", "sub"]})
+
+    with token_lock:
+        verified_tokens[token] = claims
+        if len(verified_tokens) > TOKEN_CACHE_SIZE:
+            verified_tokens.popitem(last=False)
+    return claims
+
+
+def authenticated_user(request: Request) -> str | None:
+    """Returns the id of the user whose access token is in the request, or None if it isn't valid"""
+    try:
+        return verify_token(request.headers["Authorization"])["sub"]
+    except (KeyError, jwt.PyJWTError):
+        return None
+
+
+# supabase ids of the users allowed to use the admin endpoints, comma separated
+ADMIN_USER_IDS = {user_id.strip() for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
+
+def is_admin(request: Request) -> bool:
+    """Returns whether the request has the valid access token of an admin"""
+    return authenticated_user(request) in ADMIN_USER_IDS
+
+
+# The supabase client and SQLAlchemy engine are synchronous, so handlers run their calls on a
+# bounded pool of threads instead of on the event loop. A slow query then only holds one of
+# DB_THREADS threads rather than stalling every request on the worker.
+# Handlers declared with def (get_books, search_books) are already run on a thread by FastAPI.
+db_limiter = anyio.CapacityLimiter(int(os.getenv("DB_THREADS", "40")))
+
+
+async def run_blocking(function, *args, **kwargs):
+    """Runs a blocking call on the database threadpool and waits for it without blocking the event loop"""
+    call = profiling.run_sampled(functools.partial(function, *args, **kwargs))
+    return await anyio.to_thread.run_sync(call, limiter=db_limiter)
+
+
+async def run_supabase(call: str, function, *args, **kwargs):
+    """Runs a blocking supabase call like run_blocking, and records how long it took under the name call"""
+    def timed():
+        with metrics.supabase_seconds.time(call=call):
+            return function(*args, **kwargs)
+    return await run_blocking(timed)
 
 
 def get_db_session():
@@ -35,7 +284,258 @@ def get_db_session():
         db.close()
 
 
-app = FastAPI()
+# Response schemas
+# Lists of rows are encoded straight from the database rows with orjson (which handles UUIDs,
+# dates and datetimes natively) and returned as an ORJSONResponse, skipping FastAPI's per-row
+# validation and jsonable_encoder pass. The models below document those responses and are
+# used to validate the smaller ones.
+class Book(BaseModel):
+    id: uuid.UUID
+    created_at: datetime
+    updated_at: datetime
+    title: str
+    author: str
+    isbn: str
+    is_checked_out: bool
+    due_date: date | None = None
+    total_copies: int
+    available_copies: int
+
+
+class BookPage(BaseModel):
+    data: list[Book]
+    next_cursor: str | None = None
+
+
+class ChangedBook(Book):
+    changed_at: datetime
+
+
+class BookChanges(BaseModel):
+    data: list[ChangedBook]
+    deleted: list[uuid.UUID]
+    since: str
+    has_more: bool
+
+
+class SearchResult(Book):
+    rank: float
+
+
+class SearchPage(BaseModel):
+    data: list[SearchResult]
+    next_offset: int | None = None
+
+
+class Loan(BaseModel):
+    id: uuid.UUID
+    title: str
+    author: str
+    isbn: str
+    due_date: date | None = None
+    is_overdue: bool = False
+
+
+class LoanList(BaseModel):
+    data: list[Loan]
+
+
+class OverdueLoan(BaseModel):
+    copy_id: uuid.UUID
+    book_id: uuid.UUID
+    title: str
+    author: str
+    isbn: str
+    user_id: uuid.UUID
+    checkout_date: datetime
+    due_date: date
+    days_overdue: int
+
+
+class OverduePage(BaseModel):
+    data: list[OverdueLoan]
+    next_cursor: str | None = None
+
+
+class OverdueUser(BaseModel):
+    user_id: uuid.UUID
+    overdue_loans: int
+    oldest_due_date: date
+
+
+class OverdueUserPage(BaseModel):
+    data: list[OverdueUser]
+    next_offset: int | None = None
+
+
+class DailyStats(BaseModel):
+    day: date
+    checkouts: int
+    returns: int
+    average_loan_days: float | None = None
+
+
+class CirculationStats(BaseModel):
+    start: date
+    end: date
+    checkouts: int
+    returns: int
+    average_loan_days: float | None = None
+    data: list[DailyStats]
+
+
+class PopularBook(BaseModel):
+    id: uuid.UUID
+    title: str
+    author: str
+    isbn: str
+    checkouts: int
+
+
+class PopularBooks(BaseModel):
+    start: date
+    end: date
+    data: list[PopularBook]
+
+
+class Recommendation(BaseModel):
+    id: uuid.UUID
+    title: str
+    author: str
+    isbn: str
+    readers: int
+
+
+class RecommendationList(BaseModel):
+    data: list[Recommendation]
+
+
+class BatchResult(BaseModel):
+    book_id: str
+    status: str
+    message: str
+    due_date: str | None = None
+
+
+class BatchResults(BaseModel):
+    results: list[BatchResult]
+
+
+class ImportResult(BaseModel):
+    inserted: int
+    skipped: int
+    duplicates: int
+    existing: int
+    invalid: int
+
+
+class ErrorMessage(BaseModel):
+    message: str
+
+
+class ErrorResponse(BaseModel):
+    error: ErrorMessage
+
+
+# Keeps the caches of every server process coherent when several run on the same database,
+# see invalidation.py. Write handlers update their own process's caches and call notify_processes,
+# the bus runs while the app does, and only with the Postgres storage backend.
+bus = None
+
+
+def notify_processes(kind: str, **fields) -> None:
+    """Tells the other server processes about a change this one made"""
+    if bus is not None:
+        bus.publish(kind, **fields)
+
+
+def apply_invalidation(message: dict, loop) -> None:
+    """Makes the change another server process made to the caches of this one, runs on the bus's listener thread"""
+    # every change is to the catalog
+    invalidate_catalog()
+    store.note_write(message.get("user_id"))
+    if message["kind"] == "book" and recommender.resource is not None:
+        recommender.add_book(message["book"])
+    elif message["kind"] == "checkout" and recommender.resource is not None:
+        for book_id in message["book_ids"]:
+            recommender.add_checkout(message["user_id"], book_id)
+    if message["kind"] in ("checkout", "return"):
+        asyncio.run_coroutine_threadsafe(publish_availability(message["book_ids"]), loop)
+    elif message["kind"] == "reset":
+        # the subscribers of /events may have missed changes too
+        loop.call_soon_threadsafe(broker.publish, "reset", {})
+
+
+# number of connections each database pool opens when the server starts, so the first requests
+# don't wait for connections to be made. Up to the pool's size (5) are kept open.
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", "2"))
+
+
+def warm_pool(engine, connections: int) -> None:
+    """Opens connections of an engine's pool at the same time and returns them to the pool"""
+    with concurrent.futures.ThreadPoolExecutor(connections) as executor:
+        opening = [executor.submit(engine.connect) for _ in range(connections)]
+    # every connection is open before any is returned, so each is a new one
+    for future in opening:
+        if future.exception() is None:
+            future.result().close()
+    for future in opening:
+        future.result()
+
+
+async def start_resources() -> None:
+    """Creates the lazy resources, warms the database pools and fetches the JWKS, all at the same time"""
+    async def create(resource, warmup: int = 0):
+        try:
+            await anyio.to_thread.run_sync(resource.get)
+            if warmup:
+                await anyio.to_thread.run_sync(warm_pool, resource, warmup)
+        except Exception:
+            # handlers try again when they need it, a database that is down shouldn't stop the server
+            logger.exception("Failed to start a resource")
+
+    async def fetch_jwks():
+        try:
+            await anyio.to_thread.run_sync(jwks.fetch)
+        except Exception:
+            # the refresher tries again, until then tokens signed with those keys are rejected
+            logger.exception("Failed to fetch the JWKS")
+            jwks.wanted.set()
+
+    async with anyio.create_task_group() as group:
+        for resource, warmup in [(engine, DB_POOL_WARMUP), (replica_engine, DB_POOL_WARMUP), (supabase, 0)]:
+            if isinstance(resource, LazyResource):
+                group.start_soon(create, resource, warmup)
+        if jwks is not None and local_jwks is None:
+            group.start_soon(fetch_jwks)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global bus
+    await start_resources()
+    if jwks is not None and local_jwks is None:
+        jwks.start()
+    if engine is not None:
+        loop = asyncio.get_running_loop()
+        bus = invalidation.InvalidationBus(engine, server_instance, lambda message: apply_invalidation(message, loop))
+        bus.start()
+    try:
+        yield
+    finally:
+        if bus is not None:
+            await anyio.to_thread.run_sync(bus.stop)
+            bus = None
+        if jwks is not None and jwks.thread is not None:
+            await anyio.to_thread.run_sync(jwks.stop)
+        for resource in [engine, replica_engine]:
+            if isinstance(resource, LazyResource) and resource.resource is not None:
+                resource.dispose()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(profiling.ProfilingMiddleware, is_admin=is_admin, exclude=("/events",))
 
 
 # Used to test if the server is running
@@ -45,63 +545,340 @@ def hello_world():
     return {"message": "Hello World"}
 
 
-# Return a list of books
-@app.get("/books")
-def get_books():
-    """Return a list of books"""
-    response = (supabase.table("books").select("*").execute())
-    return response
+# Request, database and supabase timings of this worker, in the Prometheus text format
+@app.get("/metrics", response_class=Response)
+def get_metrics():
+    """Returns the server's metrics for a Prometheus scrape"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# Profiles of requests sent with an X-Profile header by an admin, or sampled by PROFILE_SAMPLE_RATE
+# Requires the auth token of an admin in the header of your request
+@app.get("/admin/profiles", responses={403: {"model": ErrorResponse}})
+async def get_profiles(request: Request):
+    """Returns the saved request profiles, newest first"""
+    if not is_admin(request):
+        return error_response("Only admins can see profiles", 403)
+    return {"data": await run_blocking(profiling.list_profiles)}
+
+
+# Downloads a profile in the speedscope format, open it at https://www.speedscope.app
+@app.get("/admin/profiles/{profile_id}", responses={403: {"model": ErrorResponse}, 404: {"model": ErrorResponse}})
+def get_profile(profile_id: str, request: Request):
+    """Returns a saved request profile"""
+    if not is_admin(request):
+        return error_response("Only admins can see profiles", 403)
+    path = profiling.profile_path(profile_id)
+    if path is None:
+        return error_response("Profile not found", 404)
+    return FileResponse(path, media_type="application/json", filename=profile_id + profiling.PROFILE_SUFFIX)
+
+
+# default and maximum number of books returned by one page of /books
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+# number of rows fetched from the server-side cursor at a time when streaming /books
+STREAM_BATCH_SIZE = 1000
+
+
+# In-process cache of rendered /books pages
+# The catalog only changes through /book, /checkout and /return, which call
+# invalidate_catalog() to bump catalog_version and drop every cached page.
+# catalog_version is also the ETag, so clients can revalidate with If-None-Match.
+CATALOG_CACHE_SIZE = 256
+catalog_cache = OrderedDict()  # (limit, cursor) -> rendered page
+catalog_version = 0
+catalog_lock = threading.Lock()
+# changes every time the server starts, so an ETag from another run never matches
+server_instance = uuid.uuid4().hex[:8]
+
+
+def invalidate_catalog() -> None:
+    """Bumps the catalog version and drops every cached page"""
+    global catalog_version
+    with catalog_lock:
+        catalog_version += 1
+        catalog_cache.clear()
+
+
+def catalog_etag(version: int) -> str:
+    """Returns the ETag of the catalog at the given version"""
+    return f'"{server_instance}-{version}"'
+
+
+def etag_matches(etag: str, if_none_match: str | None) -> bool:
+    """Checks an If-None-Match header, which can hold several ETags, against etag"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def error_response(message: str, status_code: int) -> ORJSONResponse:
+    """Builds an error in the same shape supabase uses, so the clients can show the message"""
+    return ORJSONResponse(status_code=status_code, content={"error": {"message": message}})
+
+
+def encode_cursor(values: list) -> str:
+    """Encodes the sort key of the last row of a page into an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    """Decodes a cursor made by encode_cursor, raises ValueError if it is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def stream_books():
+    """Yields every book as a line of JSON, a batch of books at a time"""
+    for books in store.stream_books(STREAM_BATCH_SIZE):
+        yield b"".join(orjson.dumps(book) + b"\n" for book in books)
+
+
+# Return a page of books
+# Books are sorted by (title, id), and a cursor holds the (title, id) of the last book of its page
+# With "Accept: application/x-ndjson" every book is streamed instead, one JSON object per line,
+# so neither the server nor the client has to hold the whole catalog in memory
+@app.get("/books", response_model=BookPage, responses={304: {"description": "Not modified"}, 400: {"model": ErrorResponse}})
+def get_books(limit: int = PAGE_SIZE, cursor: str | None = None, if_none_match: str | None = Header(None),
+              accept: str | None = Header(None)):
+    """Return a page of books, pass next_cursor back as cursor to get the next page"""
+    if accept and "application/x-ndjson" in accept:
+        return StreamingResponse(stream_books(), media_type="application/x-ndjson")
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    # the version is read before the query so a page is never cached under a newer version
+    version = catalog_version
+    # a page read from the replica right after a write may not have it yet, and isn't cached
+    settled = store.is_settled()
+    etag = catalog_etag(version)
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    key = (limit, cursor)
+    with catalog_lock:
+        body = catalog_cache.get(key)
+        if body is not None:
+            catalog_cache.move_to_end(key)
+    if body is not None:
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+    after = None
+    if cursor:
+        try:
+            title, book_id = decode_cursor(cursor)
+            if not isinstance(title, str):
+                raise ValueError("Invalid cursor")
+            after = [title, str(uuid.UUID(str(book_id)))]
+        except (TypeError, ValueError):
+            return error_response("Invalid cursor", 400)
+
+    # one extra row is fetched to know if there is another page
+    books = store.books_page(limit + 1, after)
+    next_cursor = None
+    if len(books) > limit:
+        books = books[:limit]
+        next_cursor = encode_cursor([books[-1]["title"], str(books[-1]["id"])])
+
+    body = orjson.dumps({"data": books, "next_cursor": next_cursor})
+    if not settled:
+        return Response(content=body, media_type="application/json")
+    with catalog_lock:
+        if version == catalog_version:
+            catalog_cache[key] = body
+            if len(catalog_cache) > CATALOG_CACHE_SIZE:
+                catalog_cache.popitem(last=False)
+
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+# Books changed or deleted since an earlier call, so a client can keep its copy of the catalog
+# up to date without downloading it again. Call it without since to get the since of the
+# catalog as it is now, then load the catalog with /books, and pass the since of each response
+# to the next call. Changes are sorted by (changed_at, id); while has_more is true, call again
+# right away for the rest.
+@app.get("/books/changes", response_model=BookChanges, responses={400: {"model": ErrorResponse}})
+async def get_book_changes(since: str | None = None, limit: int = MAX_PAGE_SIZE):
+    """Return the books changed and the ids of the books deleted since an earlier call"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    after = None
+    if since:
+        try:
+            changed_at, book_id = decode_cursor(since)
+            after = [datetime.fromisoformat(changed_at), None if book_id is None else str(uuid.UUID(book_id))]
+        except (TypeError, ValueError):
+            return error_response("Invalid since", 400)
+
+    # one extra change is fetched to know if there are more
+    changes, until = await run_blocking(store.book_changes, after, limit + 1)
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if has_more:
+        since = encode_cursor([changes[-1]["changed_at"].isoformat(), str(changes[-1]["id"])])
+    else:
+        # every change made before until has been returned
+        since = encode_cursor([until.isoformat(), None])
+
+    return ORJSONResponse({"data": [change for change in changes if not change.get("deleted")],
+                           "deleted": [change["id"] for change in changes if change.get("deleted")],
+                           "since": since, "has_more": has_more})
+
+
+# Search books by title, author or ISBN, best matches first
+# Title and author are matched with word similarity, so typos and partial words still match
+@app.get("/books/search", response_model=SearchPage, responses={400: {"model": ErrorResponse}})
+def search_books(q: str, limit: int = PAGE_SIZE, offset: int = 0):
+    """Return a page of books matching q, pass next_offset back as offset to get the next page"""
+    q = q.strip()
+    if not q:
+        return error_response("Search text is required", 400)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = max(0, offset)
+
+    books = store.search_books(q, limit + 1, offset)
+
+    # one extra row is fetched to know if there is another page
+    next_offset = None
+    if len(books) > limit:
+        books = books[:limit]
+        next_offset = offset + limit
+
+    return ORJSONResponse({"data": books, "next_offset": next_offset})
 
 
 # Returns a list of books checked out by the logged-in user
-@app.post("/my-books")
+@app.post("/my-books", response_model=LoanList | str)
 async def get_my_books(request: Request):
     """Returns a list of books checked out by the logged-in user"""
     data = await request.json()
-    auth_token = request.headers["Authorization"]
-    supabase.postgrest.auth(auth_token)
 
-    # queries
-    my_books = "select id, title, author, isbn, due_date from books where id in (select book_id from checkout_logs where checkin_date IS NULL AND user_id=:user_id);"
+    books = await run_blocking(store.my_books, data["user_id"], loan_date())
+    if not books:
+        return "You haven't checked out any books"
+    return ORJSONResponse({"data": books})
 
-    with engine.connect() as connection:
-        result = connection.execute(text(my_books), {"user_id": data["user_id"]})
 
-        data = {"data": []}
-        if result.rowcount == 0:
-            response = "You haven't checked out any books"
-        else:
-            for book in result:
-                data["data"].append({"id": book._data[0], "title": book._data[1], "author": book._data[2], "isbn": book._data[3], "due_date": book._data[4]})
-            response = data
-
-        '''rows = result.mappings()
-        books = []
-        for row in rows:
-            books.append({
-                "id": row["id"],
-                "title": row["title"],
-                "author": row["author"],
-                "isbn": row["isbn"],
-                "due_date": row["due_date"]
-            })
-        response = {"data": books}'''
+def loan_date() -> date:
+    """Returns today's date in the time zone due dates are set in"""
+    return datetime.now(timezone.utc).date()
+
+
+# Lists the loans due before today, the longest overdue first
+# Loans are sorted by (due_date, copy_id), and a cursor holds the (due_date, copy_id) of the last loan of its page
+# Requires the auth token of an admin in the header of your request
+@app.get("/overdue", response_model=OverduePage, responses={400: {"model": ErrorResponse}, 403: {"model": ErrorResponse}})
+async def get_overdue(request: Request, limit: int = PAGE_SIZE, cursor: str | None = None):
+    """Return a page of overdue loans, pass next_cursor back as cursor to get the next page"""
+    if not is_admin(request):
+        return error_response("Only admins can see overdue loans", 403)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    after = None
+    if cursor:
+        try:
+            due_date, copy_id = decode_cursor(cursor)
+            after = [date.fromisoformat(due_date), str(uuid.UUID(copy_id))]
+        except (TypeError, ValueError):
+            return error_response("Invalid cursor", 400)
+
+    # one extra row is fetched to know if there is another page
+    loans = await run_blocking(store.overdue_loans, loan_date(), limit + 1, after)
+    next_cursor = None
+    if len(loans) > limit:
+        loans = loans[:limit]
+        next_cursor = encode_cursor([loans[-1]["due_date"].isoformat(), str(loans[-1]["copy_id"])])
+
+    return ORJSONResponse({"data": loans, "next_cursor": next_cursor})
+
+
+# Lists the users with overdue loans, how many they have and their oldest due date
+# Requires the auth token of an admin in the header of your request
+@app.get("/overdue/users", response_model=OverdueUserPage, responses={403: {"model": ErrorResponse}})
+async def get_overdue_users(request: Request, limit: int = PAGE_SIZE, offset: int = 0):
+    """Return a page of users with overdue loans, pass next_offset back as offset to get the next page"""
+    if not is_admin(request):
+        return error_response("Only admins can see overdue loans", 403)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = max(0, offset)
+
+    # one extra row is fetched to know if there is another page
+    users = await run_blocking(store.overdue_users, loan_date(), limit + 1, offset)
+    next_offset = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_offset = offset + limit
+
+    return ORJSONResponse({"data": users, "next_offset": next_offset})
 
-    return response
+
+# number of days /stats covers when no start is given
+STATS_DAYS = 30
+
+
+def stats_range(start: date | None, end: date | None) -> tuple:
+    """Returns the days a /stats request covers, the last STATS_DAYS days by default"""
+    end = end or loan_date()
+    return start or end - timedelta(days=STATS_DAYS - 1), end
+
+
+def average_loan_days(returns: int, loan_seconds: float) -> float | None:
+    return round(loan_seconds / returns / 86400, 2) if returns else None
+
+
+# Checkouts, returns and the average length of the loans returned, per day and in total
+# Read from the daily rollups that checkout and return keep up to date
+@app.get("/stats/circulation", response_model=CirculationStats, responses={400: {"model": ErrorResponse}})
+async def get_circulation_stats(start: date | None = None, end: date | None = None):
+    """Return the checkouts and returns of each day from start to end, the last 30 days by default"""
+    start, end = stats_range(start, end)
+    if start > end:
+        return error_response("start must not be after end", 400)
+
+    days = await run_blocking(store.daily_stats, start, end)
+    returns = sum(day["returns"] for day in days)
+    return ORJSONResponse({
+        "start": start, "end": end,
+        "checkouts": sum(day["checkouts"] for day in days), "returns": returns,
+        "average_loan_days": average_loan_days(returns, sum(day["loan_seconds"] for day in days)),
+        "data": [{"day": day["day"], "checkouts": day["checkouts"], "returns": day["returns"],
+                  "average_loan_days": average_loan_days(day["returns"], day["loan_seconds"])} for day in days]})
+
+
+# The most borrowed books from start to end, the last 30 days by default
+@app.get("/stats/popular", response_model=PopularBooks, responses={400: {"model": ErrorResponse}})
+async def get_popular_books(start: date | None = None, end: date | None = None, limit: int = 10):
+    """Return the books checked out the most from start to end, most checkouts first"""
+    start, end = stats_range(start, end)
+    if start > end:
+        return error_response("start must not be after end", 400)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    books = await run_blocking(store.popular_books, start, end, limit)
+    return ORJSONResponse({"start": start, "end": end, "data": books})
 
 
 @app.post("/signup")
 async def signup(request: Request):
     """Creates a new user in the database"""
+    if supabase is None:
+        return error_response("Sign up isn't available on this server", 503)
     data = await request.json()
     try:
-        create_user = supabase.auth.sign_up({"email": data["email"], "password": data["password"]})
+        create_user = await run_supabase("auth.sign_up", supabase.auth.sign_up, {"email": data["email"], "password": data["password"]})
     except Exception as e:
         response = {"message": e.message, "status": 400}
         return response
 
     supabase_id = create_user.user.id
-    supabase_service_client.table("users").insert({"supabase_id": supabase_id}).execute()
+    await run_blocking(store.add_user, supabase_id)
     response = {"message": "User created successfully", "status": 200}
     return response
 
@@ -109,17 +886,21 @@ async def signup(request: Request):
 @app.post("/logout")
 async def logout():
     """Logs the current user out"""
-    supabase.auth.sign_out()
+    if supabase is None:
+        return error_response("Log out isn't available on this server", 503)
+    await run_supabase("auth.sign_out", supabase.auth.sign_out)
 
     return "Logged out successfully"
 
 
-@app.get("/user")
+@app.get("/user", response_model=str, responses={401: {"model": ErrorResponse}})
 async def get_user(request: Request):
     """Returns the user id of the user whose auth token was provided"""
-    auth_token = request.headers["Authorization"]
-    user = supabase.auth.get_user(auth_token)
-    response = user.user.id
+    try:
+        claims = verify_token(request.headers["Authorization"])
+    except (KeyError, jwt.PyJWTError):
+        return error_response("Invalid or expired token", 401)
+    response = claims["sub"]
 
     return response
 
@@ -128,75 +909,318 @@ async def get_user(request: Request):
 @app.post("/auth")
 async def post_auth(request: Request):
     """Returns a temporary auth token of the user whose credentials were provided"""
+    if supabase is None:
+        return error_response("Log in isn't available on this server", 503)
     data = await request.json()
-    auth = supabase.auth.sign_in_with_password({"email": data["email"], "password": data["password"]})
+    auth = await run_supabase("auth.sign_in_with_password", supabase.auth.sign_in_with_password, {"email": data["email"], "password": data["password"]})
     session = auth.session
     return session.access_token
 
 
-# Creates a new book in the database
+# Adds copies of a book to the database
 # Requires an auth token in the header of your request
-# todo check for existing isbn and throw in an error or in the future
-#  increment quantity (column needs to be added to database)
-@app.put("/book")
+# A book whose ISBN is already in the catalog gets more copies instead of a second row,
+# the optional "copies" defaults to 1
+@app.put("/book", response_model=Book, responses={400: {"model": ErrorResponse}, 401: {"model": ErrorResponse}})
 async def create_book(request: Request):
-    """Creates a new book in the database"""
+    """Adds copies of a book to the database"""
+    if authenticated_user(request) is None:
+        return error_response("Invalid or expired token", 401)
     data = await request.json()
-    auth_token = request.headers["Authorization"]
+    copies = data.get("copies", 1)
+    if not isinstance(copies, int) or isinstance(copies, bool) or copies < 1:
+        return error_response("copies must be a positive whole number", 400)
+    # stored in the form /books/import stores it
+    isbn = normalize_isbn(data["isbn"])
+    if not isbn:
+        return error_response("isbn must have digits", 400)
 
-    supabase.postgrest.auth(auth_token)
-    response = (
-                supabase.table("books")
-                .upsert({"title": data["title"], "author": data["author"], "isbn": data["isbn"]})
-                .execute()
-    )
+    book = await run_blocking(store.add_book_copies, data["title"], data["author"], isbn, copies)
+    invalidate_catalog()
+    if recommender.resource is not None:
+        recommender.add_book(book)
+    notify_processes("book", book={key: book[key] for key in ("id", "title", "author", "isbn")})
 
-    return response
+    return ORJSONResponse(book)
+
+
+# number of rows sent to the import at a time
+IMPORT_BATCH_SIZE = 10000
+# bytes of an import body kept in memory, the rest of a larger body is written to a temporary file
+IMPORT_SPOOL_SIZE = 16 * 1024 * 1024
+
+
+def import_records(lines, ndjson: bool):
+    """Yields the record of each row of an import body, None for the rows that can't be parsed"""
+    if ndjson:
+        for line in lines:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+        return
+    # csv.reader reads as many lines as a row takes, so quoted fields can hold newlines
+    reader = csv.reader(lines)
+    header = None
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error:
+            yield None
+            continue
+        if not any(field.strip() for field in row):
+            continue
+        if header is None:
+            header = [column.strip().lower() for column in row]
+        else:
+            yield dict(zip(header, row))
+
+
+def import_body(body, ndjson: bool) -> dict:
+    """Imports the books of a CSV or NDJSON body, returns how many were inserted and skipped"""
+    seen = set()
+    batch = []
+    staged = duplicates = invalid = 0
+
+    book_import = store.start_import()
+    try:
+        for record in import_records(io.TextIOWrapper(body, encoding="utf-8-sig", newline=""), ndjson):
+            try:
+                title, author, isbn = record["title"].strip(), record["author"].strip(), normalize_isbn(record["isbn"])
+            except (KeyError, TypeError, AttributeError):
+                invalid += 1
+                continue
+            if not (title and author and isbn):
+                invalid += 1
+                continue
+            if isbn in seen:
+                duplicates += 1
+                continue
+            seen.add(isbn)
+            batch.append((title, author, isbn))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                book_import.add(batch)
+                staged += len(batch)
+                batch = []
+        if batch:
+            book_import.add(batch)
+            staged += len(batch)
+    except Exception:
+        book_import.abort()
+        raise
+    inserted = book_import.finish()
+    return {"inserted": inserted, "skipped": duplicates + invalid + staged - inserted,
+            "duplicates": duplicates, "existing": staged - inserted, "invalid": invalid}
+
+
+# Imports books from a CSV (with a title,author,isbn header) or NDJSON request body
+# The body is read into a spooled temporary file before the import starts, so a slow upload
+# doesn't hold its transaction open. Rows are de-duplicated on normalized ISBN and sent to the
+# import in batches; nothing is added until every row was. Books whose ISBN is already in the
+# catalog are skipped, and each inserted book gets one copy.
+@app.post("/books/import", response_model=ImportResult, responses={401: {"model": ErrorResponse}})
+async def import_books(request: Request):
+    """Imports books in bulk and reports how many were inserted and skipped"""
+    if authenticated_user(request) is None:
+        return error_response("Invalid or expired token", 401)
+    ndjson = "json" in request.headers.get("Content-Type", "")
+
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE) as body:
+        async for chunk in request.stream():
+            body.write(chunk)
+        body.seek(0)
+        result = await run_blocking(import_body, body, ndjson)
+
+    if result["inserted"]:
+        invalidate_catalog()
+        notify_processes("catalog")
+    return result
+
+
+# "Readers also borrowed" recommendations, see recommendations.py
+# The first request creates and builds them, later ones rebuild them in the background once they
+# are stale. Until then new books and checkouts aren't added, the first build reads them all.
+recommender = LazyResource(create_recommender)
 
 
-@app.put("/checkout")
+@app.get("/books/{book_id}/recommendations", response_model=RecommendationList, responses={400: {"model": ErrorResponse}})
+async def get_recommendations(book_id: str, limit: int = 10):
+    """Return the books most borrowed by the readers of a book, with how many of them did"""
+    book_id = storage.canonical_id(book_id)
+    if book_id is None:
+        return error_response("This isn't a valid book id", 400)
+    # off the event loop, the first request imports scipy
+    books_recommender = await run_blocking(recommender.get)
+    limit = max(1, min(limit, books_recommender.top_n))
+
+    if books_recommender.built_at is None:
+        await run_blocking(books_recommender.refresh, store, True)
+    elif books_recommender.is_stale():
+        books_recommender.refresh_in_background(store)
+    return ORJSONResponse({"data": books_recommender.recommend(book_id, limit)})
+
+
+# Availability changes of the books, pushed to the subscribers of /events as server-sent events
+# Checkouts and returns publish the new counters of their books, so clients update the
+# book's row instead of reloading the books. See events.py.
+broker = events.EventBroker(server_instance)
+
+
+async def publish_availability(book_ids) -> None:
+    """Publishes the available and total copies of books that were checked out or returned"""
+    if not broker.subscribers:
+        # nobody to tell, skip reading the counters
+        broker.skip()
+        return
+    for book in await run_blocking(store.availability, list(book_ids)):
+        broker.publish("availability", book)
+
+
+# Streams an "availability" event, {"id", "available_copies", "total_copies", "updated_at"}, each
+# time a book is checked out or returned. Events of a book may arrive out of order, keep the one
+# with the latest updated_at. Send the Last-Event-ID header when reconnecting to get the events missed
+# meanwhile, a "reset" event means some were lost and the books have to be reloaded.
+@app.get("/events", response_class=StreamingResponse)
+async def get_events(last_event_id: str | None = Header(None)):
+    """Streams availability changes as server-sent events"""
+    return StreamingResponse(broker.subscribe(last_event_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# Checks out a book for the user whose auth token is in the header
+@app.put("/checkout", response_model=str, responses={400: {"model": ErrorResponse}, 401: {"model": ErrorResponse}})
 async def checkout_book(request: Request):
     """Checks out a book in the database"""
     data = await request.json()
-    auth_token = request.headers["Authorization"]
-    supabase.postgrest.auth(auth_token)
+    user_id = authenticated_user(request)
+    if user_id is None:
+        return error_response("Invalid or expired token", 401)
+    book_id = storage.canonical_id(data.get("book_id"))
+    if book_id is None:
+        return error_response("This isn't a valid book id", 400)
+    due_date = loan_date() + timedelta(days=14)
 
-    # check if the book is already checked out
-    is_checked_out = supabase.table("books").select("*").match({"id": data["book_id"], "is_checked_out": True}).execute()
-    if is_checked_out.data:
+    due_date = await run_blocking(store.claim_book, book_id, user_id, due_date)
+    if due_date is None:
         response = "This Book is not currently available for checkout"
     else:
-
-        due_date = (datetime.now(timezone.utc) + timedelta(days=14)).date().isoformat()
-        supabase.table("checkout_logs").upsert({"book_id": data["book_id"], "user_id": data["user_id"]}).execute()
-        supabase.table("books").update({"is_checked_out": True, "due_date": due_date}).eq("id", data["book_id"]).execute()
-        response = "Book successfully checked out! Due date: " + due_date
+        invalidate_catalog()
+        if recommender.resource is not None:
+            recommender.add_checkout(user_id, book_id)
+        await publish_availability([book_id])
+        notify_processes("checkout", user_id=user_id, book_ids=[book_id])
+        response = "Book successfully checked out! Due date: " + str(due_date)
 
     return response
 
 
-@app.put("/return")
+def parse_book_ids(book_ids) -> tuple[list, list]:
+    """Splits a list of book ids into unique valid ids and invalid ids, keeping their order"""
+    valid, invalid = [], []
+    for book_id in book_ids:
+        try:
+            book_id = str(uuid.UUID(str(book_id)))
+        except ValueError:
+            invalid.append(book_id)
+            continue
+        if book_id not in valid:
+            valid.append(book_id)
+    return valid, invalid
+
+
+# Checks out several books for the user whose auth token is in the header
+# All books are claimed in one transaction, and each book gets its own result
+@app.put("/checkout/batch", response_model=BatchResults, responses={401: {"model": ErrorResponse}})
+async def checkout_books(request: Request):
+    """Checks out a list of books in the database"""
+    data = await request.json()
+    user_id = authenticated_user(request)
+    if user_id is None:
+        return error_response("Invalid or expired token", 401)
+    book_ids, invalid_ids = parse_book_ids(data["book_ids"])
+    due_date = loan_date() + timedelta(days=14)
+
+    claimed, held = {}, set()
+    if book_ids:
+        claimed, held = await run_blocking(store.claim_books, book_ids, user_id, due_date)
+
+    results = []
+    for book_id in book_ids:
+        if book_id in claimed:
+            results.append({"book_id": book_id, "status": "checked_out", "due_date": str(claimed[book_id]),
+                            "message": "Book successfully checked out! Due date: " + str(claimed[book_id])})
+        elif book_id in held:
+            results.append({"book_id": book_id, "status": "already_checked_out",
+                            "message": "You already have this book checked out"})
+        else:
+            results.append({"book_id": book_id, "status": "unavailable",
+                            "message": "This Book is not currently available for checkout"})
+    for book_id in invalid_ids:
+        results.append({"book_id": book_id, "status": "invalid", "message": "This isn't a valid book id"})
+
+    if claimed:
+        invalidate_catalog()
+        if recommender.resource is not None:
+            for book_id in claimed:
+                recommender.add_checkout(user_id, book_id)
+        await publish_availability(claimed)
+        notify_processes("checkout", user_id=user_id, book_ids=list(claimed))
+    return {"results": results}
+
+
+# Returns a book for the user whose auth token is in the header
+@app.put("/return", response_model=str, responses={400: {"model": ErrorResponse}, 401: {"model": ErrorResponse}})
 async def return_book(request: Request):
     """Returns a book in the database"""
     data = await request.json()
-    auth_token = request.headers["Authorization"]
-    current_date = datetime.now(timezone.utc)
-    supabase.postgrest.auth(auth_token)
-
-    # queries
-    is_checked_out = "SELECT * FROM checkout_logs WHERE checkin_date IS NULL AND book_id = :book_id AND user_id = :user_id"
-    checkin_book = "UPDATE checkout_logs SET checkin_date = :current_date where checkin_date IS NULL AND book_id = :book_id AND user_id = :user_id"
-
-    with engine.connect() as connection:
-        result = connection.execute(text(is_checked_out), {"book_id": data["book_id"], "user_id": data["user_id"]})
-        if result.rowcount == 0:
-            response = "This book isn't currently checked out by you"
-        else:
-            supabase.table("books").update({"is_checked_out": False, "due_date": None}).eq("id", data["book_id"]).execute()
-            connection.execute(text(checkin_book), {"book_id": data["book_id"], "user_id": data["user_id"],
-                                                    "current_date": current_date.strftime('%Y-%m-%d %H:%M:%S %z')})
-            connection.commit()
-            response = "Book successfully returned"
+    user_id = authenticated_user(request)
+    if user_id is None:
+        return error_response("Invalid or expired token", 401)
+    book_id = storage.canonical_id(data.get("book_id"))
+    if book_id is None:
+        return error_response("This isn't a valid book id", 400)
+
+    if await run_blocking(store.checkin_books, [book_id], user_id):
+        invalidate_catalog()
+        await publish_availability([book_id])
+        notify_processes("return", user_id=user_id, book_ids=[book_id])
+        response = "Book successfully returned"
+    else:
+        response = "This book isn't currently checked out by you"
 
     return response
 
+
+# Returns several books for the user whose auth token is in the header
+# All loans are closed in one transaction, and each book gets its own result
+@app.put("/return/batch", response_model=BatchResults, responses={401: {"model": ErrorResponse}})
+async def return_books(request: Request):
+    """Returns a list of books in the database"""
+    data = await request.json()
+    user_id = authenticated_user(request)
+    if user_id is None:
+        return error_response("Invalid or expired token", 401)
+    book_ids, invalid_ids = parse_book_ids(data["book_ids"])
+
+    returned = set()
+    if book_ids:
+        returned = await run_blocking(store.checkin_books, book_ids, user_id)
+
+    results = []
+    for book_id in book_ids:
+        if book_id in returned:
+            results.append({"book_id": book_id, "status": "returned", "message": "Book successfully returned"})
+        else:
+            results.append({"book_id": book_id, "status": "not_checked_out",
+                            "message": "This book isn't currently checked out by you"})
+    for book_id in invalid_ids:
+        results.append({"book_id": book_id, "status": "invalid", "message": "This isn't a valid book id"})
+
+    if returned:
+        invalidate_catalog()
+        await publish_availability(returned)
+        notify_processes("return", user_id=user_id, book_ids=list(returned))
+    return {"results": results}
@@ -0,0 +1,855 @@
+'''Storage backends of the server
+
+Every handler reads and writes books, copies, loans and users through a Storage. PostgresStorage
+runs the SQL against the database the migrations create. MemoryStorage keeps everything in
+process, so the whole API runs without a database (edge kiosks, offline benchmarks); its data
+is lost when the server stops.
+
+STORAGE_BACKEND selects the backend the server uses: "postgres" (the default) or "memory".
+The methods are blocking, handlers call them on the threadpool with run_blocking.'''
+
+import bisect
+import csv
+import difflib
+import io
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+# the columns of a Book, in order
+# is_checked_out means no copy is available, and due_date is then the earliest due date of the copies
+BOOK_COLUMNS = "id, created_at, updated_at, title, author, isbn, is_checked_out, due_date, total_copies, available_copies"
+
+# minimum word similarity of a search match, the default threshold of pg_trgm's <% operator
+SEARCH_THRESHOLD = 0.6
+
+# For this long after a write, reads that could miss it are made on the primary database rather
+# than the read replica, which may not have replayed it yet
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+
+def normalize_isbn(isbn) -> str:
+    """Strips everything but digits and X from an ISBN, so 0-306-40615-2 and 0306406152 compare equal"""
+    return re.sub(r"[^0-9X]", "", str(isbn).upper())
+
+
+def isbn_search_prefix(q: str) -> str | None:
+    """Returns the normalized ISBN prefix a search for q matches, None if q isn't part of an ISBN
+    (words like "Catch 22" only match titles and authors)"""
+    if not re.fullmatch(r"[0-9Xx\s-]+", q):
+        return None
+    return normalize_isbn(q) or None
+
+
+class Storage:
+    """The reads and writes the handlers make"""
+
+    def books_page(self, limit: int, after: list | None) -> list:
+        """Returns up to limit books in (title, id) order, after the [title, id] of the previous page's last book"""
+        raise NotImplementedError
+
+    def stream_books(self, batch_size: int):
+        """Yields every book in (title, id) order, in lists of up to batch_size books"""
+        raise NotImplementedError
+
+    def search_books(self, q: str, limit: int, offset: int) -> list:
+        """Returns up to limit books whose title, author or ISBN match q, best matches (highest rank) first"""
+        raise NotImplementedError
+
+    def my_books(self, user_id: str, today: date) -> list:
+        """Returns the books checked out by a user, with their due dates and whether they are overdue"""
+        raise NotImplementedError
+
+    def overdue_loans(self, today: date, limit: int, after: list | None) -> list:
+        """Returns up to limit loans due before today in (due_date, copy_id) order, after the
+        [due_date, copy_id] of the previous page's last loan"""
+        raise NotImplementedError
+
+    def overdue_users(self, today: date, limit: int, offset: int) -> list:
+        """Returns up to limit users with loans due before today, with how many they have and
+        the earliest due date of them, the users with the oldest overdue loan first"""
+        raise NotImplementedError
+
+    def daily_stats(self, start: date, end: date) -> list:
+        """Returns the checkouts, returns and total length in seconds of the loans returned
+        (loan_seconds) of each day from start to end that had any, in day order"""
+        raise NotImplementedError
+
+    def popular_books(self, start: date, end: date, limit: int) -> list:
+        """Returns up to limit books checked out the most from start to end, with their checkouts"""
+        raise NotImplementedError
+
+    def loan_pairs(self, batch_size: int):
+        """Yields the (user id, book id) of every user and book they ever borrowed, each pair
+        once, in lists of up to batch_size pairs"""
+        raise NotImplementedError
+
+    def book_changes(self, after: list | None, limit: int) -> tuple[list, datetime]:
+        """Returns up to limit books changed or deleted after the [changed_at, id] of the previous
+        change (or at or after changed_at when id is None), in (changed_at, id) order, and the time
+        up to which changes are complete. Changed books have a changed_at, deleted ones are just
+        {"id", "changed_at", "deleted": True}. Without after, only the time is returned."""
+        raise NotImplementedError
+
+    def add_book_copies(self, title: str, author: str, isbn: str, copies: int) -> dict:
+        """Adds copies of a book, creating it if its ISBN isn't in the catalog yet, returns the book"""
+        raise NotImplementedError
+
+    def start_import(self) -> "BookImport":
+        """Starts a bulk import of books"""
+        raise NotImplementedError
+
+    def claim_book(self, book_id: str, user_id: str, due_date):
+        """Checks out a copy of a book for a user, returns the due date or None if no copy is available"""
+        raise NotImplementedError
+
+    def claim_books(self, book_ids: list, user_id: str, due_date) -> tuple[dict, set]:
+        """Checks out a copy of each available book in a list for a user, returns {book id: due date}
+        and the ids of the books the user already has a copy of, which are skipped"""
+        raise NotImplementedError
+
+    def checkin_books(self, book_ids: list, user_id: str) -> set:
+        """Closes a user's open loans of the books in a list, returns the ids of the returned books"""
+        raise NotImplementedError
+
+    def availability(self, book_ids: list) -> list:
+        """Returns the id, available_copies, total_copies and updated_at of the books in a list that exist"""
+        raise NotImplementedError
+
+    def add_user(self, supabase_id: str) -> None:
+        """Records a user who signed up"""
+        raise NotImplementedError
+
+    def note_write(self, user_id: str | None = None) -> None:
+        """Records a write to the catalog, made by user_id if given, so that the reads made
+        after it don't miss it. Writes made through the storage are recorded by it, this is
+        for those made through another server process."""
+
+    def is_settled(self) -> bool:
+        """Returns whether the catalog read now has every write this storage knows of, so it can be cached"""
+        return True
+
+
+class BookImport:
+    """A bulk import of books, nothing is visible until it is finished"""
+
+    def add(self, rows: list) -> None:
+        """Adds a batch of (title, author, normalized isbn) rows, with ISBNs not already in the import"""
+        raise NotImplementedError
+
+    def finish(self) -> int:
+        """Inserts the books whose ISBN isn't in the catalog yet with one copy each, returns how many were inserted"""
+        raise NotImplementedError
+
+    def abort(self) -> None:
+        raise NotImplementedError
+
+
+# claims the copies in a "picked" CTE: marks them checked out and decrements the counters of
+# their books, a book is checked out (with the earliest due date) once no copy is available.
+# The checkouts are added to the day's rollups, in book id order so that concurrent checkouts
+# lock the rows in the same order.
+CLAIM_COPIES = """claimed as (
+                      update book_copies set is_checked_out = true, due_date = :due_date
+                      where id in (select id from picked)
+                      returning id, book_id, due_date
+                  ), counted as (
+                      update books set available_copies = available_copies - 1,
+                                       is_checked_out = available_copies = 1,
+                                       due_date = case when available_copies = 1
+                                                       then coalesce((select min(due_date) from book_copies
+                                                                      where book_id = books.id), :due_date)
+                                                  end
+                      where id in (select book_id from claimed)
+                  ), counted_book_day as (
+                      insert into book_daily_stats (day, book_id, checkouts)
+                      select current_date, book_id, count(*) from claimed group by book_id order by book_id
+                      on conflict (day, book_id) do update set checkouts = book_daily_stats.checkouts + excluded.checkouts
+                  ), counted_day as (
+                      insert into daily_stats (day, checkouts)
+                      select current_date, count(*) from claimed having count(*) > 0
+                      on conflict (day) do update set checkouts = daily_stats.checkouts + excluded.checkouts
+                  )"""
+
+# adds the loans closed in a "closed" CTE to the day's rollups
+RETURN_LOANS = """returned_book_day as (
+                      insert into book_daily_stats (day, book_id, returns, loan_seconds)
+                      select current_date, book_id, count(*), sum(extract(epoch from checkin_date - checkout_date))
+                      from closed group by book_id order by book_id
+                      on conflict (day, book_id) do update set returns = book_daily_stats.returns + excluded.returns,
+                                                              loan_seconds = book_daily_stats.loan_seconds + excluded.loan_seconds
+                  ), returned_day as (
+                      insert into daily_stats (day, returns, loan_seconds)
+                      select current_date, count(*), sum(extract(epoch from checkin_date - checkout_date))
+                      from closed having count(*) > 0
+                      on conflict (day) do update set returns = daily_stats.returns + excluded.returns,
+                                                      loan_seconds = daily_stats.loan_seconds + excluded.loan_seconds
+                  )"""
+
+
+class PostgresStorage(Storage):
+    """Stores everything in the database the migrations create
+
+    Writes go to engine, the primary. Given a replica engine, the catalog, loan listings,
+    reports and statistics are read from the replica, but the loans of a user who wrote in the
+    last sticky_seconds are read from the primary, so users see their own writes. is_settled
+    tells whether the catalog read from the replica may still miss a write. book_changes and
+    availability, which are read to follow writes, always use the primary."""
+
+    def __init__(self, engine, replica=None, sticky_seconds: float = REPLICA_STICKY_SECONDS):
+        self.engine = engine
+        self.replica = replica
+        self.sticky_seconds = sticky_seconds
+        self.lock = threading.Lock()
+        self.writers = OrderedDict()  # user id -> time.monotonic() of their last write, oldest first
+        self.written_at = None  # time.monotonic() of the last write to the catalog
+
+    def note_write(self, user_id: str | None = None) -> None:
+        if self.replica is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.written_at = now
+            if user_id is not None:
+                self.writers[str(user_id)] = now
+                self.writers.move_to_end(str(user_id))
+            # forget the writers whose reads went back to the replica
+            while self.writers and next(iter(self.writers.values())) < now - self.sticky_seconds:
+                self.writers.popitem(last=False)
+
+    def is_settled(self) -> bool:
+        written_at = self.written_at
+        return written_at is None or written_at < time.monotonic() - self.sticky_seconds
+
+    def reader(self, user_id: str | None = None):
+        """Returns the engine to read from, the replica unless there is none or user_id wrote recently"""
+        if self.replica is None:
+            return self.engine
+        if user_id is None:
+            return self.replica
+        with self.lock:
+            written_at = self.writers.get(str(user_id))
+        if written_at is not None and written_at >= time.monotonic() - self.sticky_seconds:
+            return self.engine
+        return self.replica
+
+    # Books are sorted by (title, id) so the page after a cursor can be found with the
+    # ix_books_title_id index instead of reading and sorting the whole table
+    def books_page(self, limit: int, after: list | None) -> list:
+        # queries
+        first_page = f"select {BOOK_COLUMNS} from books order by title, id limit :limit"
+        next_page = f"select {BOOK_COLUMNS} from books where (title, id) > (:title, :id) order by title, id limit :limit"
+
+        if after is None:
+            query, params = first_page, {"limit": limit}
+        else:
+            query, params = next_page, {"title": after[0], "id": after[1], "limit": limit}
+
+        with self.reader().connect() as connection:
+            return [dict(row) for row in connection.execute(text(query), params).mappings().all()]
+
+    # the books are read from a server-side cursor a batch at a time
+    def stream_books(self, batch_size: int):
+        with self.reader().connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(
+                text(f"select {BOOK_COLUMNS} from books order by title, id"))
+            for rows in result.mappings().partitions(batch_size):
+                yield [dict(row) for row in rows]
+
+    # Title and author are matched with trigram word similarity, so typos and partial
+    # words still match. The gin_trgm_ops indexes from the books_search_indexes migration
+    # serve both the similarity operator and the ISBN prefix match.
+    def search_books(self, q: str, limit: int, offset: int) -> list:
+        # queries
+        search = f"""select {BOOK_COLUMNS}, greatest(word_similarity(:q, title), word_similarity(:q, author),
+                                       case when isbn ilike :isbn_prefix then 1 else 0 end) as rank
+                    from books
+                    where :q <% title or :q <% author or isbn ilike :isbn_prefix
+                    order by rank desc, title, id
+                    limit :limit offset :offset"""
+
+        # ISBNs are stored normalized, so 0-306-40615 finds 0306406152. The normalized text has
+        # no LIKE wildcards, and a null prefix matches no ISBN
+        isbn_prefix = isbn_search_prefix(q)
+        if isbn_prefix is not None:
+            isbn_prefix += "%"
+
+        with self.reader().connect() as connection:
+            result = connection.execute(text(search), {"q": q, "isbn_prefix": isbn_prefix, "limit": limit, "offset": offset})
+            return [dict(row) for row in result.mappings().all()]
+
+    def my_books(self, user_id: str, today: date) -> list:
+        # queries
+        my_books = """select books.id, books.title, books.author, books.isbn, book_copies.due_date,
+                             book_copies.due_date < :today as is_overdue
+                      from checkout_logs
+                      join books on books.id = checkout_logs.book_id
+                      join book_copies on book_copies.id = checkout_logs.copy_id
+                      where checkout_logs.checkin_date IS NULL AND checkout_logs.user_id=:user_id"""
+
+        with self.reader(user_id).connect() as connection:
+            result = connection.execute(text(my_books), {"user_id": user_id, "today": today})
+            return [dict(row) for row in result.mappings()]
+
+    # The loaned copies due before today are read from ix_book_copies_due_date in (due_date, id)
+    # order, so a page costs the same however many loans are overdue, and each is joined to its
+    # open loan through ux_checkout_logs_open_copy
+    def overdue_loans(self, today: date, limit: int, after: list | None) -> list:
+        # queries
+        overdue = """select book_copies.id as copy_id, books.id as book_id, books.title, books.author, books.isbn,
+                             checkout_logs.user_id, checkout_logs.checkout_date, book_copies.due_date,
+                             :today - book_copies.due_date as days_overdue
+                      from book_copies
+                      join checkout_logs on checkout_logs.copy_id = book_copies.id and checkout_logs.checkin_date is null
+                      join books on books.id = book_copies.book_id
+                      where book_copies.is_checked_out and book_copies.due_date < :today
+                            {after}
+                      order by book_copies.due_date, book_copies.id
+                      limit :limit"""
+        first_page = overdue.format(after="")
+        next_page = overdue.format(after="and (book_copies.due_date, book_copies.id) > (:due_date, :copy_id)")
+
+        if after is None:
+            query, params = first_page, {"today": today, "limit": limit}
+        else:
+            query, params = next_page, {"today": today, "due_date": after[0], "copy_id": after[1], "limit": limit}
+
+        with self.reader().connect() as connection:
+            return [dict(row) for row in connection.execute(text(query), params).mappings().all()]
+
+    def overdue_users(self, today: date, limit: int, offset: int) -> list:
+        # queries
+        overdue_users = """select checkout_logs.user_id, count(*) as overdue_loans,
+                                  min(book_copies.due_date) as oldest_due_date
+                           from book_copies
+                           join checkout_logs on checkout_logs.copy_id = book_copies.id and checkout_logs.checkin_date is null
+                           where book_copies.is_checked_out and book_copies.due_date < :today
+                           group by checkout_logs.user_id
+                           order by oldest_due_date, checkout_logs.user_id
+                           limit :limit offset :offset"""
+
+        with self.reader().connect() as connection:
+            result = connection.execute(text(overdue_users), {"today": today, "limit": limit, "offset": offset})
+            return [dict(row) for row in result.mappings().all()]
+
+    # a book whose ISBN is already in the catalog (ux_books_isbn_normalized) gets more copies
+    # instead of a second row, see the add_book_copies function in the book_copies migration
+    def add_book_copies(self, title: str, author: str, isbn: str, copies: int) -> dict:
+        # queries
+        add_copies = f"select {BOOK_COLUMNS} from add_book_copies(:title, :author, :isbn, :copies)"
+
+        with self.engine.begin() as connection:
+            result = connection.execute(text(add_copies), {"title": title, "author": author, "isbn": isbn, "copies": copies})
+            book = dict(result.mappings().one())
+        self.note_write()
+        return book
+
+    def start_import(self) -> "PostgresImport":
+        return PostgresImport(self)
+
+    def claim_book(self, book_id: str, user_id: str, due_date):
+        # queries
+        # an available copy is locked and claimed, the book's counter is decremented and the loan
+        # is logged in one statement; copies locked by a concurrent checkout are skipped rather
+        # than waited on, so two users can't both claim the same copy
+        checkout = f"""with picked as (
+                          select id from book_copies
+                          where book_id = :book_id and not is_checked_out
+                          limit 1
+                          for update skip locked
+                      ), {CLAIM_COPIES}
+                      insert into checkout_logs (book_id, copy_id, user_id)
+                      select book_id, id, :user_id from claimed
+                      returning (select due_date from claimed) as due_date"""
+
+        try:
+            with self.engine.begin() as connection:
+                loan = connection.execute(text(checkout), {"book_id": book_id, "user_id": user_id,
+                                                           "due_date": due_date}).first()
+        except IntegrityError as e:
+            # the user already has a copy of the book, any other violation is a bug
+            if not is_open_loan_conflict(e):
+                raise
+            return None
+        if loan is None:
+            return None
+        self.note_write(user_id)
+        return loan.due_date
+
+    # all books are claimed in one transaction
+    def claim_books(self, book_ids: list, user_id: str, due_date) -> tuple[dict, set]:
+        # queries
+        # one available copy is picked per book the user doesn't already have a copy of, the open
+        # loans are found by ux_checkout_logs_open_book_user
+        checkout = f"""with held as (
+                          select book_id from checkout_logs
+                          where book_id = any(cast(:book_ids as uuid[])) and user_id = :user_id and checkin_date is null
+                      ), picked as (
+                          select copy.id from unnest(cast(:book_ids as uuid[])) as requested(book_id)
+                          cross join lateral (
+                              select id from book_copies
+                              where book_copies.book_id = requested.book_id and not is_checked_out
+                              limit 1
+                              for update skip locked
+                          ) as copy
+                          where requested.book_id not in (select book_id from held)
+                      ), {CLAIM_COPIES}, logged as (
+                          insert into checkout_logs (book_id, copy_id, user_id)
+                          select book_id, id, :user_id from claimed
+                      )
+                      select book_id as id, due_date, false as held from claimed
+                      union all
+                      select book_id, null, true from held"""
+
+        try:
+            with self.engine.begin() as connection:
+                result = connection.execute(text(checkout), {"book_ids": book_ids, "user_id": user_id, "due_date": due_date})
+                rows = result.all()
+        except IntegrityError as e:
+            # a concurrent checkout of one of the books by the same user committed first, the
+            # batch was rolled back. Any other violation is a bug
+            if not is_open_loan_conflict(e):
+                raise
+            return {}, set()
+        claimed = {str(row.id): row.due_date for row in rows if not row.held}
+        if claimed:
+            self.note_write(user_id)
+        return claimed, {str(row.id) for row in rows if row.held}
+
+    # all loans are closed in one transaction
+    def checkin_books(self, book_ids: list, user_id: str) -> set:
+        # queries
+        # the loaned copies are made available again and the counters of their books incremented
+        checkin = f"""with closed as (
+                               update checkout_logs set checkin_date = now()
+                               where checkin_date is null and user_id = :user_id and book_id = any(cast(:book_ids as uuid[]))
+                               returning book_id, copy_id, checkout_date, checkin_date
+                           ), {RETURN_LOANS}, freed as (
+                               update book_copies set is_checked_out = false, due_date = null
+                               where id in (select copy_id from closed)
+                           ), returned as (
+                               select book_id, count(*) as copies from closed group by book_id
+                           )
+                           update books set available_copies = available_copies + returned.copies,
+                                            is_checked_out = false, due_date = null
+                           from returned
+                           where books.id = returned.book_id
+                           returning books.id"""
+
+        with self.engine.begin() as connection:
+            result = connection.execute(text(checkin), {"book_ids": book_ids, "user_id": user_id})
+            returned = {str(row.id) for row in result}
+        if returned:
+            self.note_write(user_id)
+        return returned
+
+    # the rollups hold a row per day and per book per day, so these read far fewer rows than checkout_logs
+    def daily_stats(self, start: date, end: date) -> list:
+        # queries
+        daily_stats = """select day, checkouts, returns, loan_seconds from daily_stats
+                         where day between :start and :end order by day"""
+
+        with self.reader().connect() as connection:
+            result = connection.execute(text(daily_stats), {"start": start, "end": end})
+            return [dict(row) for row in result.mappings().all()]
+
+    def popular_books(self, start: date, end: date, limit: int) -> list:
+        # queries
+        popular = """select books.id, books.title, books.author, books.isbn, top.checkouts
+                     from (select book_id, sum(checkouts) as checkouts from book_daily_stats
+                           where day between :start and :end and checkouts > 0
+                           group by book_id
+                           order by checkouts desc, book_id
+                           limit :limit) as top
+                     join books on books.id = top.book_id
+                     order by top.checkouts desc, books.id"""
+
+        with self.reader().connect() as connection:
+            result = connection.execute(text(popular), {"start": start, "end": end, "limit": limit})
+            return [dict(row) for row in result.mappings().all()]
+
+    # the pairs are read from a server-side cursor a batch at a time
+    def loan_pairs(self, batch_size: int):
+        with self.reader().connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(
+                text("select distinct user_id, book_id from checkout_logs"))
+            for rows in result.partitions(batch_size):
+                yield [(str(row.user_id), str(row.book_id)) for row in rows]
+
+    # Books are found by ix_books_updated_at_id and deleted books by ix_book_tombstones_deleted_at_id,
+    # both kept up to date by the triggers of the books_change_tracking migration.
+    # A row's updated_at is set when it is written, but other transactions only see the row once
+    # its transaction commits, however long that takes (a bulk import can take minutes). Changes
+    # are only listed up to the start of the oldest transaction still running, since every row
+    # it wrote has a later updated_at, so no older change can become visible after a client moved
+    # past it. The server's role must see the xact_start of the sessions that write books: they
+    # have to run as the same role, or it needs pg_read_all_stats.
+    def book_changes(self, after: list | None, limit: int) -> tuple[list, datetime]:
+        # queries
+        horizon = """select least(clock_timestamp(), min(xact_start))::timestamp from pg_stat_activity
+                     where datname = current_database() and backend_type = 'client backend'
+                       and pid <> pg_backend_pid()"""
+        changed = f"""select {BOOK_COLUMNS}, updated_at as changed_at from books
+                      where updated_at < :horizon and {{after}}
+                      order by updated_at, id limit :limit"""
+        deleted = """select book_id as id, deleted_at as changed_at, true as deleted from book_tombstones
+                     where deleted_at < :horizon and {after}
+                     order by deleted_at, book_id limit :limit"""
+
+        with self.engine.connect() as connection:
+            until = connection.execute(text(horizon)).scalar()
+            if after is None:
+                return [], until
+            params = {"horizon": until, "changed_at": after[0], "id": after[1], "limit": limit}
+            changes = []
+            for query, column, id_column in [(changed, "updated_at", "id"), (deleted, "deleted_at", "book_id")]:
+                if after[1] is None:
+                    condition = f"{column} >= :changed_at"
+                else:
+                    condition = f"({column}, {id_column}) > (:changed_at, :id)"
+                result = connection.execute(text(query.format(after=condition)), params)
+                changes.extend(dict(row) for row in result.mappings())
+        # both lists are in order, the first limit of them together are the next changes
+        changes.sort(key=lambda change: (change["changed_at"], str(change["id"])))
+        return changes[:limit], until
+
+    def availability(self, book_ids: list) -> list:
+        # queries
+        availability = """select id, available_copies, total_copies, updated_at from books
+                          where id = any(cast(:book_ids as uuid[]))"""
+
+        with self.engine.connect() as connection:
+            result = connection.execute(text(availability), {"book_ids": book_ids})
+            return [dict(row) for row in result.mappings().all()]
+
+    def add_user(self, supabase_id: str) -> None:
+        # queries
+        add_user = "insert into users (supabase_id) values (:supabase_id) on conflict (supabase_id) do nothing"
+
+        with self.engine.begin() as connection:
+            connection.execute(text(add_user), {"supabase_id": supabase_id})
+
+
+class PostgresImport(BookImport):
+    """Sends the rows to a temporary staging table in COPY batches, and merges them into books
+    in the same transaction. Books whose ISBN is already in the catalog are skipped by
+    ux_books_isbn_normalized."""
+
+    def __init__(self, storage: PostgresStorage):
+        # queries
+        create_staging = "create temp table books_import (title text, author text, isbn text) on commit drop"
+
+        self.storage = storage
+        self.connection = storage.engine.raw_connection()
+        self.cursor = self.connection.cursor()
+        self.cursor.execute(create_staging)
+
+    def add(self, rows: list) -> None:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        self.cursor.copy_expert("copy books_import (title, author, isbn) from stdin with (format csv)", buffer)
+
+    def finish(self) -> int:
+        # queries
+        merge = """with inserted as (
+                       insert into books (title, author, isbn)
+                       select title, author, isbn from books_import
+                       on conflict do nothing
+                       returning id
+                   )
+                   insert into book_copies (book_id) select id from inserted"""
+
+        try:
+            self.cursor.execute(merge)
+            inserted = self.cursor.rowcount
+            self.connection.commit()
+        finally:
+            self.connection.close()
+        if inserted:
+            self.storage.note_write()
+        return inserted
+
+    def abort(self) -> None:
+        try:
+            self.connection.rollback()
+        finally:
+            self.connection.close()
+
+
+def is_open_loan_conflict(error: IntegrityError) -> bool:
+    """Returns whether an IntegrityError is the user already having an open loan of the book,
+    a violation of ux_checkout_logs_open_book_user"""
+    diag = getattr(error.orig, "diag", None)
+    return getattr(diag, "constraint_name", None) == "ux_checkout_logs_open_book_user"
+
+
+def canonical_id(book_id) -> str | None:
+    """Returns a book id in the form MemoryStorage stores it, or None if it isn't a UUID"""
+    try:
+        return str(uuid.UUID(str(book_id)))
+    except ValueError:
+        return None
+
+
+def word_similarity(q: str, value: str) -> float:
+    """Approximates pg_trgm's word_similarity: how well q matches the best part of value"""
+    q, value = q.lower(), value.lower()
+    if q in value:
+        return 1.0
+    words = value.split()
+    size = len(q.split())
+    # compare q with every run of as many words as it has
+    parts = [" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))]
+    return max(difflib.SequenceMatcher(None, q, part).ratio() for part in parts)
+
+
+class MemoryStorage(Storage):
+    """Stores everything in process. Books are kept in hash indexes by id and normalized ISBN,
+    and open loans by user, so lookups don't scan; pages of /books and /overdue are found by
+    bisecting sorted lists of (title, id) and (due_date, copy id). One lock makes every method atomic."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.books = {}  # book id -> book
+        self.isbns = {}  # normalized isbn -> book id
+        self.order = []  # (title, book id) of every book, sorted
+        self.copies = {}  # book id -> {copy id: due date, None if available}
+        self.available = {}  # book id -> ids of its available copies
+        self.loans = {}  # user id -> {book id: copy id}, the open loans
+        self.due = []  # (due date, copy id) of every loaned copy, sorted
+        self.borrowers = {}  # copy id -> (book id, user id, checkout date) of its open loan
+        self.daily = {}  # day -> [checkouts, returns, loan seconds]
+        self.book_daily = {}  # (day, book id) -> [checkouts, returns, loan seconds]
+        self.borrowed = set()  # (user id, book id) of every loan, returned or not
+        self.changes = []  # (updated_at, book id) of every book, sorted
+        self.users = set()  # supabase ids
+
+    def books_page(self, limit: int, after: list | None) -> list:
+        with self.lock:
+            start = 0 if after is None else bisect.bisect_right(self.order, (after[0], after[1]))
+            return [dict(self.books[book_id]) for _, book_id in self.order[start:start + limit]]
+
+    def stream_books(self, batch_size: int):
+        with self.lock:
+            books = [dict(self.books[book_id]) for _, book_id in self.order]
+        for i in range(0, len(books), batch_size):
+            yield books[i:i + batch_size]
+
+    def search_books(self, q: str, limit: int, offset: int) -> list:
+        isbn_prefix = isbn_search_prefix(q)
+        with self.lock:
+            books = [dict(self.books[book_id]) for _, book_id in self.order]
+        matches = []
+        for book in books:
+            rank = max(word_similarity(q, book["title"]), word_similarity(q, book["author"]),
+                       1.0 if isbn_prefix and normalize_isbn(book["isbn"]).startswith(isbn_prefix) else 0.0)
+            if rank >= SEARCH_THRESHOLD:
+                matches.append({**book, "rank": rank})
+        # the books are already in (title, id) order, and the sort is stable
+        matches.sort(key=lambda book: book["rank"], reverse=True)
+        return matches[offset:offset + limit]
+
+    def my_books(self, user_id: str, today: date) -> list:
+        with self.lock:
+            loans = self.loans.get(user_id, {})
+            return [{"id": book_id, "title": self.books[book_id]["title"], "author": self.books[book_id]["author"],
+                     "isbn": self.books[book_id]["isbn"], "due_date": self.copies[book_id][copy_id],
+                     "is_overdue": self.copies[book_id][copy_id] < today}
+                    for book_id, copy_id in loans.items()]
+
+    def overdue_loans(self, today: date, limit: int, after: list | None) -> list:
+        with self.lock:
+            end = bisect.bisect_left(self.due, (today,))
+            start = 0 if after is None else bisect.bisect_right(self.due, (after[0], after[1]), 0, end)
+            loans = []
+            for due_date, copy_id in self.due[start:min(end, start + limit)]:
+                book_id, user_id, checkout_date = self.borrowers[copy_id]
+                book = self.books[book_id]
+                loans.append({"copy_id": copy_id, "book_id": book_id, "title": book["title"], "author": book["author"],
+                              "isbn": book["isbn"], "user_id": user_id, "checkout_date": checkout_date, "due_date": due_date,
+                              "days_overdue": (today - due_date).days})
+            return loans
+
+    def overdue_users(self, today: date, limit: int, offset: int) -> list:
+        users = {}  # user id -> [overdue loans, oldest due date]
+        with self.lock:
+            for due_date, copy_id in self.due[:bisect.bisect_left(self.due, (today,))]:
+                _, user_id, _ = self.borrowers[copy_id]
+                # loans are read oldest first, so the first due date of a user is their oldest
+                users.setdefault(user_id, [0, due_date])[0] += 1
+        rows = sorted(users.items(), key=lambda item: (item[1][1], item[0]))
+        return [{"user_id": user_id, "overdue_loans": count, "oldest_due_date": oldest}
+                for user_id, (count, oldest) in rows[offset:offset + limit]]
+
+    def add_book_copies(self, title: str, author: str, isbn: str, copies: int) -> dict:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        new_copies = [str(uuid.uuid4()) for _ in range(copies)]
+        with self.lock:
+            book_id = self.isbns.get(normalize_isbn(isbn))
+            if book_id is None:
+                book_id = str(uuid.uuid4())
+                self.books[book_id] = {"id": book_id, "created_at": now, "updated_at": now, "title": title,
+                                       "author": author, "isbn": isbn, "is_checked_out": False, "due_date": None,
+                                       "total_copies": 0, "available_copies": 0}
+                self.isbns[normalize_isbn(isbn)] = book_id
+                bisect.insort(self.order, (title, book_id))
+                bisect.insort(self.changes, (now, book_id))
+                self.copies[book_id] = {}
+                self.available[book_id] = []
+            book = self.books[book_id]
+            for copy_id in new_copies:
+                self.copies[book_id][copy_id] = None
+                self.available[book_id].append(copy_id)
+            book.update(total_copies=book["total_copies"] + copies, available_copies=book["available_copies"] + copies,
+                        is_checked_out=False, due_date=None)
+            self.touch(book_id, now)
+            return dict(book)
+
+    def start_import(self) -> "MemoryImport":
+        return MemoryImport(self)
+
+    def claim_book(self, book_id: str, user_id: str, due_date):
+        claimed, _ = self.claim_books([book_id], user_id, due_date)
+        return claimed.get(canonical_id(book_id))
+
+    def claim_books(self, book_ids: list, user_id: str, due_date) -> tuple[dict, set]:
+        book_ids = [canonical_id(book_id) for book_id in book_ids]
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        with self.lock:
+            loans = self.loans.get(user_id, {})
+            # one copy per user, like ux_checkout_logs_open_book_user
+            held = {book_id for book_id in book_ids if book_id in loans}
+            claimed = {}
+            for book_id in book_ids:
+                if book_id in held or not self.available.get(book_id):
+                    continue
+                copy_id = self.available[book_id].pop()
+                self.copies[book_id][copy_id] = due_date
+                self.loans.setdefault(user_id, {})[book_id] = copy_id
+                bisect.insort(self.due, (due_date, copy_id))
+                self.borrowers[copy_id] = (book_id, user_id, now)
+                self.borrowed.add((user_id, book_id))
+                self.count_loan(now.date(), book_id, 0, 1)
+                book = self.books[book_id]
+                book["available_copies"] -= 1
+                if book["available_copies"] == 0:
+                    book["is_checked_out"] = True
+                    book["due_date"] = min(self.copies[book_id].values())
+                self.touch(book_id, now)
+                claimed[book_id] = due_date
+            return claimed, held
+
+    def checkin_books(self, book_ids: list, user_id: str) -> set:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        returned = set()
+        with self.lock:
+            loans = self.loans.get(user_id, {})
+            for book_id in book_ids:
+                book_id = canonical_id(book_id)
+                copy_id = loans.pop(book_id, None)
+                if copy_id is None:
+                    continue
+                del self.due[bisect.bisect_left(self.due, (self.copies[book_id][copy_id], copy_id))]
+                _, _, checkout_date = self.borrowers.pop(copy_id)
+                self.count_loan(now.date(), book_id, 1, 1, (now - checkout_date).total_seconds())
+                self.copies[book_id][copy_id] = None
+                self.available[book_id].append(copy_id)
+                book = self.books[book_id]
+                book.update(available_copies=book["available_copies"] + 1, is_checked_out=False, due_date=None)
+                self.touch(book_id, now)
+                returned.add(book_id)
+            if not loans:
+                self.loans.pop(user_id, None)
+        return returned
+
+    def touch(self, book_id: str, now: datetime) -> None:
+        """Sets a book's updated_at, like the books_updated_at trigger"""
+        book = self.books[book_id]
+        del self.changes[bisect.bisect_left(self.changes, (book["updated_at"], book_id))]
+        book["updated_at"] = max(now, book["updated_at"])
+        bisect.insort(self.changes, (book["updated_at"], book_id))
+
+    def book_changes(self, after: list | None, limit: int) -> tuple[list, datetime]:
+        # every change is made under the lock, so a change is complete as soon as it is made
+        with self.lock:
+            until = datetime.now(timezone.utc).replace(tzinfo=None)
+            if after is None:
+                return [], until
+            if after[1] is None:
+                start = bisect.bisect_left(self.changes, (after[0],))
+            else:
+                start = bisect.bisect_right(self.changes, (after[0], after[1]))
+            end = bisect.bisect_left(self.changes, (until,))
+            return [{**self.books[book_id], "changed_at": changed_at}
+                    for changed_at, book_id in self.changes[start:min(end, start + limit)]], until
+
+    def count_loan(self, day: date, book_id: str, column: int, count: int, loan_seconds: float = 0.0) -> None:
+        """Adds a checkout (column 0) or return (column 1) to the rollups of a day"""
+        for key, rollup in ((day, self.daily), ((day, book_id), self.book_daily)):
+            stats = rollup.setdefault(key, [0, 0, 0.0])
+            stats[column] += count
+            stats[2] += loan_seconds
+
+    def daily_stats(self, start: date, end: date) -> list:
+        with self.lock:
+            days = sorted((day, stats) for day, stats in self.daily.items() if start <= day <= end)
+        return [{"day": day, "checkouts": checkouts, "returns": returns, "loan_seconds": loan_seconds}
+                for day, (checkouts, returns, loan_seconds) in days]
+
+    def popular_books(self, start: date, end: date, limit: int) -> list:
+        checkouts = {}  # book id -> checkouts
+        with self.lock:
+            for (day, book_id), stats in self.book_daily.items():
+                if start <= day <= end and stats[0]:
+                    checkouts[book_id] = checkouts.get(book_id, 0) + stats[0]
+            top = sorted(checkouts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+            return [{"id": book_id, "title": self.books[book_id]["title"], "author": self.books[book_id]["author"],
+                     "isbn": self.books[book_id]["isbn"], "checkouts": count} for book_id, count in top]
+
+    def loan_pairs(self, batch_size: int):
+        with self.lock:
+            pairs = list(self.borrowed)
+        for i in range(0, len(pairs), batch_size):
+            yield pairs[i:i + batch_size]
+
+    def availability(self, book_ids: list) -> list:
+        with self.lock:
+            books = (self.books.get(canonical_id(book_id)) for book_id in book_ids)
+            return [{"id": book["id"], "available_copies": book["available_copies"],
+                     "total_copies": book["total_copies"], "updated_at": book["updated_at"]}
+                    for book in books if book is not None]
+
+    def add_user(self, supabase_id: str) -> None:
+        with self.lock:
+            self.users.add(supabase_id)
+
+
+class MemoryImport(BookImport):
+    """Collects the rows, and adds the books whose ISBN isn't in the catalog when finished"""
+
+    def __init__(self, storage: MemoryStorage):
+        self.storage = storage
+        self.rows = []
+
+    def add(self, rows: list) -> None:
+        self.rows.extend(rows)
+
+    def finish(self) -> int:
+        inserted = 0
+        with self.storage.lock:
+            for title, author, isbn in self.rows:
+                if normalize_isbn(isbn) not in self.storage.isbns:
+                    self.storage.add_book_copies(title, author, isbn, 1)
+                    inserted += 1
+        return inserted
+
+    def abort(self) -> None:
+        self.rows = []
@@ -4,10 +4,65 @@ from PyQt6.QtWidgets import *
 from PyQt6.QtCore import *
 from PyQt6.QtGui import *
 from login_dialog import LoginDialog
-from datetime import datetime, timedelta
 import os
 import requests
 import json
+from datetime import datetime
+
+
+class EventListener(QThread):
+    """Listens to the server's availability events on a background thread, reconnecting when
+    the connection drops, and emits each of them as a signal"""
+
+    availability_changed = pyqtSignal(dict)
+    reset = pyqtSignal()
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self.last_event_id = None
+        self.response = None
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            headers = {"Last-Event-ID": self.last_event_id} if self.last_event_id else {}
+            try:
+                # the server sends a heartbeat every 15 seconds, a minute of silence is a dead connection
+                self.response = requests.get(self.url, headers=headers, stream=True, timeout=(10, 60))
+                self.read_events(self.response.iter_lines(chunk_size=None, decode_unicode=True))
+            except (requests.RequestException, OSError):
+                pass
+            if not self.stopped:
+                self.msleep(3000)
+
+    def read_events(self, lines):
+        """Emits the events in the lines of a text/event-stream"""
+        name, data = "message", ""
+        for line in lines:
+            if line.startswith(":"):
+                continue  # heartbeat
+            if line == "":
+                if name == "availability":
+                    self.availability_changed.emit(json.loads(data))
+                elif name == "reset":
+                    self.reset.emit()
+                name, data = "message", ""
+                continue
+            field, _, value = line.partition(":")
+            value = value.removeprefix(" ")
+            if field == "id":
+                self.last_event_id = value
+            elif field == "event":
+                name = value
+            elif field == "data":
+                data += value
+
+    def stop(self):
+        self.stopped = True
+        if self.response is not None:
+            self.response.close()
+        self.wait(1000)
 
 
 class MainWindow(QMainWindow):
@@ -77,6 +132,12 @@ class MainWindow(QMainWindow):
         )
         self.searchbox.textChanged.connect(self.changed_search)
 
+        # search the server once typing pauses instead of on every keystroke
+        self.search_timer = QTimer()
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(300)
+        self.search_timer.timeout.connect(self.search_books)
+
         # Home Button
         self.home_button = QPushButton("Home")
         self.home_button.setStyleSheet(
@@ -114,32 +175,34 @@ class MainWindow(QMainWindow):
         self.header.addWidget(self.login_button)
 
         # Table of books
+        self.page_size = 100
+        self.next_cursor = None
+        self.books_etag = None
+        self.last_loaded_book = None  # (title, id) of the last book of the pages loaded
+        # the catalog's since is taken before loading it, so no change is missed in between
+        self.changes_since = None
+        self.get_book_changes()
         books = self.get_books()
         self.books_table = QTableWidget()
-        self.books_table.setRowCount(len(books))
-        self.books_table.setColumnCount(4)
-        self.books_table.setHorizontalHeaderLabels(["Title", "Author", "ISBN", " "])
-        for i, book in enumerate(books):
-            self.books_table.setItem(i, 0, QTableWidgetItem(f"{book["title"]}"))
-            self.books_table.setItem(i, 1, QTableWidgetItem(f"{book["author"]}"))
-            self.books_table.setItem(i, 2, QTableWidgetItem(f"{book["isbn"]}"))
-
-            if book["is_checked_out"] == True:
-                self.checkout_button = QPushButton("unavailable")
-                self.checkout_button.setEnabled(False)
-                self.checkout_button.setStyleSheet(
-                    "background-color: red; color: white;"
-                )
-                self.books_table.setCellWidget(i, 3, self.checkout_button)
-            else:
-                self.checkout_button = QPushButton("Check Out")
-                self.checkout_button.setEnabled(True)
-                self.checkout_button.setStyleSheet(
-                    "background-color: black; color: white;"
-                )
-                self.checkout_button.setProperty("book_id", book["id"])
-                self.checkout_button.clicked.connect(self.clicked_checkout)
-                self.books_table.setCellWidget(i, 3, self.checkout_button)
+        self.books_table.setColumnCount(5)
+        self.books_table.setHorizontalHeaderLabels(["Title", "Author", "ISBN", "Available", " "])
+        self.add_book_rows(books)
+        # load the next page of books when the table is scrolled to the bottom
+        self.books_table.verticalScrollBar().valueChanged.connect(self.scrolled_books)
+
+        # fetch only what changed in the catalog every 30 seconds to keep the table up to date
+        self.refresh_timer = QTimer()
+        self.refresh_timer.setInterval(30000)
+        self.refresh_timer.timeout.connect(self.refresh_books)
+        self.refresh_timer.start()
+
+        # books checked out or returned by anyone are updated in their row as it happens,
+        # a reset means events were missed, so the changes are fetched instead
+        self.event_listener = EventListener("https://lms.murtsa.dev/events")
+        #self.event_listener = EventListener("http://127.0.0.1:8000/events")
+        self.event_listener.availability_changed.connect(self.update_book_availability)
+        self.event_listener.reset.connect(self.refresh_books)
+        self.event_listener.start()
 
         self.books_table.resizeColumnsToContents()
         self.books_table.resizeRowsToContents()
@@ -161,6 +224,7 @@ class MainWindow(QMainWindow):
         header.setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
         header.setSectionResizeMode(1, QHeaderView.ResizeMode.ResizeToContents)
         header.setSectionResizeMode(2, QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(3, QHeaderView.ResizeMode.ResizeToContents)
 
         # Table of books style sheet
         self.books_table.setStyleSheet(
@@ -195,7 +259,6 @@ class MainWindow(QMainWindow):
         self.books_table.resizeRowsToContents()
 
         # Checked out books table
-        books = self.get_books()
         self.my_books_table = QTableWidget()
         self.my_books_table.setColumnCount(4)
         self.my_books_table.setHorizontalHeaderLabels(
@@ -204,6 +267,13 @@ class MainWindow(QMainWindow):
         self.my_books_table.resizeColumnsToContents()
         self.my_books_table.resizeRowsToContents()
         self.my_books_table.sortByColumn(0, Qt.SortOrder(0))
+        # several rows can be selected and returned together
+        self.my_books_table.setSelectionBehavior(
+            QAbstractItemView.SelectionBehavior.SelectRows
+        )
+        self.my_books_table.setSelectionMode(
+            QAbstractItemView.SelectionMode.ExtendedSelection
+        )
 
         # books_table container to add side padding
         books_table_container = QWidget()
@@ -245,11 +315,20 @@ class MainWindow(QMainWindow):
             self.secondary_color = default_colors["secondary"]
 
     # methods
-    def get_books(self) -> list:
-        """This function gets the books from the database and returns the result as a list"""
-        response = requests.get("https://lms.murtsa.dev/books")
-        #response = requests.get("http://127.0.0.1:8000/books")
-
+    def get_books(self, cursor=None, etag=None) -> list:
+        """This function gets a page of books from the database and returns the result as a list.
+        Returns None if etag is given and the page hasn't changed"""
+        params = {"limit": self.page_size}
+        if cursor:
+            params["cursor"] = cursor
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        response = requests.get("https://lms.murtsa.dev/books", params=params, headers=headers)
+        #response = requests.get("http://127.0.0.1:8000/books", params=params, headers=headers)
+
+        if response.status_code == 304:
+            return None
         try:
             data = response.json()
         except json.JSONDecodeError:
@@ -261,10 +340,39 @@ class MainWindow(QMainWindow):
             )
             return []
         books = data["data"]
-        if books == []:
+        self.next_cursor = data.get("next_cursor")
+        if cursor is None:
+            self.books_etag = response.headers.get("ETag")
+        if books:
+            self.last_loaded_book = (books[-1]["title"], books[-1]["id"])
+        if books == [] and cursor is None:
             QMessageBox.warning(self, "Error", "There was a connection error")
         return books
 
+    def get_book_changes(self) -> tuple[list, list]:
+        """Returns the books changed and the ids of the books deleted since the last call.
+        The first call returns nothing, it only gets the since of the catalog as it is now."""
+        changed, deleted = [], []
+        while True:
+            params = {"since": self.changes_since} if self.changes_since else {}
+            try:
+                response = requests.get("https://lms.murtsa.dev/books/changes", params=params)
+                #response = requests.get("http://127.0.0.1:8000/books/changes", params=params)
+                data = response.json()
+            except (requests.RequestException, json.JSONDecodeError):
+                # the next refresh tries again from the same since
+                return changed, deleted
+            if "error" in data:
+                # start again from the catalog as it is now
+                self.changes_since = None
+                return changed, deleted
+            if self.changes_since:
+                changed.extend(data["data"])
+                deleted.extend(data["deleted"])
+            self.changes_since = data["since"]
+            if not data["has_more"]:
+                return changed, deleted
+
     def get_my_books(self) -> list:
         """Gets the books the user has checked out and returns it as a list"""
         if self.is_logged_in() == False:
@@ -333,33 +441,137 @@ class MainWindow(QMainWindow):
         except FileNotFoundError:
             return False
 
+    def add_book_rows(self, books, sort=True):
+        """Adds a row to the table of books for each book in the list"""
+        self.books_table.setSortingEnabled(False)
+        start = self.books_table.rowCount()
+        self.books_table.setRowCount(start + len(books))
+        for i, book in enumerate(books, start):
+            self.set_book_row(i, book)
+        self.books_table.resizeColumnsToContents()
+        self.books_table.resizeRowsToContents()
+        self.books_table.setSortingEnabled(sort)
+
+    def set_book_row(self, i, book):
+        """Shows a book in row i of the table of books"""
+        title = QTableWidgetItem(f"{book["title"]}")
+        title.setData(Qt.ItemDataRole.UserRole, book["id"])
+        self.books_table.setItem(i, 0, title)
+        self.books_table.setItem(i, 1, QTableWidgetItem(f"{book["author"]}"))
+        self.books_table.setItem(i, 2, QTableWidgetItem(f"{book["isbn"]}"))
+        self.set_book_availability(i, book)
+
+    def set_book_availability(self, i, book):
+        """Shows the available copies of a book and its checkout button in row i of the table of books"""
+        copies = QTableWidgetItem(f"{book["available_copies"]}/{book["total_copies"]}")
+        # when the counters were written, so older availability events can be told apart
+        copies.setData(Qt.ItemDataRole.UserRole, book.get("updated_at"))
+        self.books_table.setItem(i, 3, copies)
+        if book["available_copies"] == 0:
+            self.checkout_button = QPushButton("unavailable")
+            self.checkout_button.setEnabled(False)
+            self.checkout_button.setStyleSheet(
+                "background-color: red; color: white;"
+            )
+            self.books_table.setCellWidget(i, 4, self.checkout_button)
+        else:
+            self.checkout_button = QPushButton("Check Out")
+            self.checkout_button.setEnabled(True)
+            self.checkout_button.setStyleSheet(
+                "background-color: black; color: white;"
+            )
+            self.checkout_button.setProperty("book_id", book["id"])
+            self.checkout_button.clicked.connect(self.clicked_checkout)
+            self.books_table.setCellWidget(i, 4, self.checkout_button)
+
     def update_book_list(self):
-        """Updates the table of books on the home page"""
-        books = self.get_books()
+        """Reloads the table of books on the home page starting from the first page"""
+        books = self.get_books(etag=self.books_etag)
+        if books is None:
+            # the catalog hasn't changed since the table was loaded
+            return
+        self.books_table.setRowCount(0)
+        self.add_book_rows(books)
+
+    def refresh_books(self):
+        """Applies the changes made to the catalog since the last refresh to the table of books"""
+        changed, deleted = self.get_book_changes()
+        if not changed and not deleted:
+            return
+        rows = self.book_table_rows()
+        searching = self.searchbox.text().strip() != ""
         self.books_table.setSortingEnabled(False)
-        for i, book in enumerate(books):
-            self.books_table.setItem(i, 0, QTableWidgetItem(f"{book["title"]}"))
-            self.books_table.setItem(i, 1, QTableWidgetItem(f"{book["author"]}"))
-            self.books_table.setItem(i, 2, QTableWidgetItem(f"{book["isbn"]}"))
-            if book["is_checked_out"] == True:
-                self.checkout_button = QPushButton("unavailable")
-                self.checkout_button.setEnabled(False)
-                self.checkout_button.setStyleSheet(
-                    "background-color: red; color: white;"
-                )
-                self.books_table.setCellWidget(i, 3, self.checkout_button)
-            else:
-                self.checkout_button = QPushButton("Check Out")
-                self.checkout_button.setEnabled(True)
-                self.checkout_button.setStyleSheet(
-                    "background-color: black; color: white;"
-                )
-                self.checkout_button.setProperty("book_id", book["id"])
-                self.checkout_button.clicked.connect(self.clicked_checkout)
-                self.books_table.setCellWidget(i, 3, self.checkout_button)
+        for row in sorted((rows[book_id] for book_id in deleted if book_id in rows), reverse=True):
+            self.books_table.removeRow(row)
+        rows = self.book_table_rows()
+        for book in changed:
+            if book["id"] in rows:
+                self.set_book_row(rows[book["id"]], book)
+            elif not searching and (
+                self.next_cursor is None
+                or (book["title"], book["id"]) <= self.last_loaded_book
+            ):
+                # a new book among the pages loaded, later books come with their page
+                row = self.books_table.rowCount()
+                self.books_table.setRowCount(row + 1)
+                self.set_book_row(row, book)
         self.books_table.resizeColumnsToContents()
         self.books_table.resizeRowsToContents()
-        self.books_table.setSortingEnabled(True)
+        self.books_table.setSortingEnabled(not searching)
+
+    def update_book_availability(self, book):
+        """Updates the row of a book checked out or returned, if it is in the table of books"""
+        row = self.book_table_rows().get(book["id"])
+        if row is None:
+            return
+        shown = self.books_table.item(row, 3)
+        shown = shown.data(Qt.ItemDataRole.UserRole) if shown is not None else None
+        if shown and book.get("updated_at") and (
+            datetime.fromisoformat(book["updated_at"]) < datetime.fromisoformat(shown)
+        ):
+            # published after a newer event of the book
+            return
+        sorting = self.books_table.isSortingEnabled()
+        self.books_table.setSortingEnabled(False)
+        self.set_book_availability(row, book)
+        self.books_table.setSortingEnabled(sorting)
+
+    def book_table_rows(self) -> dict:
+        """Returns the row of each book in the table of books by its id"""
+        rows = {}
+        for row in range(self.books_table.rowCount()):
+            item = self.books_table.item(row, 0)
+            if item is not None:
+                rows[item.data(Qt.ItemDataRole.UserRole)] = row
+        return rows
+
+    def search_books(self):
+        """Replaces the table of books with the server's search results, best matches first"""
+        text = self.searchbox.text().strip()
+        if text == "":
+            self.update_book_list()
+            return
+        response = requests.get(
+            "https://lms.murtsa.dev/books/search",
+            params={"q": text, "limit": self.page_size},
+        )
+        #response = requests.get("http://127.0.0.1:8000/books/search", params={"q": text, "limit": self.page_size})
+
+        try:
+            data = response.json()
+        except json.JSONDecodeError:
+            QMessageBox.warning(self, "Error", "Failed to decode JSON response.")
+            return
+        if "error" in data:
+            QMessageBox.warning(
+                self, "Error", f"Error searching books: {data['error']['message']}"
+            )
+            return
+        # search results are not paged by scrolling, and the table no longer holds the catalog
+        self.next_cursor = None
+        self.books_etag = None
+        self.books_table.setRowCount(0)
+        self.add_book_rows(data["data"], sort=False)
 
 
     def update_my_books_list(self):
@@ -367,22 +579,22 @@ class MainWindow(QMainWindow):
         books = self.get_my_books()
         self.my_books_table.setSortingEnabled(False)
         self.my_books_table.setRowCount(len(books))
-        current_date = datetime.now()
-        fourteen_days_ago = current_date - timedelta(days=14)
 
         for i, book in enumerate(books):
 
             due_date = book.get("due_date", "N/A")
-            date_format = "%Y-%m-%d"
-            due_date_object = datetime.strptime(due_date, date_format)
             self.my_books_table.setItem(i, 0, QTableWidgetItem(f"{book["title"]}"))
             self.my_books_table.setItem(i, 1, QTableWidgetItem(f"{book["author"]}"))
             self.my_books_table.setItem(i, 2, QTableWidgetItem(f"{str(due_date)}"))
-            if due_date_object < fourteen_days_ago:
+            # the server works out which loans are overdue
+            if book.get("is_overdue"):
                 self.return_button = QPushButton("Return (Late)")
             else:
                 self.return_button = QPushButton("Return")
             self.return_button.setProperty("book_id", book["id"])
+            self.return_button.setToolTip(
+                "Select several rows to return them together"
+            )
             self.return_button.setStyleSheet(
                 "QPushButton {background-color: #FFFFFF; color: black; } QPushButton:hover {background-color: #DDDDDD; color: black; }"
             )
@@ -398,24 +610,27 @@ class MainWindow(QMainWindow):
 
     # event handlers
 
+    def scrolled_books(self, value):
+        """Loads the next page of books when the table of books is scrolled to the bottom"""
+        if value < self.books_table.verticalScrollBar().maximum() or not self.next_cursor:
+            return
+        books = self.get_books(self.next_cursor)
+        self.add_book_rows(books)
+
     def changed_search(self):
-        """Updates the selected item in the tables when text is entered into the search box"""
+        """Searches the books on the server and highlights matches in my books when text is entered into the search box"""
         text = self.searchbox.text()
         if text == "":
-            self.books_table.setCurrentItem(None)
             self.my_books_table.setCurrentItem(None)
-
-        matching_items1 = self.books_table.findItems(text, Qt.MatchFlag.MatchContains)
-        if matching_items1:
-            # we have found something
-            item = matching_items1[0]  # take the first
-            self.books_table.setCurrentItem(item)
-        matching_items2 = self.my_books_table.findItems(
-            text, Qt.MatchFlag.MatchContains
-        )
-        if matching_items2:
-            item = matching_items2[0]
-            self.my_books_table.setCurrentItem(item)
+        else:
+            matching_items = self.my_books_table.findItems(
+                text, Qt.MatchFlag.MatchContains
+            )
+            if matching_items:
+                item = matching_items[0]  # take the first
+                self.my_books_table.setCurrentItem(item)
+        # restart the timer so the search runs once typing pauses
+        self.search_timer.start()
 
     def clicked_login(self):
         """Spawns the login dialog and updates the login button"""
@@ -479,7 +694,6 @@ class MainWindow(QMainWindow):
         #response = requests.put('http://127.0.0.1:8000/checkout', headers=headers, json=payload)
         if response.status_code == 200:
             QMessageBox.information(self, "Info", response.text.strip('"'))
-            self.update_book_list()
         else:
             QMessageBox.warning(
                 self, "Error", "Failed to checkout book. {response.text}"
@@ -494,6 +708,11 @@ class MainWindow(QMainWindow):
         if not book_id:
             QMessageBox.warning(self, "Error", "Could not determine book to return")
             return
+        # return every selected book if the clicked book is part of a multi selection
+        selected_ids = self.selected_my_book_ids()
+        if book_id in selected_ids and len(selected_ids) > 1:
+            self.return_books(selected_ids)
+            return
         user_id = requests.get("https://lms.murtsa.dev/user", headers=headers)
         #user_id = requests.get('http://127.0.0.1:8000/user', headers=headers)
         if user_id.status_code != 200:
@@ -509,7 +728,6 @@ class MainWindow(QMainWindow):
         #response = requests.put('http://127.0.0.1:8000/return', headers=headers, json=payload)
         if response.status_code == 200:
             QMessageBox.information(self, "Info", response.text.strip('"'))
-            self.update_book_list()
             if self.my_books_table.rowCount() > 1:
                 self.update_my_books_list()
             else:
@@ -524,6 +742,47 @@ class MainWindow(QMainWindow):
 
         return
 
+    def selected_my_book_ids(self) -> list:
+        """Returns the ids of the books in the selected rows of the my books table"""
+        book_ids = []
+        for index in self.my_books_table.selectionModel().selectedRows():
+            button = self.my_books_table.cellWidget(index.row(), 3)
+            if button is not None and button.property("book_id"):
+                book_ids.append(button.property("book_id"))
+        return book_ids
+
+    def return_books(self, book_ids):
+        """Returns several books for the logged-in user in one request"""
+        headers = {"Authorization": token, "Content-Type": "application/json"}
+        response = requests.put(
+            "https://lms.murtsa.dev/return/batch",
+            headers=headers,
+            json={"book_ids": book_ids},
+        )
+        #response = requests.put('http://127.0.0.1:8000/return/batch', headers=headers, json={"book_ids": book_ids})
+        if response.status_code == 200:
+            results = response.json()["results"]
+            returned = [result for result in results if result["status"] == "returned"]
+            message = f"{len(returned)} of {len(results)} books successfully returned"
+            failed = [f"{result['book_id']}: {result['message']}" for result in results if result["status"] != "returned"]
+            if failed:
+                message += "\n\n" + "\n".join(failed)
+            QMessageBox.information(self, "Info", message)
+            if len(returned) < self.my_books_table.rowCount():
+                self.update_my_books_list()
+            else:
+                self.my_books_table.setRowCount(0)
+        else:
+            QMessageBox.warning(
+                self,
+                "Error",
+                f"\nFailed to return books. Status code: {response.status_code}, Response: {response.text}\n",
+            )
+
+    def closeEvent(self, event):
+        self.event_listener.stop()
+        super().closeEvent(event)
+
     def clicked_home(self):
         """Changes the page to the home menu"""
         self.stacked_layout.setCurrentIndex(0)
@@ -0,0 +1,238 @@
+'''Tests that need a real PostgreSQL database
+Set TEST_DATABASE_URL to an empty database to run them, the migrations are applied to it first'''
+
+import os
+import inspect
+import json
+import queue
+import re
+import time
+from datetime import date, datetime
+import pytest
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, event, text
+
+import backfill_stats
+import invalidation
+import storage
+
+database_url = os.getenv("TEST_DATABASE_URL")
+# a second empty database, standing in for a read replica that hasn't replayed any write
+replica_url = os.getenv("TEST_REPLICA_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not database_url, reason="TEST_DATABASE_URL is not set")
+
+alembic_ini = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "backend", "alembic.ini"))
+
+
+@pytest.fixture(scope="module")
+def engine():
+    os.environ["SUPABASE_DATABASE_URL"] = database_url  # read by migrations/env.py
+    command.upgrade(Config(alembic_ini), "head")
+    engine = create_engine(database_url)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def replica_engine(engine):
+    if not replica_url:
+        pytest.skip("TEST_REPLICA_DATABASE_URL is not set")
+    os.environ["SUPABASE_DATABASE_URL"] = replica_url
+    try:
+        command.upgrade(Config(alembic_ini), "head")
+    finally:
+        os.environ["SUPABASE_DATABASE_URL"] = database_url
+    replica_engine = create_engine(replica_url)
+    yield replica_engine
+    replica_engine.dispose()
+
+
+def query_plan(engine, query: str, params: dict) -> str:
+    """Returns the plan of a query as JSON text, with sequential scans disabled so that
+    the planner picks an index whenever one can be used, even on an empty table"""
+    with engine.connect() as connection:
+        connection.execute(text("SET enable_seqscan = off"))
+        plan = connection.execute(text("EXPLAIN (FORMAT JSON) " + query), params).scalar()
+    return json.dumps(plan)
+
+
+def storage_plan(engine, call) -> str:
+    """Runs call, and returns the plans of the statements it ran on engine as JSON text, planned
+    like query_plan with the parameters they were run with"""
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        result = call()
+        if inspect.isgenerator(result):
+            list(result)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert statements
+    with engine.connect() as connection:
+        connection.execute(text("SET enable_seqscan = off"))
+        plans = [connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+                 for statement, parameters in statements]
+    return json.dumps(plans)
+
+
+USER_ID = "0b6f8a3e-3c1f-4c57-9d0e-5f3f1a6c2b11"
+BOOK_ID = "8d2e41c7-51a2-4f0e-b1d9-7e6a0c9f4d22"
+
+
+def test_my_books_uses_open_loans_index(engine):
+    store = storage.PostgresStorage(engine)
+    plan = storage_plan(engine, lambda: store.my_books(USER_ID, date(2026, 3, 1)))
+    # both open loan indexes lead with user_id
+    assert any(index in plan for index in ["ix_checkout_logs_open_user", "ux_checkout_logs_open_book_user"])
+
+
+def test_return_uses_open_loans_index(engine):
+    store = storage.PostgresStorage(engine)
+    plan = storage_plan(engine, lambda: store.checkin_books([BOOK_ID], USER_ID))
+    assert "Seq Scan" not in plan
+    assert any(index in plan for index in ["ux_checkout_logs_open_book_user", "ix_checkout_logs_open_user"])
+
+
+def test_copy_pick_uses_available_copies_index(engine):
+    store = storage.PostgresStorage(engine)
+    plan = storage_plan(engine, lambda: store.claim_book(BOOK_ID, USER_ID, date(2026, 3, 15)))
+    assert "ix_book_copies_available" in plan
+    plan = storage_plan(engine, lambda: store.claim_books([BOOK_ID], USER_ID, date(2026, 3, 15)))
+    assert "ix_book_copies_available" in plan and "ux_checkout_logs_open_book_user" in plan
+
+
+def test_add_book_copies_uses_normalized_isbn_index(engine):
+    # the statement is the body of the add_book_copies function, planned as it is in the database
+    with engine.connect() as connection:
+        body = connection.execute(text("select prosrc from pg_proc where proname = 'add_book_copies'")).scalar()
+    arguments = {"new_title": "text", "new_author": "text", "new_isbn": "text", "copies": "integer"}
+    body = re.sub(r"\b(%s)\b" % "|".join(arguments), lambda match: f"cast(:{match[1]} as {arguments[match[1]]})", body)
+    params = {"new_title": "Dune", "new_author": "A", "new_isbn": "0441172717", "copies": 1}
+    assert "ux_books_isbn_normalized" in query_plan(engine, body, params)
+
+
+def test_add_user_uses_supabase_id_index(engine):
+    store = storage.PostgresStorage(engine)
+    assert "ux_users_supabase_id" in storage_plan(engine, lambda: store.add_user(USER_ID))
+
+
+def test_books_page_uses_title_id_index(engine):
+    store = storage.PostgresStorage(engine)
+    assert "ix_books_title_id" in storage_plan(engine, lambda: store.books_page(100, ["Dune", BOOK_ID]))
+
+
+def test_overdue_page_uses_due_date_index(engine):
+    store = storage.PostgresStorage(engine)
+    plan = storage_plan(engine, lambda: store.overdue_loans(date(2026, 3, 16), 100, [date(2026, 3, 1), BOOK_ID]))
+    assert "ix_book_copies_due_date" in plan
+
+
+def test_backfill_matches_live_rollups(engine):
+    store = storage.PostgresStorage(engine)
+    with engine.begin() as connection:
+        user_id = str(connection.execute(text("insert into users (supabase_id) values (uuid_generate_v4()) returning id")).scalar())
+    book_ids = [store.add_book_copies(title, "A", isbn, 2)["id"] for title, isbn in [("Rollup 1", "R-1"), ("Rollup 2", "R-2")]]
+    store.claim_books(book_ids, user_id, date(2026, 3, 15))
+    store.checkin_books(book_ids[:1], user_id)
+
+    start, end = date(2000, 1, 1), date(2100, 1, 1)
+    live = store.daily_stats(start, end), store.popular_books(start, end, 10)
+    backfill_stats.backfill(engine)
+    assert (store.daily_stats(start, end), store.popular_books(start, end, 10)) == live
+    assert [book["checkouts"] for book in live[1]] == [1, 1]
+
+
+def test_claim_books_skips_held_books(engine):
+    store = storage.PostgresStorage(engine)
+    with engine.begin() as connection:
+        user_id = str(connection.execute(text("insert into users (supabase_id) values (uuid_generate_v4()) returning id")).scalar())
+    held, free = [store.add_book_copies(title, "A", isbn, 2)["id"] for title, isbn in [("Held 1", "7001"), ("Held 2", "7002")]]
+    store.claim_books([held], user_id, date(2026, 3, 15))
+    claimed, already = store.claim_books([held, free], user_id, date(2026, 3, 15))
+    assert (list(claimed), already) == ([str(free)], {str(held)})
+    assert {book["available_copies"] for book in store.availability([held, free])} == {1}
+
+
+def test_book_changes_use_updated_at_index(engine):
+    store = storage.PostgresStorage(engine)
+    plan = storage_plan(engine, lambda: store.book_changes([datetime(2026, 3, 1), BOOK_ID], 500))
+    assert "ix_books_updated_at_id" in plan and "ix_book_tombstones_deleted_at_id" in plan
+
+
+def test_book_changes_wait_for_running_transactions(engine):
+    store = storage.PostgresStorage(engine)
+    _, since = store.book_changes(None, 500)
+    with engine.connect() as slow:
+        # a long import: its book is written first, but only committed after a later change
+        slow.execute(text("insert into books (title, author, isbn) values ('Slow', 'A', '7101')"))
+        store.add_book_copies("Fast", "A", "7102", 1)
+        changes, until = store.book_changes([since, None], 500)
+        assert "Fast" not in [change["title"] for change in changes]
+        slow.commit()
+    changes, _ = store.book_changes([until, None], 500)
+    assert [change["title"] for change in changes] == ["Slow", "Fast"]
+
+
+def test_deleted_books_leave_tombstones(engine):
+    with engine.begin() as connection:
+        book_id = connection.execute(text("insert into books (title, author, isbn) values ('Gone', 'A', '978-0-00-999999-1') returning id")).scalar()
+        updated_at = connection.execute(text("select updated_at from books where id = :id"), {"id": book_id}).scalar()
+        connection.execute(text("delete from books where id = :id"), {"id": book_id})
+        deleted_at = connection.execute(text("select deleted_at from book_tombstones where book_id = :id"), {"id": book_id}).scalar()
+    assert deleted_at > updated_at
+
+
+def test_invalidation_bus_reaches_other_processes(engine):
+    received = queue.SimpleQueue()
+    buses = [invalidation.InvalidationBus(engine, origin, received.put) for origin in ["a", "b"]]
+    for bus in buses:
+        bus.start()
+    try:
+        # the listeners may not be listening yet, notifications sent before then are lost
+        for _ in range(50):
+            buses[0].publish("catalog")
+            try:
+                received.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        time.sleep(0.2)
+        while not received.empty():
+            received.get()
+
+        book_ids = [f"00000000-0000-0000-0000-{i:012d}" for i in range(150)]
+        buses[0].publish("checkout", user_id=USER_ID, book_ids=book_ids)
+        messages = [received.get(timeout=5), received.get(timeout=5)]
+    finally:
+        for bus in buses:
+            bus.stop()
+    # split to fit in a NOTIFY payload, and not sent back to the process that sent it
+    assert [message["book_ids"] for message in messages] == [book_ids[:100], book_ids[100:]]
+    assert {(message["origin"], message["kind"], message["user_id"]) for message in messages} == {("a", "checkout", USER_ID)}
+    assert received.empty()
+
+
+def test_reads_go_to_replica_unless_the_user_just_wrote(engine, replica_engine):
+    store = storage.PostgresStorage(engine, replica_engine, sticky_seconds=0.5)
+    with engine.begin() as connection:
+        user_id, other_id = [str(connection.execute(text("insert into users (supabase_id) values (uuid_generate_v4()) returning id")).scalar())
+                             for _ in range(2)]
+    assert store.is_settled()
+    book = store.add_book_copies("Replicated", "A", "978-0-00-999999-2", 1)
+    assert not store.is_settled()
+    # the replica doesn't have the book, so the catalog read from it doesn't either
+    assert "Replicated" not in [row["title"] for row in store.books_page(500, None)]
+
+    assert store.claim_book(str(book["id"]), user_id, date(2026, 3, 15)) is not None
+    assert [loan["title"] for loan in store.my_books(user_id, date(2026, 3, 1))] == ["Replicated"]
+    assert store.reader(other_id) is replica_engine
+    assert store.availability([str(book["id"])])[0]["available_copies"] == 0
+
+    time.sleep(0.6)
+    assert store.is_settled() and store.reader(user_id) is replica_engine
+    assert store.my_books(user_id, date(2026, 3, 1)) == []
@@ -5,21 +5,95 @@ import sys
 sys.path.insert(0, "../backend")  # Adjust the path as necessary
 
 import os
+import asyncio
+import httpx
+import json
+import threading
+import time
+import uuid
+from datetime import date, datetime
+import jwt
 import pytest
 from fastapi.testclient import TestClient
 from backend.server import app
+import backend.server as server
 from unittest.mock import patch, MagicMock, mock_open #doesn't touch real files
 import backend.main as cli
+import recommendations
 
 
 client = TestClient(app)
 
+
+@pytest.fixture(autouse=True)
+def clear_catalog_cache():
+    """Stops cached /books pages from leaking between tests"""
+    server.invalidate_catalog()
+    cli.books_cache.clear()
+    cli.books_since = None
+
 #interaction with server
 def test_hello_world_server():
     response = client.get("/")
     assert response.status_code == 200
     assert response.json() == {"message": "Hello World"}
 
+def metric_value(name: str) -> float:
+    """Returns the value of a sample in the /metrics output, 0 if it isn't there yet"""
+    for line in client.get("/metrics").text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0
+
+
+def test_metrics_count_requests_by_route():
+    sample = 'lms_http_requests_total{method="GET",route="/",status="200"}'
+    before = metric_value(sample)
+    client.get("/")
+    assert metric_value(sample) == before + 1
+    client.get("/no-such-page")
+    assert metric_value('lms_http_requests_total{method="GET",route="unmatched",status="404"}') >= 1
+
+
+def test_histogram_render():
+    histogram = server.metrics.Histogram("test_seconds", "A test", ("route",), buckets=(0.1, 1.0))
+    server.metrics.registry.remove(histogram)
+    histogram.observe(0.05, route="/a")
+    histogram.observe(0.5, route="/a")
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1.0"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 2',
+        'test_seconds_sum{route="/a"} 0.55',
+        'test_seconds_count{route="/a"} 2']
+
+
+def test_pool_wait_leaves_out_opening_connections():
+    from sqlalchemy import create_engine, event
+    engine = create_engine("sqlite://", poolclass=server.metrics.TimedQueuePool, pool_size=1, max_overflow=0)
+    server.metrics.instrument_engine(engine)
+    event.listen(engine, "do_connect", lambda *args: time.sleep(0.2))  # a slow connection handshake
+
+    with patch.object(server.metrics, "pool_wait_seconds") as pool_wait:
+        connection = engine.connect()
+        holder = threading.Timer(0.2, connection.close)  # another request holds the only connection
+        holder.start()
+        engine.connect().close()
+        holder.join()
+    opened, queued = [call.args[0] for call in pool_wait.observe.call_args_list]
+    assert opened < 0.1
+    assert queued >= 0.15
+    engine.dispose()
+
+
+@patch("backend.server.supabase")
+def test_metrics_time_supabase_calls(mock_supabase):
+    sample = 'lms_supabase_call_duration_seconds_count{call="auth.sign_out"}'
+    before = metric_value(sample)
+    client.post("/logout")
+    assert metric_value(sample) == before + 1
+
+
 def test_get_books_server():
     response = client.get("/books")
     assert response.status_code == 200
@@ -27,6 +101,801 @@ def test_get_books_server():
     assert "data" in response.json()
 
 
+def mock_books_query(mock_engine, rows):
+    """Makes every query on the patched engine return rows"""
+    connection = mock_engine.connect.return_value.__enter__.return_value
+    connection.execute.return_value.mappings.return_value.all.return_value = rows
+    return connection
+
+
+def test_cursor_round_trip():
+    cursor = server.encode_cursor(["Dune", "7f1c"])
+    assert server.decode_cursor(cursor) == ["Dune", "7f1c"]
+
+
+@patch("backend.server.store.engine")
+def test_get_books_first_page(mock_engine):
+    rows = [{"id": str(i), "title": f"Book {i}", "author": "A", "isbn": str(i), "is_checked_out": False} for i in range(3)]
+    mock_books_query(mock_engine, rows)
+    response = client.get("/books", params={"limit": 2})
+    assert response.status_code == 200
+    body = response.json()
+    assert [book["title"] for book in body["data"]] == ["Book 0", "Book 1"]
+    assert server.decode_cursor(body["next_cursor"]) == ["Book 1", "1"]
+
+
+@patch("backend.server.store.engine")
+def test_get_books_last_page(mock_engine):
+    connection = mock_books_query(mock_engine, [{"id": "9", "title": "Zen", "author": "A", "isbn": "9", "is_checked_out": False}])
+    response = client.get("/books", params={"limit": 2, "cursor": server.encode_cursor(["Book 1", BOOK_A])})
+    assert response.json()["next_cursor"] is None
+    params = connection.execute.call_args.args[1]
+    assert params == {"title": "Book 1", "id": BOOK_A, "limit": 3}
+
+
+@patch("backend.server.store.engine")
+def test_get_books_stream(mock_engine):
+    connection = mock_engine.connect.return_value.__enter__.return_value
+    result = connection.execution_options.return_value.execute.return_value
+    result.mappings.return_value.partitions.return_value = iter([
+        [{"id": "1", "title": "Dune", "author": "A", "isbn": "1"}, {"id": "2", "title": "Emma", "author": "B", "isbn": "2"}],
+        [{"id": "3", "title": "Ulysses", "author": "C", "isbn": "3"}]])
+    response = client.get("/books", headers={"Accept": "application/x-ndjson"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = response.text.splitlines()
+    assert [json.loads(line)["title"] for line in lines] == ["Dune", "Emma", "Ulysses"]
+    connection.execution_options.assert_called_once_with(stream_results=True, yield_per=server.STREAM_BATCH_SIZE)
+
+
+@patch("backend.server.store.engine")
+def test_get_books_matches_schema(mock_engine):
+    now = datetime(2026, 10, 18, 12, 30)
+    rows = [{"id": uuid.UUID(BOOK_A), "created_at": now, "updated_at": now, "title": "Dune", "author": "A",
+             "isbn": "1", "is_checked_out": True, "due_date": date(2026, 11, 1),
+             "total_copies": 2, "available_copies": 0}]
+    mock_books_query(mock_engine, rows)
+    response = client.get("/books")
+    page = server.BookPage.model_validate_json(response.content)
+    assert page.data[0].id == uuid.UUID(BOOK_A)
+    assert page.data[0].due_date == date(2026, 11, 1)
+
+
+def test_get_books_invalid_cursor():
+    response = client.get("/books", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+    assert response.json() == {"error": {"message": "Invalid cursor"}}
+    # well formed cursors whose values can't be a title and a book id
+    for values in [["Dune", "not-a-uuid"], [1, BOOK_A], ["Dune", 7], ["Dune"]]:
+        response = client.get("/books", params={"cursor": server.encode_cursor(values)})
+        assert response.status_code == 400, values
+
+
+@patch("backend.server.store.engine")
+def test_get_books_etag(mock_engine):
+    mock_books_query(mock_engine, [{"id": "1", "title": "Dune", "author": "A", "isbn": "1", "is_checked_out": False}])
+    response = client.get("/books")
+    etag = response.headers["ETag"]
+
+    cached = client.get("/books")
+    assert cached.json() == response.json()
+    assert mock_engine.connect.call_count == 1  # second page came from the cache
+
+    not_modified = client.get("/books", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+
+    server.invalidate_catalog()
+    changed = client.get("/books", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert mock_engine.connect.call_count == 2
+
+
+@patch("backend.server.store.engine")
+def test_get_books_not_cached_until_settled(mock_engine):
+    mock_books_query(mock_engine, [{"id": "1", "title": "Dune", "author": "A", "isbn": "1", "is_checked_out": False}])
+    # the catalog was just written, the replica may not have the write yet
+    with patch.object(server.store, "is_settled", return_value=False):
+        response = client.get("/books")
+        assert "ETag" not in response.headers
+        client.get("/books")
+        assert mock_engine.connect.call_count == 2
+    assert "ETag" in client.get("/books").headers
+
+
+TEST_SECRET = "test-secret-that-is-at-least-32-bytes"
+
+
+def make_token(key, algorithm="HS256", expires_in=3600, sub="ctack321", **headers):
+    claims = {"sub": sub, "aud": "authenticated", "exp": int(time.time()) + expires_in}
+    return jwt.encode(claims, key, algorithm=algorithm, headers=headers or None)
+
+
+def auth(user_id="ctack321"):
+    """Returns the header of a request made by user_id"""
+    return {"Authorization": make_token(TEST_SECRET, sub=user_id)}
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_get_user_hs256_token():
+    server.verified_tokens.clear()
+    token = make_token(TEST_SECRET)
+    response = client.get("/user", headers={"Authorization": token})
+    assert response.status_code == 200
+    assert response.json() == "ctack321"
+    assert token in server.verified_tokens
+
+
+def test_get_user_local_jwks():
+    from cryptography.hazmat.primitives.asymmetric import ec
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    jwk = jwt.algorithms.ECAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    jwks = jwt.PyJWKSet.from_dict({"keys": [{**jwk, "kid": "local", "alg": "ES256", "use": "sig"}]})
+    token = make_token(private_key, "ES256", kid="local")
+    with patch("backend.server.local_jwks", jwks):
+        response = client.get("/user", headers={"Authorization": f"Bearer {token}"})
+    assert response.json() == "ctack321"
+
+
+def test_get_user_fetched_jwks():
+    from cryptography.hazmat.primitives.asymmetric import ec
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    jwk = jwt.algorithms.ECAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    jwks_client = MagicMock()
+    jwks_client.get_jwk_set.return_value = jwt.PyJWKSet.from_dict(
+        {"keys": [{**jwk, "kid": "current", "alg": "ES256", "use": "sig"}]})
+    jwks = server.JwksRefresher(jwks_client)
+    with patch("backend.server.jwks", jwks):
+        # nothing fetched yet, the request doesn't wait for it
+        token = make_token(private_key, "ES256", kid="current")
+        assert client.get("/user", headers={"Authorization": f"Bearer {token}"}).status_code == 401
+        assert jwks.wanted.is_set()
+        jwks_client.get_jwk_set.assert_not_called()
+
+        jwks.fetch()
+        jwks.wanted.clear()
+        assert client.get("/user", headers={"Authorization": f"Bearer {token}"}).json() == "ctack321"
+        # a key that wasn't fetched is rejected, and asks for the keys to be fetched again
+        token = make_token(private_key, "ES256", kid="rotated")
+        assert client.get("/user", headers={"Authorization": f"Bearer {token}"}).status_code == 401
+        assert jwks.wanted.is_set()
+    assert jwks_client.get_jwk_set.call_count == 1
+
+    with patch.object(server, "JWKS_MIN_REFRESH", 0):
+        jwks.start()
+        for _ in range(100):
+            if jwks_client.get_jwk_set.call_count == 2:
+                break
+            time.sleep(0.01)
+        jwks.stop()
+    assert jwks_client.get_jwk_set.call_count >= 2
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_get_user_rejects_bad_tokens():
+    assert client.get("/user", headers={"Authorization": make_token("wrong-secret-" + TEST_SECRET)}).status_code == 401
+    assert client.get("/user", headers={"Authorization": make_token(TEST_SECRET, expires_in=-10)}).status_code == 401
+    assert client.get("/user", headers={"Authorization": "not a token"}).status_code == 401
+    assert client.get("/user").status_code == 401
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_verify_token_cache_expiry():
+    token = make_token(TEST_SECRET)
+    server.verify_token(token)
+    server.verified_tokens[token] = {**server.verified_tokens[token], "exp": time.time() - 1}
+    with pytest.raises(jwt.ExpiredSignatureError):
+        server.verify_token(token)
+    assert token not in server.verified_tokens
+
+
+def slow_my_books(user_id, today):
+    time.sleep(0.05)
+    return []
+
+
+@patch("backend.server.ADMIN_USER_IDS", {"ctack321"})
+@patch("backend.server.jwt_secret", TEST_SECRET)
+@patch("backend.server.store.my_books", side_effect=slow_my_books)
+def test_profile_request(mock_fetch, tmp_path):
+    admin = {"Authorization": make_token(TEST_SECRET)}
+    with patch("profiling.PROFILE_DIR", str(tmp_path)):
+        response = client.post("/my-books", headers={**admin, "X-Profile": "1"}, json={"user_id": "ctack321"})
+        profile_id = response.headers["X-Profile-Id"]
+        listed = client.get("/admin/profiles", headers=admin).json()["data"]
+        assert [profile["id"] for profile in listed] == [profile_id]
+        assert listed[0]["name"] == "POST /my-books"
+        profile = client.get(f"/admin/profiles/{profile_id}", headers=admin).json()
+    frames = [frame["name"] for frame in profile["shared"]["frames"]]
+    assert "slow_my_books" in frames  # sampled on the threadpool thread running the query
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_profile_requires_admin(tmp_path):
+    user = {"Authorization": make_token(TEST_SECRET)}
+    with patch("profiling.PROFILE_DIR", str(tmp_path)):
+        response = client.get("/", headers={**user, "X-Profile": "1"})
+        assert "X-Profile-Id" not in response.headers
+        assert client.get("/admin/profiles", headers=user).status_code == 403
+        assert client.get("/admin/profiles/../secrets", headers=user).status_code in (403, 404)
+
+
+def test_profiles_ring_buffer(tmp_path):
+    with patch("profiling.PROFILE_DIR", str(tmp_path)), patch("profiling.PROFILE_KEEP", 2):
+        for i in range(4):
+            server.profiling.save_profile(f"{i}-a", {"name": f"GET /{i}", "duration": 0.1})
+        assert server.profiling.list_profile_ids() == ["3-a", "2-a"]
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+@patch("backend.server.store.engine")
+def test_checkout_book(mock_engine):
+    connection = mock_engine.begin.return_value.__enter__.return_value
+    connection.execute.return_value.first.return_value = MagicMock(due_date="2026-11-01")
+    version = server.catalog_version
+    response = client.put("/checkout", headers=auth(), json={"book_id": BOOK_A, "user_id": "someone-else"})
+    assert response.json() == "Book successfully checked out! Due date: 2026-11-01"
+    assert connection.execute.call_count == 1  # one round trip
+    assert connection.execute.call_args.args[1]["user_id"] == "ctack321"  # the token's user, not the body's
+    assert server.catalog_version == version + 1
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+@patch("backend.server.store.engine")
+def test_checkout_book_unavailable(mock_engine):
+    connection = mock_engine.begin.return_value.__enter__.return_value
+    connection.execute.return_value.first.return_value = None
+    response = client.put("/checkout", headers=auth(), json={"book_id": BOOK_A})
+    assert response.json() == "This Book is not currently available for checkout"
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+@patch("backend.server.store.engine")
+def test_checkout_book_open_loan_conflict(mock_engine):
+    from sqlalchemy.exc import IntegrityError
+    connection = mock_engine.begin.return_value.__enter__.return_value
+    duplicate = MagicMock()
+    duplicate.diag.constraint_name = "ux_checkout_logs_open_book_user"
+    connection.execute.side_effect = IntegrityError("insert", {}, duplicate)
+    response = client.put("/checkout", headers=auth(), json={"book_id": BOOK_A})
+    assert response.json() == "This Book is not currently available for checkout"
+
+    # other violations aren't a book being unavailable
+    missing_user = MagicMock()
+    missing_user.diag.constraint_name = "checkout_logs_user_id_fkey"
+    connection.execute.side_effect = IntegrityError("insert", {}, missing_user)
+    with pytest.raises(IntegrityError):
+        server.store.claim_book(BOOK_A, "ctack321", date(2026, 1, 1))
+    with pytest.raises(IntegrityError):
+        server.store.claim_books([BOOK_A], "ctack321", date(2026, 1, 1))
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+@patch("backend.server.store.engine")
+def test_checkout_and_return_invalid_book_id(mock_engine):
+    for path in ["/checkout", "/return"]:
+        assert client.put(path, headers=auth(), json={"book_id": "1"}).status_code == 400
+        response = client.put(path, headers=auth(), json={})
+        assert response.status_code == 400
+        assert response.json()["error"]["message"] == "This isn't a valid book id"
+    mock_engine.begin.assert_not_called()
+
+
+@patch("backend.server.store.engine")
+def test_checkout_book_requires_token(mock_engine):
+    assert client.put("/checkout", json={"book_id": "1", "user_id": "ctack321"}).status_code == 401
+    assert client.put("/checkout", headers={"Authorization": "token"}, json={"book_id": "1"}).status_code == 401
+    mock_engine.begin.assert_not_called()
+
+
+BOOK_A = "0b6f8a3e-3c1f-4c57-9d0e-5f3f1a6c2b11"
+BOOK_B = "8d2e41c7-51a2-4f0e-b1d9-7e6a0c9f4d22"
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+@patch("backend.server.store.engine")
+def test_checkout_books_batch(mock_engine):
+    connection = mock_engine.begin.return_value.__enter__.return_value
+    connection.execute.return_value.all.return_value = [MagicMock(id=BOOK_A, due_date="2026-11-01", held=False)]
+    response = client.put("/checkout/batch", headers={"Authorization": make_token(TEST_SECRET)},
+                          json={"book_ids": [BOOK_A, BOOK_B, BOOK_A, "abc"]})
+    results = response.json()["results"]
+    assert [(result["book_id"], result["status"]) for result in results] == [
+        (BOOK_A, "checked_out"), (BOOK_B, "unavailable"), ("abc", "invalid")]
+    assert connection.execute.call_count == 1  # one statement for the whole batch
+    assert connection.execute.call_args.args[1]["book_ids"] == [BOOK_A, BOOK_B]
+    assert connection.execute.call_args.args[1]["user_id"] == "ctack321"
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+@patch("backend.server.store.engine")
+def test_return_books_batch(mock_engine):
+    connection = mock_engine.begin.return_value.__enter__.return_value
+    connection.execute.return_value = [MagicMock(id=BOOK_B)]
+    response = client.put("/return/batch", headers={"Authorization": make_token(TEST_SECRET)},
+                          json={"book_ids": [BOOK_A, BOOK_B]})
+    results = response.json()["results"]
+    assert [(result["book_id"], result["status"]) for result in results] == [
+        (BOOK_A, "not_checked_out"), (BOOK_B, "returned")]
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+@patch("backend.server.store.engine")
+def test_return_book(mock_engine):
+    connection = mock_engine.begin.return_value.__enter__.return_value
+    connection.execute.return_value = [MagicMock(id=BOOK_A)]
+    response = client.put("/return", headers=auth(), json={"book_id": BOOK_A, "user_id": "someone-else"})
+    assert response.json() == "Book successfully returned"
+    assert connection.execute.call_args.args[1]["user_id"] == "ctack321"  # the token's user, not the body's
+
+
+@patch("backend.server.store.engine")
+def test_return_book_requires_token(mock_engine):
+    assert client.put("/return", json={"book_id": BOOK_A, "user_id": "ctack321"}).status_code == 401
+    mock_engine.begin.assert_not_called()
+
+
+def test_return_books_batch_requires_token():
+    response = client.put("/return/batch", json={"book_ids": [BOOK_A]})
+    assert response.status_code == 401
+
+
+@pytest.fixture
+def memory_store():
+    """Runs the handlers against an empty in-memory storage"""
+    with patch.object(server, "store", server.storage.MemoryStorage()) as store:
+        yield store
+
+
+def add_book(title, isbn, copies=1):
+    response = client.put("/book", headers={"Authorization": make_token(TEST_SECRET)},
+                          json={"title": title, "author": "A", "isbn": isbn, "copies": copies})
+    return response.json()
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_create_book_adds_copies(memory_store):
+    version = server.catalog_version
+    book = add_book("Dune", "0-441-17271-7")
+    assert server.catalog_version == version + 1
+    assert (book["total_copies"], book["available_copies"]) == (1, 1)
+    more = add_book("Dune", "0441172717", copies=2)  # the same ISBN written differently
+    assert more["id"] == book["id"]
+    assert (more["total_copies"], more["available_copies"]) == (3, 3)
+    assert book["isbn"] == "0441172717"  # stored normalized, like /books/import stores it
+    assert client.put("/book", headers=auth(), json={"title": "Dune", "author": "A", "isbn": "n/a"}).status_code == 400
+
+
+def test_create_book_requires_token():
+    response = client.put("/book", json={"title": "Dune", "author": "A", "isbn": "1"})
+    assert response.status_code == 401
+
+
+@pytest.mark.parametrize("copies", [0, -1, 1.5, "2", True])
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_create_book_invalid_copies(copies):
+    response = client.put("/book", headers={"Authorization": make_token(TEST_SECRET)},
+                          json={"title": "Dune", "author": "A", "isbn": "1", "copies": copies})
+    assert response.status_code == 400
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_memory_storage_checkout_and_return(memory_store):
+    book_id = add_book("Dune", "1", copies=2)["id"]
+    checkout = lambda user_id: client.put("/checkout", headers=auth(user_id), json={"book_id": book_id}).json()
+    assert checkout("ann").startswith("Book successfully checked out!")
+    assert checkout("ann") == "This Book is not currently available for checkout"  # one copy per user
+    assert checkout("bob").startswith("Book successfully checked out!")
+    assert checkout("cat") == "This Book is not currently available for checkout"  # no copies left
+    book = client.get("/books").json()["data"][0]
+    assert (book["available_copies"], book["is_checked_out"]) == (0, True)
+    assert [loan["id"] for loan in client.post("/my-books", json={"user_id": "ann"}).json()["data"]] == [book_id]
+
+    assert client.put("/return", headers=auth("ann"), json={"book_id": book_id}).json() == "Book successfully returned"
+    assert client.post("/my-books", json={"user_id": "ann"}).json() == "You haven't checked out any books"
+    book = client.get("/books").json()["data"][0]
+    assert (book["available_copies"], book["is_checked_out"]) == (1, False)
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_checkout_books_batch_skips_held_books(memory_store):
+    held, free = [add_book(title, str(i))["id"] for i, title in enumerate(["Dune", "Emma"])]
+    client.put("/checkout", headers=auth("ann"), json={"book_id": held})
+    results = client.put("/checkout/batch", headers=auth("ann"), json={"book_ids": [held, free]}).json()["results"]
+    assert [(result["book_id"], result["status"]) for result in results] == [(held, "already_checked_out"), (free, "checked_out")]
+    assert sorted(loan["title"] for loan in client.post("/my-books", json={"user_id": "ann"}).json()["data"]) == ["Dune", "Emma"]
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_memory_storage_pages_and_search(memory_store):
+    for i, title in enumerate(["Emma", "Dune", "Ulysses", "Beloved", "Middlemarch"]):
+        add_book(title, str(i))
+    first = client.get("/books", params={"limit": 2}).json()
+    second = client.get("/books", params={"limit": 2, "cursor": first["next_cursor"]}).json()
+    third = client.get("/books", params={"limit": 2, "cursor": second["next_cursor"]}).json()
+    titles = [book["title"] for page in (first, second, third) for book in page["data"]]
+    assert titles == ["Beloved", "Dune", "Emma", "Middlemarch", "Ulysses"]
+    assert third["next_cursor"] is None
+    assert [book["title"] for book in client.get("/books/search", params={"q": "midlemarch"}).json()["data"]] == ["Middlemarch"]
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_memory_storage_import(memory_store):
+    add_book("Dune", "0441172717")
+    body = "title,author,isbn\nDune,Frank Herbert,0-441-17271-7\nEmma,Jane Austen,978-0141439587\n"
+    response = client.post("/books/import", headers={"Authorization": make_token(TEST_SECRET), "Content-Type": "text/csv"}, content=body)
+    assert response.json() == {"inserted": 1, "skipped": 1, "duplicates": 0, "existing": 1, "invalid": 0}
+    assert [book["title"] for book in client.get("/books").json()["data"]] == ["Dune", "Emma"]
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_import_books_csv_quoted_newlines(memory_store):
+    body = 'title,author,isbn\n"Dune\nMessiah",Frank Herbert,0-399-12868-5\n"Emma","Austen,\nJane",978-0141439587\n'
+    response = client.post("/books/import", headers={**auth(), "Content-Type": "text/csv"}, content=body)
+    assert response.json()["inserted"] == 2
+    books = client.get("/books").json()["data"]
+    assert [(book["title"], book["author"]) for book in books] == [("Dune\nMessiah", "Frank Herbert"), ("Emma", "Austen,\nJane")]
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_import_books_csv_byte_order_mark(memory_store):
+    # spreadsheets save CSV files as UTF-8 with a byte order mark
+    body = "title,author,isbn\nDune,Frank Herbert,0-399-12868-5\n".encode("utf-8-sig")
+    response = client.post("/books/import", headers={**auth(), "Content-Type": "text/csv"}, content=body)
+    assert response.json() == {"inserted": 1, "skipped": 0, "duplicates": 0, "existing": 0, "invalid": 0}
+
+
+@patch("backend.server.ADMIN_USER_IDS", {"ctack321"})
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_overdue_loans(memory_store):
+    users = sorted(str(uuid.uuid4()) for _ in range(2))
+    books = [add_book(title, str(i))["id"] for i, title in enumerate(["Dune", "Emma", "Ulysses"])]
+    # checked out on the 1st and 3rd of March, so due on the 15th and 17th
+    for day, (book_id, user_id) in [(1, (books[0], users[1])), (1, (books[1], users[0])), (3, (books[2], users[1]))]:
+        with patch("backend.server.loan_date", return_value=date(2026, 3, day)):
+            client.put("/checkout", headers=auth(user_id), json={"book_id": book_id})
+
+    admin = {"Authorization": make_token(TEST_SECRET)}
+    with patch("backend.server.loan_date", return_value=date(2026, 3, 16)):
+        first = client.get("/overdue", headers=admin, params={"limit": 1}).json()
+        second = client.get("/overdue", headers=admin, params={"limit": 1, "cursor": first["next_cursor"]}).json()
+        overdue_users = client.get("/overdue/users", headers=admin).json()
+        my_books = client.post("/my-books", json={"user_id": users[1]}).json()["data"]
+
+    # both are due on the 15th, so they are in the order of their copy ids
+    assert sorted(loan["title"] for loan in first["data"] + second["data"]) == ["Dune", "Emma"]
+    assert second["next_cursor"] is None  # Ulysses isn't due until the 17th
+    assert first["data"][0]["days_overdue"] == 1
+    assert overdue_users == {"data": [{"user_id": users[0], "overdue_loans": 1, "oldest_due_date": "2026-03-15"},
+                                      {"user_id": users[1], "overdue_loans": 1, "oldest_due_date": "2026-03-15"}],
+                             "next_offset": None}
+    assert {book["title"]: book["is_overdue"] for book in my_books} == {"Dune": True, "Ulysses": False}
+
+    # returned loans are no longer overdue
+    client.put("/return", headers=auth(users[1]), json={"book_id": books[0]})
+    with patch("backend.server.loan_date", return_value=date(2026, 3, 20)):
+        loans = client.get("/overdue", headers=admin).json()["data"]
+    assert [(loan["title"], loan["days_overdue"]) for loan in loans] == [("Emma", 5), ("Ulysses", 3)]
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_overdue_requires_admin(memory_store):
+    user = {"Authorization": make_token(TEST_SECRET)}
+    assert client.get("/overdue", headers=user).status_code == 403
+    assert client.get("/overdue/users", headers=user).status_code == 403
+    with patch("backend.server.ADMIN_USER_IDS", {"ctack321"}):
+        assert client.get("/overdue", headers=user, params={"cursor": "bm90IGEgY3Vyc29y"}).status_code == 400
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_circulation_stats(memory_store):
+    books = [add_book(title, str(i), copies=2)["id"] for i, title in enumerate(["Dune", "Emma"])]
+    for user_id in ["ann", "bob"]:
+        client.put("/checkout", headers=auth(user_id), json={"book_id": books[0]})
+    client.put("/checkout", headers=auth("ann"), json={"book_id": books[1]})
+    client.put("/return", headers=auth("ann"), json={"book_id": books[0]})
+
+    stats = client.get("/stats/circulation").json()
+    assert (stats["checkouts"], stats["returns"]) == (3, 1)
+    assert [(day["checkouts"], day["returns"]) for day in stats["data"]] == [(3, 1)]
+    assert stats["average_loan_days"] is not None
+    popular = client.get("/stats/popular", params={"limit": 1}).json()["data"]
+    assert [(book["title"], book["checkouts"]) for book in popular] == [("Dune", 2)]
+
+    # the rollups only cover the days asked for
+    assert client.get("/stats/circulation", params={"end": "2020-01-31"}).json()["data"] == []
+    assert client.get("/stats/popular", params={"start": "2020-02-01", "end": "2020-01-01"}).status_code == 400
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_book_changes(memory_store):
+    since = client.get("/books/changes").json()["since"]
+    books = [add_book(title, str(i))["id"] for i, title in enumerate(["Dune", "Emma", "Ulysses"])]
+
+    first = client.get("/books/changes", params={"since": since, "limit": 2}).json()
+    second = client.get("/books/changes", params={"since": first["since"], "limit": 2}).json()
+    assert [book["title"] for book in first["data"] + second["data"]] == ["Dune", "Emma", "Ulysses"]
+    assert (first["has_more"], second["has_more"]) == (True, False)
+
+    client.put("/checkout", headers=auth("ann"), json={"book_id": books[1]})
+    changes = client.get("/books/changes", params={"since": second["since"]}).json()
+    assert [(book["title"], book["available_copies"]) for book in changes["data"]] == [("Emma", 0)]
+    assert changes["deleted"] == []
+    assert client.get("/books/changes", params={"since": changes["since"]}).json()["data"] == []
+    assert client.get("/books/changes", params={"since": "bm90IGEgc2luY2U="}).status_code == 400
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_availability_events(memory_store):
+    broker = server.events.EventBroker("test", size=2)
+    loop = asyncio.new_event_loop()
+    stream = broker.subscribe()
+
+    def receive():
+        return loop.run_until_complete(anext(stream)).decode()
+
+    try:
+        with patch.object(server, "broker", broker):
+            book = add_book("Dune", "1", copies=2)["id"]
+            assert receive() == "retry: 3000\n\n"
+            client.put("/checkout", headers=auth("ann"), json={"book_id": book})
+            client.put("/return", headers=auth("ann"), json={"book_id": book})
+            received = receive()
+            assert received.startswith("id: test-1\nevent: availability\ndata: ")
+            assert "\n\nid: test-2\nevent: availability\ndata: " in received
+            events = [json.loads(line[len("data: "):]) for line in received.splitlines() if line.startswith("data: ")]
+            assert [{key: event[key] for key in ("id", "available_copies", "total_copies")} for event in events] == [
+                {"id": book, "available_copies": 1, "total_copies": 2},
+                {"id": book, "available_copies": 2, "total_copies": 2}]
+            # clients order the events of a book by updated_at
+            assert events[0]["updated_at"] <= events[1]["updated_at"]
+            assert events[1]["updated_at"] == memory_store.books[book]["updated_at"].isoformat()
+
+            # a client reconnecting gets the events it missed, or a reset once they left the buffer
+            client.put("/checkout", headers=auth("bob"), json={"book_id": book})
+            assert [event for _, event in broker.since(broker.parse_id("test-2"))] == [broker.events[-1][1]]
+            assert broker.since(broker.parse_id("test-0")) is None
+            replay = broker.subscribe("test-1")
+            assert loop.run_until_complete(anext(replay)) == b"retry: 3000\n\n"
+            assert loop.run_until_complete(anext(replay)).startswith(b"id: test-2\n")
+            loop.run_until_complete(replay.aclose())
+            assert broker.parse_id("other-2") is None
+    finally:
+        loop.run_until_complete(stream.aclose())
+        loop.close()
+
+    # nobody is subscribed, the counters aren't read but reconnecting clients are reset
+    with patch.object(server, "broker", broker), patch.object(memory_store, "availability") as availability:
+        client.put("/return", headers=auth("bob"), json={"book_id": book})
+    availability.assert_not_called()
+    assert broker.sequence == 4 and broker.since(3) is None
+
+
+def test_event_broker_wakes_every_subscriber():
+    async def scenario():
+        broker = server.events.EventBroker("test")
+        streams = [broker.subscribe() for _ in range(100)]
+        for stream in streams:
+            await anext(stream)
+        reads = [asyncio.ensure_future(anext(stream)) for stream in streams]
+        await asyncio.sleep(0)
+        broker.publish("availability", {"id": "a"})
+        assert set(await asyncio.gather(*reads)) == {b'id: test-1\nevent: availability\ndata: {"id":"a"}\n\n'}
+
+        idle = broker.subscribe(heartbeat=0.01)
+        await anext(idle)
+        assert await anext(idle) == server.events.HEARTBEAT
+        for stream in streams + [idle]:
+            await stream.aclose()
+        assert broker.subscribers == 0
+
+    asyncio.run(scenario())
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_invalidation_from_another_process(memory_store):
+    dune, emma = [add_book(title, str(i))["id"] for i, title in enumerate(["Dune", "Emma"])]
+    recommender = recommendations.Recommender()
+    recommender.build([[("ann", dune)]], [])
+    lazy_recommender = server.LazyResource(lambda: recommender)
+    lazy_recommender.get()
+    broker = server.events.EventBroker("test")
+    loop = asyncio.new_event_loop()
+    stream = broker.subscribe()
+    try:
+        with patch.object(server, "recommender", lazy_recommender), patch.object(server, "broker", broker):
+            loop.run_until_complete(anext(stream))
+            # another process checked out Emma for ann
+            memory_store.claim_books([emma], "ann", date(2026, 1, 1))
+            version = server.catalog_version
+            server.apply_invalidation({"origin": "other", "kind": "checkout", "user_id": "ann", "book_ids": [emma]}, loop)
+            assert server.catalog_version == version + 1
+            assert recommender.count(dune, emma) == 1
+            assert b'"available_copies":0' in loop.run_until_complete(anext(stream))
+
+            server.apply_invalidation({"kind": "reset"}, loop)
+            assert loop.run_until_complete(anext(stream)) == b"id: test-2\nevent: reset\ndata: {}\n\n"
+    finally:
+        loop.run_until_complete(stream.aclose())
+        loop.close()
+
+
+def test_notify_processes():
+    bus = server.invalidation.InvalidationBus(None, "test", None)
+    with patch.object(server, "bus", bus):
+        server.notify_processes("return", book_ids=[str(i) for i in range(250)])
+        server.notify_processes("catalog")
+    messages = [json.loads(bus.pending.get()) for _ in range(4)]
+    assert [len(message.get("book_ids", [])) for message in messages] == [100, 100, 50, 0]
+    assert [message["sequence"] for message in messages] == [0, 1, 2, 3]
+    assert messages[3] == {"origin": "test", "sequence": 3, "kind": "catalog"}
+
+
+def test_lazy_resource():
+    factory = MagicMock()
+    resource = server.LazyResource(factory)
+    # introspection doesn't create it
+    assert not hasattr(resource, "_pool")
+    factory.assert_not_called()
+
+    resource.connect()
+    resource.connect()
+    factory.assert_called_once_with()
+    assert factory.return_value.connect.call_count == 2
+    assert resource.get() is factory.return_value
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_recommendations(memory_store):
+    books = {title: add_book(title, str(i), copies=3)["id"] for i, title in enumerate(["Dune", "Emma", "Ulysses", "Beloved"])}
+    for user_id, titles in [("ann", ["Dune", "Emma", "Ulysses"]), ("bob", ["Dune", "Emma"]), ("cat", ["Beloved"])]:
+        for title in titles:
+            client.put("/checkout", headers=auth(user_id), json={"book_id": books[title]})
+
+    recommender = server.LazyResource(lambda: recommendations.Recommender(top_n=5))
+    with patch.object(server, "recommender", recommender):
+        # checkouts before the first request aren't added, the first build reads them
+        client.put("/checkout", headers=auth("dan"), json={"book_id": books["Dune"]})
+        client.put("/return", headers=auth("dan"), json={"book_id": books["Dune"]})
+        assert recommender.resource is None
+
+        recommended = client.get(f"/books/{books['Dune']}/recommendations").json()["data"]
+        assert [(book["title"], book["readers"]) for book in recommended] == [("Emma", 2), ("Ulysses", 1)]
+        assert client.get(f"/books/{books['Beloved']}/recommendations").json()["data"] == []
+
+        # checkouts after the build are counted as they happen
+        client.put("/return", headers=auth("cat"), json={"book_id": books["Beloved"]})
+        for title in ["Ulysses", "Beloved"]:
+            client.put("/checkout", headers=auth("bob"), json={"book_id": books[title]})
+        recommended = client.get(f"/books/{books['Ulysses']}/recommendations", params={"limit": 2}).json()["data"]
+        # Beloved has one reader in common, Dune and Emma two each, tied in the order of their ids
+        assert sorted((book["title"], book["readers"]) for book in recommended) == [("Dune", 2), ("Emma", 2)]
+        assert client.get("/books/not-a-uuid/recommendations").status_code == 400
+
+
+def test_recommender_incremental_matches_build():
+    pairs = [("u1", "a"), ("u1", "b"), ("u2", "a"), ("u2", "c"), ("u3", "b"), ("u3", "c"), ("u3", "d")]
+    later = [("u1", "c"), ("u4", "d"), ("u4", "a"), ("u2", "a"), ("u2", "d")]
+    incremental = recommendations.Recommender(top_n=2)
+    incremental.build([pairs], [])
+    for user_id, book_id in later:
+        incremental.add_checkout(user_id, book_id)
+    rebuilt = recommendations.Recommender(top_n=2)
+    rebuilt.build([pairs + later], [])
+    assert incremental.top == rebuilt.top
+    assert rebuilt.top["a"] == [("c", 2), ("d", 2)]
+
+
+@patch("backend.server.supabase", None)
+def test_auth_without_supabase():
+    assert client.post("/auth", json={"email": "a@b.c", "password": "x"}).status_code == 503
+    assert client.post("/signup", json={"email": "a@b.c", "password": "x"}).status_code == 503
+
+
+def test_normalize_isbn():
+    assert server.normalize_isbn("0-306-40615-2") == "0306406152"
+    assert server.normalize_isbn(" 0-8044-2957-x ") == "080442957X"
+
+
+def mock_import_connection(mock_engine, inserted):
+    """Collects the CSV sent to the staging table by each COPY"""
+    cursor = mock_engine.raw_connection.return_value.cursor.return_value
+    cursor.rowcount = inserted
+    copied = []
+    cursor.copy_expert.side_effect = lambda sql, buffer: copied.append(buffer.read())
+    return copied
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+@patch("backend.server.store.engine")
+def test_import_books_csv(mock_engine):
+    copied = mock_import_connection(mock_engine, 1)
+    body = "Title,Author,ISBN\r\nDune,Frank Herbert,0-441-17271-7\r\nDune (copy),Frank Herbert,0441172717\r\n,No Title,123\r\nEmma,Jane Austen,978-0141439587\r\n"
+    response = client.post("/books/import", headers={"Authorization": make_token(TEST_SECRET), "Content-Type": "text/csv"}, content=body)
+    assert response.json() == {"inserted": 1, "skipped": 3, "duplicates": 1, "existing": 1, "invalid": 1}
+    assert copied == ["Dune,Frank Herbert,0441172717\r\nEmma,Jane Austen,9780141439587\r\n"]
+    mock_engine.raw_connection.return_value.commit.assert_called_once()
+
+
+@patch("backend.server.IMPORT_BATCH_SIZE", 2)
+@patch("backend.server.jwt_secret", TEST_SECRET)
+@patch("backend.server.store.engine")
+def test_import_books_ndjson_batches(mock_engine):
+    copied = mock_import_connection(mock_engine, 3)
+    body = "\n".join(json.dumps({"title": f"Book {i}", "author": "A", "isbn": f"{i}"}) for i in range(3)) + "\nnot json"
+    response = client.post("/books/import", headers={"Authorization": make_token(TEST_SECRET), "Content-Type": "application/x-ndjson"}, content=body)
+    assert response.json()["inserted"] == 3
+    assert response.json()["invalid"] == 1
+    assert len(copied) == 2  # a full batch and the remainder
+
+
+def test_import_books_requires_token():
+    response = client.post("/books/import", content="title,author,isbn\n")
+    assert response.status_code == 401
+
+
+def timed_concurrent_requests(clients: int, requests_per_client: int) -> float:
+    """Sends /my-books requests from several concurrent clients, returns the total time taken"""
+    async def run_client(http):
+        for _ in range(requests_per_client):
+            response = await http.post("/my-books", headers={"Authorization": "token"}, json={"user_id": "ctack321"})
+            assert response.status_code == 200
+
+    async def run_clients():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            start = time.perf_counter()
+            await asyncio.gather(*(run_client(http) for _ in range(clients)))
+            return time.perf_counter() - start
+
+    return asyncio.run(run_clients())
+
+
+def slow_query(user_id, today):
+    time.sleep(0.1)  # a query that blocks its thread for 100ms
+    return []
+
+
+@patch("backend.server.store.my_books", side_effect=slow_query)
+def test_blocking_queries_run_concurrently(mock_fetch):
+    one_client = timed_concurrent_requests(clients=1, requests_per_client=4)
+    ten_clients = timed_concurrent_requests(clients=10, requests_per_client=4)
+    # 10x the requests should take about as long, not 10x longer as they would on the event loop
+    assert one_client >= 0.4
+    assert ten_clients < one_client * 3
+    assert mock_fetch.call_count == 44
+
+
+@patch("backend.server.store.engine")
+def test_search_books(mock_engine):
+    rows = [{"id": str(i), "title": "Dune", "author": "Frank Herbert", "isbn": "111", "is_checked_out": False, "rank": 1.0} for i in range(3)]
+    connection = mock_books_query(mock_engine, rows)
+    response = client.get("/books/search", params={"q": "0-306-40615", "limit": 2, "offset": 4})
+    assert response.status_code == 200
+    body = response.json()
+    assert len(body["data"]) == 2
+    assert body["next_offset"] == 6
+    params = connection.execute.call_args.args[1]
+    assert params == {"q": "0-306-40615", "isbn_prefix": "030640615%", "limit": 3, "offset": 4}
+    # text that isn't part of an ISBN only matches titles and authors
+    client.get("/books/search", params={"q": "10%_off"})
+    assert connection.execute.call_args.args[1]["isbn_prefix"] is None
+
+
+@patch("backend.server.jwt_secret", TEST_SECRET)
+def test_search_books_hyphenated_isbn(memory_store):
+    add_book("Dune", "0-306-40615-2")
+    add_book("Catch 22", "22-1")
+    assert [book["title"] for book in client.get("/books/search", params={"q": "0-306-40615"}).json()["data"]] == ["Dune"]
+    assert [book["title"] for book in client.get("/books/search", params={"q": "0306 40615"}).json()["data"]] == ["Dune"]
+    assert [book["title"] for book in client.get("/books/search", params={"q": "Catch 22"}).json()["data"]] == ["Catch 22"]
+
+
+def test_search_books_blank():
+    response = client.get("/books/search", params={"q": "  "})
+    assert response.status_code == 400
+
+
 
 #Isolated tests for CLI functions (not interacting with server)
 #These use "Mock Testing"
@@ -47,6 +916,7 @@ def test_print_menu(capsys):
     assert "4. Return Book" in output
     assert "5. Login" in output
     assert "6. Exit" in output
+    assert "8. View All Books" in output
 
 
 
@@ -224,6 +1094,15 @@ def test_print_books_success(mock_input, mock_get, capsys):
     assert "Frank Herbert" in output
 
 
+@patch("backend.main.requests.get")
+@patch("builtins.input", return_value="") # Mock input for exiting function
+def test_print_books_copies(mock_input, mock_get, capsys):
+    mock_get.return_value.json.return_value = {"data": [
+        {"id": 1, "title": "Book 1", "author": "A", "isbn": "111", "total_copies": 3, "available_copies": 2}]}
+    cli.print_books()
+    assert "Available: 2/3" in capsys.readouterr().out
+
+
 @patch("backend.main.requests.get")
 @patch("builtins.input", return_value="") # Mock input for exiting function
 def test_print_books_empty(mock_input, mock_get, capsys):
@@ -241,6 +1120,98 @@ def test_print_books_empty(mock_input, mock_get, capsys):
 
 
 
+@patch("backend.main.requests.get")
+@patch("builtins.input", side_effect=["", ""]) # next page, then exit function
+def test_print_books_pages(mock_input, mock_get, capsys):
+    first_page = MagicMock()
+    first_page.json.return_value = {"data": [{"id": 1, "title": "Book 1", "author": "A", "isbn": "111"}], "next_cursor": "abc"}
+    second_page = MagicMock()
+    second_page.json.return_value = {"data": [{"id": 2, "title": "Book 2", "author": "B", "isbn": "222"}], "next_cursor": None}
+    since = MagicMock()
+    since.json.return_value = {"data": [], "deleted": [], "since": "s1", "has_more": False}
+    mock_get.side_effect = [since, first_page, second_page]
+    cli.print_books()
+    output = capsys.readouterr().out
+    assert "Book 1" in output
+    assert "Book 2" in output
+    assert mock_get.call_args_list[2].kwargs["params"] == {"limit": cli.page_size, "cursor": "abc"}
+
+
+@patch("backend.main.requests.get")
+@patch("builtins.input", return_value="q") # stop after the first page
+def test_print_books_stop_paging(mock_input, mock_get, capsys):
+    mock_get.return_value.json.return_value = {"data": [{"id": 1, "title": "Book 1", "author": "A", "isbn": "111"}], "next_cursor": "abc"}
+    cli.print_books()
+    assert [call.args[0] for call in mock_get.call_args_list].count("https://lms.murtsa.dev/books") == 1
+
+
+
+
+
+@patch("backend.main.requests.get")
+@patch("builtins.input", return_value="") # Mock input for exiting function
+def test_print_books_not_modified(mock_input, mock_get, capsys):
+    cli.books_cache[None] = ("\"etag\"", {"data": [{"id": 1, "title": "Cached Book", "author": "A", "isbn": "111"}]})
+    mock_get.return_value.status_code = 304
+    cli.print_books()
+    output = capsys.readouterr().out
+    assert "Cached Book" in output
+    assert mock_get.call_args.kwargs["headers"] == {"If-None-Match": "\"etag\""}
+
+
+@patch("backend.main.requests.get")
+@patch("builtins.input", return_value="") # Mock input for exiting function
+def test_print_books_applies_changes(mock_input, mock_get, capsys):
+    def response(data, etag=None):
+        response = MagicMock(status_code=200, headers={"ETag": etag} if etag else {})
+        response.json.return_value = data
+        return response
+
+    dune = {"id": "1", "title": "Dune", "author": "A", "isbn": "111", "total_copies": 2, "available_copies": 2}
+    emma = {"id": "2", "title": "Emma", "author": "B", "isbn": "222", "total_copies": 1, "available_copies": 1}
+    mock_get.side_effect = [
+        response({"data": [], "deleted": [], "since": "s1", "has_more": False}),
+        response({"data": [dune, emma], "next_cursor": None}, etag='"v1"'),
+        # Dune was checked out and Emma deleted, the cached page is updated without fetching it
+        response({"data": [{**dune, "available_copies": 1}], "deleted": ["2"], "since": "s2", "has_more": False}),
+        # a new book can belong on any page, so the page is fetched again
+        response({"data": [{"id": "3", "title": "Beloved", "author": "C", "isbn": "333"}], "deleted": [],
+                  "since": "s3", "has_more": False}),
+        response({"data": [], "next_cursor": None}, etag='"v3"'),
+    ]
+    cli.print_books()
+    capsys.readouterr()
+    cli.print_books()
+    output = capsys.readouterr().out
+    assert "Available: 1/2" in output and "Emma" not in output
+    assert mock_get.call_args.kwargs["params"] == {"since": "s1"}
+    assert mock_get.call_count == 3
+
+    cli.print_books()
+    assert mock_get.call_args_list[3].kwargs["params"] == {"since": "s2"}
+    assert mock_get.call_args.args[0] == "https://lms.murtsa.dev/books"
+    assert mock_get.call_args.kwargs["headers"] == {}
+    assert cli.books_since == "s3"
+
+
+@patch("backend.main.requests.get")
+@patch("builtins.input", return_value="") # Mock input for exiting function
+def test_print_books_stream(mock_input, mock_get, capsys):
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.iter_lines.return_value = iter([
+        b'{"id": 1, "title": "Book 1", "author": "Frank Herbert", "isbn": "111-111"}', b"",
+        b'{"id": 2, "title": "Book 2", "author": "Author 2", "isbn": "222-222"}'])
+    cli.print_books(stream=True)
+    output = capsys.readouterr().out
+    assert "Book 1" in output
+    assert "Book 2" in output
+    assert mock_get.call_args.kwargs["headers"] == {"Accept": "application/x-ndjson"}
+    assert mock_get.call_args.kwargs["stream"] is True
+
+
+
+
+
 #add_book
 
 
@@ -398,6 +1369,29 @@ def test_return_book_failure(mock_put, mock_get, mock_input, mock_print_books, c
 
 
 
+@patch("backend.main.print_my_books")
+@patch("builtins.input", side_effect=["1, 2"]) #two ids
+@patch("backend.main.requests.get")
+@patch("backend.main.requests.put")
+def test_return_book_batch(mock_put, mock_get, mock_input, mock_print_my_books, capsys):
+    cli.token = "fake_token"
+
+    mock_put.return_value.status_code = 200
+    mock_put.return_value.json.return_value = {"results": [
+        {"book_id": "1", "status": "returned", "message": "Book successfully returned"},
+        {"book_id": "2", "status": "not_checked_out", "message": "This book isn't currently checked out by you"}]}
+
+    cli.return_book()
+
+    output = capsys.readouterr().out
+    assert "ID 1: Book successfully returned" in output
+    assert "ID 2: This book isn't currently checked out by you" in output
+    assert mock_put.call_args.kwargs["json"] == {"book_ids": ["1", "2"]}
+    mock_get.assert_not_called()  # no /user lookup for a batch
+    del cli.token
+
+
+
 #clear_screen
 
 @patch("backend.main.os.system")